@@ -1,17 +1,5 @@
-import os
-import sys
-import shutil
+# The stages are in pipeline.py, next to this script
+from pipeline import main
 
-sys.path.insert(0, os.environ["MP_HOME"])
-from mp_tools import *
-
-MYDIR = os.path.split(os.path.abspath(__file__))[0]
-FRONTEND_DIR = os.path.join(MYDIR, "frontend")
-os.chdir(FRONTEND_DIR)
-yarn = shutil.which("yarn")
-run([yarn, "install"])
-run([yarn, "build"])
-if os.path.isdir("wifi_setup"):
-    shutil.rmtree("wifi_setup")
-os.mkdir("wifi_setup")
-minify(["-c", "-v", "build", "wifi_setup"])
+# yarn install, yarn build and minify, each of them only when its inputs changed (see pipeline.py)
+main(["minify"])
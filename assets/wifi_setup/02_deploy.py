@@ -1,16 +1,5 @@
-import os
-import sys
+# The stages are in pipeline.py, next to this script
+from pipeline import main
 
-sys.path.insert(0, os.environ["MP_HOME"])
-from mp_tools import *
-
-MYDIR = os.path.split(os.path.abspath(__file__))[0]
-FRONTEND_DIR = os.path.join(MYDIR, "frontend")
-
-sync(["makedirs", "/www/wifi_setup"])
-sync([
-    "--quick", "--overwrite", "--contents", "upload",
-    os.path.join(FRONTEND_DIR, "wifi_setup"),
-    "/www/wifi_setup"
-])
-sync(["--quick", "--overwrite", "--contents", "upload", MP_LIBS, "/"])
+# Upload the files of the minified frontend and the libraries that differ from the ones on the device
+main(["deploy"], deps=False)
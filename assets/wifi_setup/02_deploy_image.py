@@ -0,0 +1,6 @@
+# The stages are in pipeline.py, next to this script
+from pipeline import main
+
+# Read the partition layout and the saved settings from the device, build a file system image with them, the
+# minified frontend and the libraries, and flash it unless the device has it already (see pipeline.py)
+main(["probe", "package", "deploy_image"], deps=False)
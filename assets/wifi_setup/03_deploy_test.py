@@ -1,9 +1,4 @@
-import os
-import sys
-sys.path.insert(0, os.environ["MP_HOME"])
-from mp_tools import *
+# The stages are in pipeline.py, next to this script
+from pipeline import main
 
-MYDIR = os.path.split(os.path.abspath(__file__))[0]
-TEST_BACKEND_DIR = os.path.join(MYDIR, "test_backend")
-
-sync(["--quick", "--overwrite", "--contents", "upload", TEST_BACKEND_DIR, "/"])
\ No newline at end of file
+main(["deploy_test"], deps=False)
@@ -69,6 +69,7 @@ export interface IWifiNetworkParams {
   password: string;
   ip?: string;
   last_ifconfig?: string[];
+  last_ok?: number;
 }
 
 export interface IWifiIfconfig {
@@ -6,7 +6,6 @@ import * as serviceWorker from './serviceWorker';
 
 ReactDOM.render(<App />, document.getElementById('root'));
 
-// If you want your app to work offline and load faster, you can change
-// unregister() to register() below. Note this comes with some pitfalls.
-// Learn more about service workers: http://bit.ly/CRA-PWA
-serviceWorker.unregister();
+// The service worker is generated by esp_minify_www.py, it caches the files of the app in the browser,
+// so they are not downloaded from the device again. Browsers only allow it over https and on localhost.
+serviceWorker.register();
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import sys
+import shutil
+
+sys.path.insert(0, os.environ["MP_HOME"])
+from mp_tools import *
+
+MYDIR = os.path.split(os.path.abspath(__file__))[0]
+FRONTEND_DIR = os.path.join(MYDIR, "frontend")
+BUILD_DIR = os.path.join(FRONTEND_DIR, "build")
+WWW_DIR = os.path.join(FRONTEND_DIR, "wifi_setup")
+TEST_BACKEND_DIR = os.path.join(MYDIR, "test_backend")
+# Fingerprints of the stages, see mp_tools.Pipeline
+STATE_PATH = os.path.join(FRONTEND_DIR, "pipeline.json")
+# The build fails when the frontend grows over these (compressed sizes, see esp_minify_www.py --budget)
+BUDGETS = ["page=512K", "requests=4", "load_time=5"]
+
+IMAGE_DIR = os.path.join(FRONTEND_DIR, "fsimage")
+LAYOUT_PATH = os.path.join(IMAGE_DIR, "layout.json")
+KEEP_DIR = os.path.join(IMAGE_DIR, "keep")
+IMAGE_PATH = os.path.join(IMAGE_DIR, "fs.img")
+# These files are created on the device (the saved settings), they are copied into the new image.
+KEEP_FILES = ["/wifi.json", "/wifi_ap.json"]
+
+
+def yarn(*args):
+    run([shutil.which("yarn")] + list(args), cwd=FRONTEND_DIR)
+
+
+def minify_frontend():
+    # The output is not wiped: unchanged files are kept as they are (and not uploaded again), the others are removed.
+    os.makedirs(WWW_DIR, exist_ok=True)
+    budget_args = []
+    for budget in BUDGETS:
+        budget_args += ["--budget", budget]
+    minify(["--prune", "-v", "--bundle"] + budget_args + [BUILD_DIR, WWW_DIR])
+
+
+def deploy():
+    sync(
+        ["makedirs", "/www/wifi_setup"],
+        ["--checksum", "--compress", "--overwrite", "--contents", "upload", WWW_DIR, "/www/wifi_setup"],
+        ["--checksum", "--compress", "--overwrite", "--contents", "upload", MP_LIBS, "/"],
+    )
+
+
+def deploy_test():
+    sync(["--checksum", "--compress", "--overwrite", "--contents", "upload", TEST_BACKEND_DIR, "/"])
+
+
+def probe():
+    # Only the files that are on the device now are kept, not the ones saved from an earlier device.
+    shutil.rmtree(KEEP_DIR, ignore_errors=True)
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    keep_args = []
+    for path in KEEP_FILES:
+        keep_args += ["--keep", path]
+    fsimage(["probe", "--output", LAYOUT_PATH, "--keep-dir", KEEP_DIR] + keep_args)
+
+
+def package():
+    add_args = [
+        "--add", WWW_DIR, "/www/wifi_setup",
+        "--add", MP_LIBS, "/",
+    ]
+    if os.path.isdir(KEEP_DIR):
+        add_args += ["--add", KEEP_DIR, "/"]
+    fsimage(["build", "--layout", LAYOUT_PATH] + add_args + [IMAGE_PATH])
+
+
+def deploy_image():
+    with open(LAYOUT_PATH) as fin:
+        layout = json.load(fin)
+    reflash(["--baud", "921600"], hex(layout["offset"]), IMAGE_PATH)
+    fsimage(["verify", "--layout", LAYOUT_PATH, IMAGE_PATH])
+
+
+def make_pipeline(jobs=None):
+    pipeline = Pipeline(STATE_PATH, jobs=jobs)
+    package_json = [os.path.join(FRONTEND_DIR, fname) for fname in ["package.json", "yarn.lock"]]
+    pipeline.stage("install", lambda: yarn("install"), inputs=package_json,
+                   outputs=[os.path.join(FRONTEND_DIR, "node_modules")])
+    pipeline.stage("build", lambda: yarn("build"), after=["install"], outputs=[BUILD_DIR],
+                   inputs=package_json + [os.path.join(FRONTEND_DIR, "src"), os.path.join(FRONTEND_DIR, "public")])
+    pipeline.stage("minify", minify_frontend, after=["build"], outputs=[WWW_DIR], key=BUDGETS,
+                   inputs=[BUILD_DIR, os.path.join(MP_TOOLS, "esp_minify_www.py")])
+    # Stages that use the device always run: the state file cannot tell what is on the device (it may be a new or an
+    # erased board on the same port). They compare with the device themselves, and only write what differs.
+    # Upload the changed files one by one (02_deploy.py)
+    pipeline.stage("deploy", deploy, after=["minify"], inputs=[WWW_DIR, MP_LIBS], resource=DEVICE, always=True)
+    pipeline.stage("deploy_test", deploy_test, inputs=[TEST_BACKEND_DIR], resource=DEVICE, always=True)
+    # Or write a file system image (02_deploy_image.py). The layout and the saved settings are read from the device
+    # every time, the image is only built again when they (or the files) change.
+    pipeline.stage("probe", probe, resource=DEVICE, always=True)
+    pipeline.stage("package", package, after=["minify", "probe"], outputs=[IMAGE_PATH],
+                   inputs=[WWW_DIR, MP_LIBS, KEEP_DIR, LAYOUT_PATH])
+    pipeline.stage("deploy_image", deploy_image, after=["package"], inputs=[IMAGE_PATH, LAYOUT_PATH],
+                   resource=DEVICE, always=True)
+    return pipeline
+
+
+def main(default_targets, deps=True):
+    parser = argparse.ArgumentParser(
+        description='Build the wifi_setup frontend and deploy it. Stages that are up to date are skipped.')
+    parser.add_argument("-f", "--force", dest='force', action="append", default=[],
+                        help="Run this stage even if it is up to date, can be given multiple times. 'all' runs"
+                             " all of them.")
+    parser.add_argument("-j", "--jobs", dest='jobs', type=int, default=None,
+                        help="Number of stages that can run at the same time.")
+    parser.add_argument("-l", "--list", dest='list', action="store_true", default=False,
+                        help="List the stages and exit.")
+    parser.add_argument(dest='targets', nargs="*", default=default_targets,
+                        help="Stages to run (with the stages they depend on). Default is %s." % default_targets)
+    args = parser.parse_args()
+
+    pipeline = make_pipeline(args.jobs)
+    if args.list:
+        for name, stage in pipeline.stages.items():
+            print("%-16s after: %s" % (name, ", ".join(stage.after) or "-"))
+        return
+    force = True if "all" in args.force else args.force
+    if not pipeline.run(args.targets, force=force, deps=deps):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(["deploy"])
@@ -1,6 +1,8 @@
 import ubinascii
 import json
 import os
+import gc
+import utime
 
 CT_JS = b'application/javascript; charset=UTF-8'
 
@@ -23,15 +25,73 @@ CT = {
 
 DEBUG = False
 
+# Files in these folders have the hash of their contents in their names (create-react-app and the bundles of
+# esp_minify_www.py), so browsers can keep them. Other files (index.html, service-worker.js) are checked every time.
+IMMUTABLE_PREFIXES = (b'static/',)
+CC_IMMUTABLE = b'public, max-age=31536000, immutable'
+CC_REVALIDATE = b'no-cache'
+
+# Per-request instrumentation. When STATS is set, serve_get records latency (accept to close, in ms),
+# bytes sent, status code, path class and heap delta for every request. The last STATS_SIZE requests
+# are kept in a ring buffer, and all of them are aggregated into per path class counters.
+STATS = False
+STATS_SIZE = 16
+
+_st_ring = []
+_st_idx = 0
+_st_totals = {}
+_st_code = 0
+_st_sent = 0
+_st_cls = 'other'
+
+
+def _st_record(ms, heap):
+    global _st_idx
+    item = (ms, _st_sent, _st_code, _st_cls, heap)
+    if len(_st_ring) < STATS_SIZE:
+        _st_ring.append(item)
+    else:
+        _st_ring[_st_idx] = item
+    _st_idx = (_st_idx + 1) % STATS_SIZE
+    tot = _st_totals.get(_st_cls)
+    if tot is None:
+        tot = _st_totals[_st_cls] = {"n": 0, "bytes": 0, "ms": 0, "max_ms": 0, "err": 0}
+    tot["n"] += 1
+    tot["bytes"] += _st_sent
+    tot["ms"] += ms
+    if ms > tot["max_ms"]:
+        tot["max_ms"] = ms
+    if _st_code >= 400:
+        tot["err"] += 1
+
+
+def stats(reset=False):
+    """Return collected statistics as a json serializable dict.
+
+    recent is a list of [ms, bytes, status, path_class, heap_delta] items, oldest first."""
+    global _st_ring, _st_idx, _st_totals
+    if len(_st_ring) < STATS_SIZE:
+        recent = _st_ring[:]
+    else:
+        recent = _st_ring[_st_idx:] + _st_ring[:_st_idx]
+    result = {"enabled": STATS, "size": STATS_SIZE, "totals": _st_totals, "recent": recent}
+    if reset:
+        _st_ring, _st_idx, _st_totals = [], 0, {}
+    return result
+
 
 def resp(cl, code, ct, dat):
-    h = b'HTTP/1.0 %s\r\nCache-Control:no-cache\r\nContent-Type:%s\r\nContent-Length:%s\r\nConnection: close\r\n\r\n' % (
+    global _st_code, _st_sent
+    h = b'HTTP/1.0 %s\r\nCache-Control:no-cache\r\nContent-Type:%s\r\nContent-Length:%d\r\nConnection: close\r\n\r\n' % (
     code, ct, len(dat))
     if DEBUG:
         print(h.decode('ascii'))
     cl.sendall(h)
     cl.sendall(dat)
     cl.close()
+    if STATS:
+        _st_code = int(code[:3])
+        _st_sent += len(h) + len(dat)
 
 
 def resp_json(cl, code, data):
@@ -39,12 +99,27 @@ def resp_json(cl, code, data):
 
 
 def error(cl, code):
-    resp(cl, code, CT_JS, json.dumps({"code": code}).encode("ascii"))
+    resp(cl, code, CT_JS, json.dumps({"code": code.decode("ascii")}).encode("ascii"))
 
 
 def serve_get(srv, handle, webroot='/www'):
+    global _st_code, _st_sent, _st_cls
     cl, addr = srv.accept()
     print("CONNECT!")
+    if not STATS:
+        _serve(cl, addr, handle, webroot)
+        return
+    started = utime.ticks_ms()
+    mem_free = gc.mem_free()
+    _st_code, _st_sent, _st_cls = 0, 0, 'other'
+    try:
+        _serve(cl, addr, handle, webroot)
+    finally:
+        _st_record(utime.ticks_diff(utime.ticks_ms(), started), gc.mem_free() - mem_free)
+
+
+def _serve(cl, addr, handle, webroot):
+    global _st_code, _st_sent, _st_cls
     cl_file = cl.makefile('rwb', 0)
     get = None
     while True:
@@ -60,6 +135,7 @@ def serve_get(srv, handle, webroot='/www'):
         return
     sprm = get[5:get.rfind(b' HTTP/')]
     if sprm.startswith(b'api/'):
+        _st_cls = 'api'
         params = None
         if sprm:
             try:
@@ -73,9 +149,11 @@ def serve_get(srv, handle, webroot='/www'):
             error(cl, b"500 Internal server error")
             if DEBUG:
                 raise
-    elif '..' in sprm:
+    elif b'..' in sprm:
+        _st_cls = 'static'
         error(cl, b"403 Unauthorized parent folder")
     else:
+        _st_cls = 'static'
         sprm = sprm or b"index.html"
         fp = webroot + "/" + sprm.decode("ascii")
         if DEBUG:
@@ -96,18 +174,28 @@ def serve_get(srv, handle, webroot='/www'):
                 error(cl, b"404 Not found")
                 return
 
-        h = b'HTTP/1.0 200 OK\r\nContent-Type:%s\r\nContent-Length:%s\r\nCache-Control:3600\r\n' % (ct, size)
+        cc = CC_REVALIDATE
+        for prefix in IMMUTABLE_PREFIXES:
+            if sprm.startswith(prefix):
+                cc = CC_IMMUTABLE
+        h = b'HTTP/1.0 200 OK\r\nContent-Type:%s\r\nContent-Length:%d\r\nCache-Control:%s\r\n' % (ct, size, cc)
         if gz:
             h += b'Content-Encoding:gzip\r\n'
         if DEBUG:
             print(h.decode("ascii"))
+        h += b'Connection: close\r\n\r\n'
         cl.sendall(h)
-        cl.sendall(b'Connection: close\r\n\r\n')
+        sent = len(h)
         buf = bytearray(512)
+        mv = memoryview(buf)
         with open(fp, "rb") as fin:
             while True:
                 dat = fin.readinto(buf)
-                if dat == 0:
+                if not dat:
                     break
-                cl.sendall(buf)
+                cl.sendall(mv[:dat])
+                sent += dat
         cl.close()
+        if STATS:
+            _st_code = 200
+            _st_sent += sent
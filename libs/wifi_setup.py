@@ -10,6 +10,14 @@ import machine
 
 RESET_TIME = 5
 DEBUG = False
+# How main() connects to configured networks:
+#   "scan"   - scan first, then try the configured networks that are visible, strongest first
+#   "bssid"  - the same as "scan", but connect to the BSSID found by the scan, so the chip does not scan again
+#   "direct" - try all configured networks without scanning, the last one that was set up first (see "last_ok"
+#              in mark_last_ok). Networks without "last_ok" (saved by older versions) come last, in arbitrary order.
+CONNECT_STRATEGY = "scan"
+# Give up connecting to a network after this many seconds. None means: wait until the connection fails.
+CONNECT_TIMEOUT = None
 
 try:
     with open("wifi_ap.json", "r") as fin:
@@ -57,6 +65,15 @@ def save_params():
         print(wifi_params_good)
 
 
+def mark_last_ok(ssid):
+    # The order of a dict is arbitrary in MicroPython (and so is the order of json.loads), so the order of the
+    # networks is saved in a sequence number: the network that connected last has the highest "last_ok".
+    others = [params.get("last_ok", 0) for name, params in wifi_params.items() if name != ssid]
+    last_ok = max(others) + 1 if others else 1
+    if wifi_params[ssid].get("last_ok", 0) < last_ok:
+        wifi_params[ssid]["last_ok"] = last_ok
+
+
 ssid = None
 
 gc.collect()
@@ -87,11 +104,14 @@ def handle(cl, addr, args):
             cfg = wlan.ifconfig()
             if cfg and ssid in wifi_params:
                 wifi_params[ssid]["last_ifconfig"] = cfg
+                mark_last_ok(ssid)
                 wifi_params_good[ssid] = wifi_params[ssid]
                 save_params()
             return cfg
         else:
             return None
+    elif op == "stats":
+        return websrv.stats(args.get("reset", False))
     elif op == "reset":
         machine.reset()
     else:
@@ -121,12 +141,22 @@ def run_setup(webroot='/www/wifi_setup'):
             gc.collect()
 
 
-def try_net(ssid):
-    wlan.connect(ssid, wifi_params[ssid]["password"])
+def try_net(ssid, bssid=None):
+    if bssid:
+        wlan.connect(ssid, wifi_params[ssid]["password"], bssid=bssid)
+    else:
+        wlan.connect(ssid, wifi_params[ssid]["password"])
+    elapsed = 0.0
     while True:
         st = wlan.status()
         if st == network.STAT_CONNECTING:
+            if CONNECT_TIMEOUT is not None and elapsed >= CONNECT_TIMEOUT:
+                if DEBUG:
+                    print("connecting to %s timed out" % ssid)
+                wlan.disconnect()
+                return False
             utime.sleep(0.2)
+            elapsed += 0.2
         elif st == network.STAT_GOT_IP:
             return True
         else:
@@ -175,11 +205,16 @@ def main(webroot='/www/wifi_setup', reset_pin=14, on_reset_config=None):
         return True
     if not wifi_params:
         run_setup(webroot)  # never returns
+    if CONNECT_STRATEGY == "direct":
+        for ssid in sorted(wifi_params, key=lambda name: -wifi_params[name].get("last_ok", 0)):
+            if try_net(ssid):
+                return True
+        run_setup(webroot)  # never returns
     networks = wlan.scan()
     networks.sort(key=lambda item: -item[3])
     for n in networks:
         ssid = n[0].decode("ascii")
         if ssid in wifi_params:
-            if try_net(ssid):
+            if try_net(ssid, n[1] if CONNECT_STRATEGY == "bssid" else None):
                 return True
     run_setup(webroot)  # never returns
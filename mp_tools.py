@@ -1,6 +1,12 @@
 import os
 import sys
+import json
+import time
+import shlex
+import hashlib
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 MP_HOME = os.path.split(os.path.abspath(__file__))[0]
 MP_TOOLS = os.path.join(MP_HOME, "tools")
@@ -8,40 +14,308 @@ MP_LIBS = os.path.join(MP_HOME, "libs")
 MP_ASSETS = os.path.join(MP_HOME, "assets")
 MP_FIRMWARES = os.path.join(MP_HOME, "firmwares")
 
+ESP_SYNC = os.path.join(MP_TOOLS, "espsyncer.py")
+ESP_SYNC_CMD = [sys.executable, ESP_SYNC, "-v"]
+ESP_FLEET_CMD = [sys.executable, os.path.join(MP_TOOLS, "espfleet.py"), "-v"]
+ESP_MINIFY_CMD = [sys.executable, os.path.join(MP_TOOLS, "esp_minify_www.py")]
+
+# These directories are not part of the fingerprint of a pipeline stage input.
+FINGERPRINT_IGNORED_DIRS = ["node_modules", "__pycache__", ".git"]
+# Stages that use the same device can't run at the same time, they have this resource.
+DEVICE = "device"
+
 
 def get_firmwares(code_name):
     return [fname for fname in sorted(os.listdir(
         os.path.join(MP_FIRMWARES, code_name))) if fname.lower().endswith(".bin")]
 
 
-ESP8266_FIRMWARES = get_firmwares("esp8266")
-LATEST_ESP8266_FIRMARE = ESP8266_FIRMWARES[-1]
-LATEST_ESP8266_FIRMWARE_PATH = os.path.join(MP_FIRMWARES, "esp8266", LATEST_ESP8266_FIRMARE)
+def latest_firmware_path(code_name):
+    """Path of the latest firmware for a chip, e.g. latest_firmware_path("esp32")."""
+    firmwares = get_firmwares(code_name)
+    if not firmwares:
+        raise SystemExit("There is no firmware in %s" % os.path.join(MP_FIRMWARES, code_name))
+    return os.path.join(MP_FIRMWARES, code_name, firmwares[-1])
 
-ESP32_FIRMWARES = get_firmwares("esp32")
-LATEST_ESP32_FIRMWARE = ESP32_FIRMWARES[-1]
-LATEST_ESP32_FIRMWARE_PATH = os.path.join(MP_FIRMWARES, "esp32", LATEST_ESP32_FIRMWARE)
 
-ESP_SYNC = os.path.join(MP_TOOLS, "espsyncer.py")
-ESP_SYNC_CMD = [sys.executable, ESP_SYNC, "-v"]
+def esp_port():
+    """Port of the device, from the ESP_PORT environment variable.
 
-ESP_PORT = os.environ["ESP_PORT"]
-ESP_TOOL_CMD = ["esptool.py", "--port", ESP_PORT]
+    It is looked up when it is needed, so mp_tools can be imported without a device (e.g. for building)."""
+    port = os.environ.get("ESP_PORT")
+    if not port:
+        raise SystemExit("The ESP_PORT environment variable must be set.")
+    return port
 
-ESP_MINIFY_CMD = [sys.executable, os.path.join(MP_TOOLS, "esp_minify_www.py") ]
 
-def run(cmd):
+def esp_tool_cmd():
+    # The ESP_TOOL environment variable can replace esptool, e.g. with a stub for testing.
+    return shlex.split(os.environ.get("ESP_TOOL", "esptool.py")) + ["--port", esp_port()]
+
+
+def esp_fsimage_cmd():
+    return [sys.executable, os.path.join(MP_TOOLS, "esp_fsimage.py"), "-v", "--port", esp_port()]
+
+
+def run(cmd, input=None, check=True, cwd=None):
+    """Run a command. Returns True when it was successful (it raises an exception instead when check is set)."""
     print("RUN: ", cmd)
-    subprocess.run(cmd, check=True)
+    return subprocess.run(cmd, check=check, input=input, cwd=cwd).returncode == 0
+
 
+def sync(*operations: list):
+    """Run espsyncer with the given arguments.
 
-def sync(args: list):
-    run(ESP_SYNC_CMD + args)
+    When more operations are given (each of them is a list of arguments), then they are run in batch mode:
+    in a single session, with a single reset of the device.
 
+    When the ESP_PORTS environment variable is set, then the operations are run on all of those devices
+    at once, with espfleet."""
+    if os.environ.get("ESP_PORTS"):
+        batch = "\n".join(shlex.join(args) for args in operations)
+        run(ESP_FLEET_CMD + ["batch", "-"], input=batch.encode("UTF-8"))
+    elif len(operations) == 1:
+        run(ESP_SYNC_CMD + operations[0])
+    else:
+        batch = "\n".join(shlex.join(args) for args in operations)
+        run(ESP_SYNC_CMD + ["batch", "-"], input=batch.encode("UTF-8"))
 
-def esptool(args: list):
-    run(ESP_TOOL_CMD + + args)
+
+def esptool(args: list, check=True):
+    return run(esp_tool_cmd() + args, check=check)
+
+
+def reflash(esptool_args: list, address: str, firmware_path: str, flash_args: list = (), erase=False, force=False):
+    """Flash a firmware image, unless the device has it already.
+
+    First, the MD5 digest of the flash region is compared with the image (esptool verify_flash, the digest is
+    computed by the chip, so the flash is not read back). When they match, nothing is written. Otherwise the
+    image is written compressed. Only the sectors of the image are erased, so the file system partition is
+    kept, unless the whole chip is erased first with erase=True.
+
+    :param esptool_args: Global esptool options, e.g. ["--chip", "esp32", "--baud", "460800"]
+    :param address: Flash address of the image, e.g. "0x1000"
+    :param flash_args: Flash options, used for both the comparison and the write, e.g. ["--flash_size=detect"]
+    :param erase: Erase the whole chip, and then write the image.
+    :param force: Write the image, even if it is on the device already.
+    :return: True when the image was written.
+    """
+    flash_args = list(flash_args)
+    if not erase and not force:
+        if esptool(esptool_args + ["verify_flash"] + flash_args + [address, firmware_path], check=False):
+            print("SKIP: the device has %s already" % os.path.basename(firmware_path))
+            return False
+    if erase:
+        esptool(esptool_args + ["erase_flash"])
+    esptool(esptool_args + ["write_flash", "-z"] + flash_args + [address, firmware_path])
+    return True
 
 
 def minify(args: list):
     run(ESP_MINIFY_CMD + args)
+
+
+def fsimage(args: list):
+    """Run esp_fsimage with the given arguments (probe, build or verify)."""
+    run(esp_fsimage_cmd() + args)
+
+
+def fingerprint(paths, key=()):
+    """Hash of the contents of files and directories (recursively), and of a key (e.g. the arguments of a command).
+
+    Missing paths are part of the hash too. Directories in FINGERPRINT_IGNORED_DIRS are left out."""
+    digest = hashlib.sha256(json.dumps(list(key)).encode("UTF-8"))
+    for path in paths:
+        digest.update(b"\0" + path.encode("UTF-8") + b"\0")
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d not in FINGERPRINT_IGNORED_DIRS)
+                for fname in sorted(files):
+                    fpath = os.path.join(root, fname)
+                    digest.update(os.path.relpath(fpath, path).replace(os.sep, "/").encode("UTF-8") + b"\0")
+                    with open(fpath, "rb") as fin:
+                        digest.update(hashlib.sha256(fin.read()).digest())
+        elif os.path.isfile(path):
+            with open(path, "rb") as fin:
+                digest.update(hashlib.sha256(fin.read()).digest())
+        else:
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+
+class Stage:
+    """A step of a Pipeline.
+
+    :param name: Name of the stage, other stages refer to it in their `after` list.
+    :param action: Called without arguments to run the stage, it raises an exception on failure.
+    :param inputs: Files and directories the stage reads. The stage is skipped when their contents (and the key)
+        are the same as at its last successful run.
+    :param outputs: Files and directories the stage creates. The stage is run when any of them is missing.
+    :param after: Names of the stages that must be finished before this one.
+    :param key: Anything else the result depends on, e.g. the arguments.
+    :param resource: Stages with the same resource (e.g. DEVICE) are not run at the same time.
+    :param always: Run the stage even when it is up to date. Stages that use the device should set it, because
+        the state file does not know what is on the device (a new or erased board can be on the same port).
+    """
+
+    def __init__(self, name, action, inputs=(), outputs=(), after=(), key=(), resource=None, always=False):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.key = list(key)
+        self.resource = resource
+        self.always = always
+
+
+class Pipeline:
+    """Stages with dependencies between them (a DAG), e.g. build, minify, package and deploy.
+
+    The fingerprint of the inputs of every successful stage is saved in a state file. A stage is skipped when its
+    fingerprint did not change since, so when a stage produces the same output as before (e.g. an unchanged
+    build), the stages after it are skipped too, unless they are marked with always. Stages that do not depend on
+    each other are run in parallel. The time spent in every stage is printed at the end.
+
+        pipeline = Pipeline("pipeline.json")
+        pipeline.stage("build", build, inputs=["src"], outputs=["build"])
+        pipeline.stage("deploy", deploy, inputs=["build"], after=["build"], resource=DEVICE, always=True)
+        ok = pipeline.run(["deploy"])
+    """
+
+    STATUS_RUN = "RUN"
+    STATUS_SKIP = "SKIP"
+    STATUS_FAIL = "FAIL"
+    STATUS_CANCEL = "CANCEL"
+
+    def __init__(self, state_path, jobs=None):
+        """
+        :param state_path: JSON file that stores the fingerprints of the stages.
+        :param jobs: Number of stages that can run at the same time, default is the number of stages.
+        """
+        self.state_path = state_path
+        self.jobs = jobs
+        self.stages = {}
+        self.state_lock = threading.Lock()
+        self.results = []
+
+    def stage(self, name, action, **kwargs) -> Stage:
+        """Add a stage, see Stage for the arguments."""
+        if name in self.stages:
+            raise ValueError("Duplicate stage: %s" % name)
+        stage = self.stages[name] = Stage(name, action, **kwargs)
+        return stage
+
+    def select(self, targets=None, deps=True):
+        """Names of the stages to run for the targets, in dependency order.
+
+        :param targets: Names of the target stages, default is all of them.
+        :param deps: Include the stages that the targets depend on (recursively).
+        """
+        order, visiting = [], set()
+
+        def visit(name, included):
+            if name not in self.stages:
+                raise ValueError("Unknown stage: %s" % name)
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError("Dependency cycle at stage %s" % name)
+            visiting.add(name)
+            for dep in self.stages[name].after:
+                visit(dep, deps)
+            visiting.remove(name)
+            if included:
+                order.append(name)
+
+        for name in (self.stages if targets is None else targets):
+            visit(name, True)
+        return order
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, name, value):
+        with self.state_lock:
+            state = self.load_state()
+            state[name] = value
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, "w") as fout:
+                json.dump(state, fout, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+
+    def run_stage(self, stage, force):
+        """Run a stage unless it is up to date. Returns (status, seconds, error)."""
+        started = time.time()
+        value = fingerprint(stage.inputs, [stage.name] + stage.key)
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if not force and not stage.always and not missing and self.load_state().get(stage.name) == value:
+            print("SKIP:", stage.name, "(up to date)")
+            return self.STATUS_SKIP, time.time() - started, None
+        print("STAGE:", stage.name)
+        try:
+            stage.action()
+        except BaseException as e:
+            return self.STATUS_FAIL, time.time() - started, e
+        self.save_state(stage.name, value)
+        return self.STATUS_RUN, time.time() - started, None
+
+    def run(self, targets=None, force=(), deps=True) -> bool:
+        """Run the stages of the targets, and print their timings.
+
+        :param targets: Names of the target stages, default is all of them.
+        :param force: Names of stages that are run even when they are up to date, or True for all of them.
+        :param deps: Run the stages that the targets depend on too.
+        :return: True when all stages were successful (or skipped). The results are in self.results, as
+            (name, status, seconds, error) tuples.
+        """
+        names = self.select(targets, deps)
+        pending = {name: set(dep for dep in self.stages[name].after if dep in names) for name in names}
+        self.results = []
+        running = {}
+        busy = set()
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.jobs or max(1, len(names))) as pool:
+            while pending or running:
+                for name in [name for name in names if name in pending and not pending[name]]:
+                    stage = self.stages[name]
+                    if stage.resource is not None:
+                        if stage.resource in busy:
+                            continue
+                        busy.add(stage.resource)
+                    del pending[name]
+                    running[pool.submit(self.run_stage, stage, force is True or name in force)] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    busy.discard(stage.resource)
+                    status, seconds, error = future.result()
+                    self.results.append((stage.name, status, seconds, error))
+                    if status == self.STATUS_FAIL:
+                        print("FAILED: %s: %s" % (stage.name, error))
+                        self.cancel(stage.name, pending)
+                    else:
+                        for deps_left in pending.values():
+                            deps_left.discard(stage.name)
+        self.print_results(time.time() - started)
+        return all(status in (self.STATUS_RUN, self.STATUS_SKIP) for name, status, seconds, error in self.results)
+
+    def cancel(self, name, pending):
+        """Remove the stages that depend on a failed stage (recursively) from pending."""
+        for other in [other for other, deps_left in pending.items() if name in deps_left]:
+            if other in pending:
+                del pending[other]
+                self.results.append((other, self.STATUS_CANCEL, 0.0, None))
+                self.cancel(other, pending)
+
+    def print_results(self, elapsed):
+        print("%-24s %-8s %10s" % ("Stage", "Status", "Time"))
+        for name, status, seconds, error in self.results:
+            print("%-24s %-8s %9.2fs" % (name, status, seconds))
+        print("%-24s %-8s %9.2fs" % ("Total", "", elapsed))
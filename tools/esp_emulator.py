@@ -0,0 +1,777 @@
+#!/usr/bin/env python3
+"""Pty-backed MicroPython REPL emulator.
+
+It exposes a pseudo terminal that speaks the MicroPython REPL protocol: the friendly prompt, paste mode,
+raw mode and raw-paste mode. Code is executed by the host python interpreter, with a small set of
+MicroPython modules (os, sys, gc, micropython, machine, ubinascii, uhashlib, zlib, select ...). The
+file system of the device is a local directory, other modules are imported from there (along sys.path). The line speed can be throttled to a given baud rate,
+and a latency can be added to every turnaround, so espsyncer.py can be tested and benchmarked without
+a physical board.
+
+It can be used from python (see EspEmulator), or started from the command line, and then the printed
+port can be passed to espsyncer.py:
+
+    esp_emulator.py /tmp/device_fs
+    espsyncer.py --reset soft --port /dev/pts/5 ls /
+"""
+import argparse
+import binascii
+import builtins
+import errno
+import hashlib
+import io
+import json
+import os
+import posixpath
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+import termios
+import tty
+import types
+import zlib
+
+BANNER = b'MicroPython v1.19.1 on 2022-06-18; ESP module with ESP8266\r\nType "help()" for more information.\r\n'
+PROMPT = b'>>> '
+RAW_PROMPT = b'raw REPL; CTRL-B to exit\r\n>'
+PASTE_PROMPT = b'paste mode; Ctrl-C to cancel, Ctrl-D to finish\r\n=== '
+DEFAULT_WINDOW_SIZE = 128
+DEFAULT_MEM_FREE = 28 * 1024
+# Baud rate of the REPL UART after boot
+BOOT_BAUDRATE = 115200
+# termios speed constants -> baud rates
+TERMIOS_SPEEDS = {getattr(termios, name): int(name[1:]) for name in dir(termios)
+                  if name.startswith('B') and name[1:].isdigit()}
+
+ST_TYPE_FILE = 32768
+ST_TYPE_DIRECTORY = 16384
+
+CTRL_A = 1
+CTRL_B = 2
+CTRL_C = 3
+CTRL_D = 4
+CTRL_E = 5
+# Ends a hang of a program (see stall_after)
+STALL_RESET = bytes([CTRL_C, CTRL_C, CTRL_B])
+
+
+class HardReset(BaseException):
+    """Raised by machine.reset() inside the emulated device."""
+
+
+class DeviceIO:
+    """sys.stdin / sys.stdout of the emulated device."""
+
+    def __init__(self, emulator, is_output):
+        self.emulator = emulator
+        self.is_output = is_output
+        self.buffer = self
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.replace("\n", "\r\n").encode("utf-8")
+        self.emulator.write(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        return bytes(self.emulator.read_input(size, program=True))
+
+    def readinto(self, buf):
+        size = len(buf)
+        buf[:size] = self.emulator.read_input(size, program=True)
+        return size
+
+    def readline(self):
+        result = bytearray()
+        while not result.endswith(b'\n'):
+            result += self.emulator.read_input(1, program=True)
+        return bytes(result)
+
+    def flush(self):
+        pass
+
+
+class DecompIO:
+    """zlib.DecompIO of MicroPython: a stream that decompresses another stream."""
+
+    def __init__(self, stream, wbits=0):
+        self.stream = stream
+        if wbits == 0:
+            wbits = 15
+        self.decomp = zlib.decompressobj(wbits)
+        self.pending = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            if self.decomp.eof:
+                break
+            # The C implementation reads user defined streams (io.IOBase subclasses) with readinto()
+            buf = bytearray(256)
+            data = buf[:self.stream.readinto(buf)]
+            if not data:
+                self.pending += self.decomp.flush()
+                break
+            self.pending += self.decomp.decompress(data)
+        if size < 0:
+            size = len(self.pending)
+        result, self.pending = self.pending[:size], self.pending[size:]
+        return result
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+class EspEmulator:
+    def __init__(self, root, baudrate=None, latency=0.0, mem_free=DEFAULT_MEM_FREE,
+                 window_size=DEFAULT_WINDOW_SIZE, error_rate=0.0, max_baudrate=None, stall_after=None):
+        """Create a new emulated device.
+
+        :param root: Local directory that is the root of the device file system.
+        :param baudrate: Throttle the line to the baud rate of the REPL UART, which is initially this one.
+            None means no throttling (and BOOT_BAUDRATE).
+            When the baud rate of the host side (the pseudo terminal) differs from the one of the UART, then
+            all data is garbled.
+        :param latency: Seconds added to every turnaround (when the device starts waiting for input).
+        :param mem_free: Value returned by gc.mem_free() on the device.
+        :param window_size: Flow control window of the raw-paste mode.
+        :param error_rate: Probability of corrupting or dropping a byte in each block of data that is read by
+            a program from stdin. Used for testing error recovery of file transfers.
+        :param max_baudrate: The line does not work above this baud rate (e.g. a cheap USB-UART adapter).
+        :param stall_after: The program on the device hangs after it has read this many bytes from stdin: input
+            is ignored until the device is reset. It happens only once. Used for testing resumable uploads. The
+            pseudo terminal has no reset line, so the soft reset sequence of espsyncer (Ctrl-C, Ctrl-C, Ctrl-B)
+            also ends the hang, even when kbd_intr is disabled.
+        """
+        self.root = os.path.abspath(root)
+        self.throttle = baudrate is not None
+        self.boot_baudrate = baudrate or BOOT_BAUDRATE
+        self.baudrate = self.boot_baudrate
+        self.max_baudrate = max_baudrate
+        self.garbled = 0
+        self.latency = latency
+        self.mem_free = mem_free
+        self.window_size = window_size
+        self.error_rate = error_rate
+        self.errors_injected = 0
+        self.stall_after = stall_after
+        self.program_bytes = 0
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.input = bytearray()
+        self.kbd_intr = CTRL_C
+        self.closed = False
+        self.reset_requested = False
+        self.thread = None
+        self.globals = None
+        self.boots = 0
+        self.round_trips = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # Line emulation
+
+    def _throttle(self, size):
+        if self.throttle:
+            time.sleep(size * 10.0 / self.baudrate)
+
+    def host_baudrate(self):
+        """Baud rate that was set on the host side of the pseudo terminal."""
+        try:
+            return TERMIOS_SPEEDS.get(termios.tcgetattr(self.slave)[4])
+        except termios.error:
+            return None
+
+    def line_ok(self):
+        if self.max_baudrate and self.baudrate > self.max_baudrate:
+            return False
+        return self.host_baudrate() == self.baudrate
+
+    def _garble(self, data):
+        if self.line_ok():
+            return data
+        self.garbled += len(data)
+        return bytes(random.randrange(256) for _ in range(len(data)))
+
+    def write(self, data):
+        if not data or self.closed:
+            return
+        self._throttle(len(data))
+        self.bytes_out += len(data)
+        view = memoryview(self._garble(bytes(data)))
+        while view:
+            try:
+                sent = os.write(self.master, view)
+            except OSError:
+                return
+            view = view[sent:]
+
+    def _inject_error(self, data):
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors_injected += 1
+            idx = random.randrange(len(data))
+            if random.random() < 0.5:
+                return data[:idx] + data[idx + 1:]
+            return data[:idx] + bytes((data[idx] ^ 0x55,)) + data[idx + 1:]
+        return data
+
+    def _fill(self, timeout=None, program=False):
+        """Wait for input from the host. Returns False on timeout."""
+        rlist, _, _ = select.select([self.master], [], [], timeout)
+        if self.closed:
+            raise EOFError
+        if self.reset_requested:
+            self.reset_requested = False
+            raise HardReset()
+        if not rlist:
+            return False
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            raise EOFError
+        if not data:
+            raise EOFError
+        self._throttle(len(data))
+        self.bytes_in += len(data)
+        data = self._garble(data)
+        if program:
+            data = self._inject_error(data)
+        self.input += data
+        return True
+
+    def _interrupted(self):
+        """Check for the kbd_intr character in the input, and consume the input up to it."""
+        if self.kbd_intr >= 0 and self.kbd_intr in self.input:
+            del self.input[:self.input.index(self.kbd_intr) + 1]
+            return True
+        return False
+
+    def _stall(self):
+        """The program hangs: input is dropped until the device is reset (see stall_after)."""
+        self.stall_after = None
+        while True:
+            self._fill(0.1)
+            if STALL_RESET in self.input:
+                # Ctrl-B is left in the input, for the REPL
+                del self.input[:self.input.index(STALL_RESET) + 2]
+                raise KeyboardInterrupt()
+            self.input.clear()
+
+    def read_input(self, size, program=False):
+        """Read exactly size bytes of input. Programs can be interrupted with the kbd_intr character."""
+        if program and self.stall_after is not None and self.program_bytes >= self.stall_after:
+            self._stall()
+        waited = False
+        while len(self.input) < size:
+            if not waited:
+                self.round_trips += 1
+                waited = True
+            while not self._fill(0.1, program):
+                pass
+            if waited and self.latency:
+                time.sleep(self.latency)
+            if program and self._interrupted():
+                raise KeyboardInterrupt()
+        result = self.input[:size]
+        del self.input[:size]
+        if program:
+            self.program_bytes += size
+        return result
+
+    def input_ready(self, timeout):
+        if self.input:
+            return True
+        return self._fill(timeout)
+
+    # File system
+
+    def local_path(self, path):
+        path = posixpath.normpath(posixpath.join("/", path))
+        return os.path.join(self.root, path.lstrip("/"))
+
+    @staticmethod
+    def _oserror(e):
+        return OSError(e.errno or errno.EIO)
+
+    def make_os(self):
+        emu = self
+
+        def wrap(func):
+            def wrapped(*args):
+                try:
+                    return func(*args)
+                except OSError as e:
+                    raise emu._oserror(e)
+            return wrapped
+
+        def stat(path):
+            st = os.stat(emu.local_path(path))
+            mode = ST_TYPE_DIRECTORY if os.path.isdir(emu.local_path(path)) else ST_TYPE_FILE
+            mtime = int(st.st_mtime)
+            return (mode, 0, 0, 0, 0, 0, st.st_size, mtime, mtime, mtime)
+
+        def ilistdir(path="/"):
+            local = emu.local_path(path)
+            for fname in sorted(os.listdir(local)):
+                fpath = os.path.join(local, fname)
+                if os.path.isdir(fpath):
+                    yield (fname, ST_TYPE_DIRECTORY, 0, 0)
+                else:
+                    yield (fname, ST_TYPE_FILE, 0, os.stat(fpath).st_size)
+
+        def statvfs(path="/"):
+            st = os.statvfs(emu.local_path(path))
+            return (st.f_bsize, st.f_frsize, st.f_blocks, st.f_bfree, st.f_bavail, 0, 0, 0, 0, 255)
+
+        result = types.ModuleType("os")
+        result.stat = wrap(stat)
+        result.listdir = wrap(lambda path="/": sorted(os.listdir(emu.local_path(path))))
+        result.ilistdir = wrap(lambda path="/": list(ilistdir(path)))
+        result.remove = wrap(lambda path: os.remove(emu.local_path(path)))
+        result.rmdir = wrap(lambda path: os.rmdir(emu.local_path(path)))
+        result.mkdir = wrap(lambda path: os.mkdir(emu.local_path(path)))
+        result.rename = wrap(lambda src, dst: os.rename(emu.local_path(src), emu.local_path(dst)))
+        result.statvfs = wrap(statvfs)
+        result.getcwd = lambda: "/"
+        result.sep = "/"
+        return result
+
+    def open(self, path, mode="r", *args, **kwargs):
+        try:
+            return builtins.open(self.local_path(path), mode, *args, **kwargs)
+        except OSError as e:
+            raise self._oserror(e)
+
+    # Modules of the emulated device
+
+    def make_modules(self):
+        emu = self
+        modules = {}
+        modules["os"] = modules["uos"] = self.make_os()
+
+        sys_module = types.ModuleType("sys")
+        sys_module.stdin = DeviceIO(self, False)
+        sys_module.stdout = DeviceIO(self, True)
+        sys_module.stderr = sys_module.stdout
+        sys_module.platform = "esp8266"
+        sys_module.implementation = types.SimpleNamespace(name="micropython", version=(1, 19, 1))
+        sys_module.path = ["", "/lib"]
+        sys_module.modules = {}
+        modules["sys"] = modules["usys"] = sys_module
+
+        gc = types.ModuleType("gc")
+        gc.collect = lambda: None
+        gc.mem_free = lambda: emu.mem_free
+        gc.mem_alloc = lambda: 0
+        modules["gc"] = gc
+
+        micropython = types.ModuleType("micropython")
+
+        def kbd_intr(char):
+            emu.kbd_intr = char
+
+        micropython.kbd_intr = kbd_intr
+        micropython.const = lambda value: value
+        modules["micropython"] = micropython
+
+        machine = types.ModuleType("machine")
+
+        def reset():
+            raise HardReset()
+
+        class UART:
+            def __init__(self, uart_id, baudrate=None, **kwargs):
+                self.uart_id = uart_id
+                self.init(baudrate)
+
+            def init(self, baudrate=None, **kwargs):
+                if self.uart_id == 0 and baudrate:
+                    # Wait until the output buffer is empty
+                    time.sleep(0.01)
+                    emu.baudrate = baudrate
+
+        machine.reset = reset
+        machine.soft_reset = reset
+        machine.UART = UART
+        machine.freq = lambda *args: 80000000
+        modules["machine"] = machine
+
+        binascii_module = types.ModuleType("binascii")
+        for name in ["hexlify", "unhexlify", "a2b_base64", "b2a_base64", "crc32"]:
+            setattr(binascii_module, name, getattr(binascii, name))
+        modules["binascii"] = modules["ubinascii"] = binascii_module
+
+        hashlib_module = types.ModuleType("hashlib")
+        hashlib_module.sha256 = hashlib.sha256
+        hashlib_module.sha1 = hashlib.sha1
+        hashlib_module.md5 = hashlib.md5
+        modules["hashlib"] = modules["uhashlib"] = hashlib_module
+
+        zlib_module = types.ModuleType("zlib")
+        zlib_module.DecompIO = DecompIO
+        zlib_module.decompress = zlib.decompress
+        modules["zlib"] = modules["uzlib"] = zlib_module
+
+        select_module = types.ModuleType("select")
+
+        class Poll:
+            def __init__(self):
+                self.objects = []
+
+            def register(self, obj, eventmask=1):
+                self.objects.append(obj)
+
+            def poll(self, timeout=-1):
+                timeout = None if timeout < 0 else timeout / 1000.0
+                if emu.input_ready(timeout):
+                    return [(obj, 1) for obj in self.objects]
+                return []
+
+        select_module.poll = Poll
+        select_module.POLLIN = 1
+        modules["select"] = modules["uselect"] = select_module
+
+        modules["json"] = modules["ujson"] = json
+        modules["struct"] = modules["ustruct"] = struct
+        time_module = types.ModuleType("time")
+        time_module.time = time.time
+        time_module.gmtime = time.gmtime
+        time_module.sleep = time.sleep
+        time_module.sleep_ms = lambda ms: time.sleep(ms / 1000.0)
+        time_module.sleep_us = lambda us: time.sleep(us / 1000000.0)
+        time_module.ticks_ms = lambda: int(time.monotonic() * 1000) & 0x3fffffff
+        time_module.ticks_us = lambda: int(time.monotonic() * 1000000) & 0x3fffffff
+        time_module.ticks_diff = lambda end, start: ((end - start + 0x20000000) & 0x3fffffff) - 0x20000000
+        time_module.ticks_add = lambda ticks, delta: (ticks + delta) & 0x3fffffff
+        modules["time"] = modules["utime"] = time_module
+        modules["errno"] = modules["uerrno"] = errno
+        io_module = types.ModuleType("io")
+        io_module.IOBase = io.RawIOBase
+        io_module.BytesIO = io.BytesIO
+        modules["io"] = modules["uio"] = io_module
+        return modules
+
+    def make_globals(self):
+        modules = self.make_modules()
+        device_builtins = dict(builtins.__dict__)
+
+        sys_modules = modules["sys"].modules
+
+        def load_module(name):
+            """Load a module from the file system of the device, along sys.path."""
+            relpath = name.replace(".", "/")
+            for dpath in modules["sys"].path:
+                for fpath, is_package in [(posixpath.join("/", dpath, relpath, "__init__.py"), True),
+                                          (posixpath.join("/", dpath, relpath + ".py"), False)]:
+                    if not os.path.isfile(self.local_path(fpath)):
+                        continue
+                    with self.open(fpath, "r") as fin:
+                        source = fin.read()
+                    module = types.ModuleType(name)
+                    module.__file__ = fpath
+                    if is_package:
+                        module.__path__ = [posixpath.dirname(fpath)]
+                    module.__dict__["__builtins__"] = device_builtins
+                    sys_modules[name] = module
+                    try:
+                        exec(compile(source, fpath, "exec"), module.__dict__)
+                    except BaseException:
+                        sys_modules.pop(name, None)
+                        raise
+                    return module
+            raise ImportError("no module named '%s'" % name)
+
+        def device_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name in modules:
+                return modules[name]
+            parts = name.split(".")
+            for idx in range(len(parts)):
+                qualname = ".".join(parts[:idx + 1])
+                if qualname not in sys_modules:
+                    module = load_module(qualname)
+                    if idx:
+                        setattr(sys_modules[".".join(parts[:idx])], parts[idx], module)
+            if not fromlist:
+                return sys_modules[parts[0]]
+            module = sys_modules[name]
+            if hasattr(module, "__path__"):
+                # from package import submodule
+                for item in fromlist:
+                    if item != "*" and not hasattr(module, item):
+                        try:
+                            device_import(name + "." + item)
+                        except ImportError:
+                            pass
+            return module
+
+        def device_print(*args, sep=" ", end="\n", file=None):
+            (file or modules["sys"].stdout).write(sep.join(str(arg) for arg in args) + end)
+
+        device_builtins["__import__"] = device_import
+        device_builtins["open"] = self.open
+        device_builtins["print"] = device_print
+        return {"__name__": "__main__", "__builtins__": device_builtins}
+
+    # Execution
+
+    @staticmethod
+    def format_exception(e):
+        if isinstance(e, OSError) and e.args and isinstance(e.args[0], int):
+            msg = "OSError: [Errno %d] %s" % (e.args[0], errno.errorcode.get(e.args[0], ""))
+        elif e.args:
+            msg = "%s: %s" % (e.__class__.__name__, e.args[0])
+        else:
+            msg = e.__class__.__name__
+        return 'Traceback (most recent call last):\n  File "<stdin>", line 1, in <module>\n%s\n' % msg
+
+    def execute(self, source, mode="exec"):
+        """Execute source code. Returns the error message (or None)."""
+        stdout = self.globals["__builtins__"]["__import__"]("sys").stdout
+        try:
+            if mode == "single":
+                try:
+                    code = compile(source, "<stdin>", "eval")
+                except SyntaxError:
+                    code = compile(source, "<stdin>", "exec")
+                    mode = "exec"
+            else:
+                code = compile(source, "<stdin>", "exec")
+            result = eval(code, self.globals)
+            if mode == "single" and result is not None:
+                stdout.write(repr(result) + "\n")
+        except (HardReset, EOFError):
+            raise
+        except SyntaxError as e:
+            return self.format_exception(SyntaxError(e.msg))
+        except BaseException as e:
+            if not isinstance(e, (Exception, KeyboardInterrupt)):
+                traceback.print_exc()
+            return self.format_exception(e)
+        finally:
+            self.kbd_intr = CTRL_C
+        return None
+
+    def boot(self, soft=False):
+        self.globals = self.make_globals()
+        self.input.clear()
+        self.kbd_intr = CTRL_C
+        self.boots += 1
+        if not soft:
+            self.baudrate = self.boot_baudrate
+            # Whatever was sent while the chip was in reset is lost.
+            while select.select([self.master], [], [], 0)[0] and os.read(self.master, 4096):
+                pass
+        if soft:
+            self.write(b'MPY: soft reboot\r\n')
+        else:
+            self.write(b'\r\n ets Jan  8 2013,rst cause:2, boot mode:(3,6)\r\n\r\n')
+        self.write(BANNER)
+
+    def friendly_repl(self):
+        """Run the friendly REPL. Returns the next mode: "raw" or "soft_reset"."""
+        self.write(PROMPT)
+        line = bytearray()
+        continuation = []
+        while True:
+            c = self.read_input(1)[0]
+            if c == CTRL_A:
+                self.write(b'\r\n' + RAW_PROMPT)
+                return "raw"
+            elif c == CTRL_B:
+                self.write(b'\r\n' + BANNER + PROMPT)
+                line.clear()
+            elif c == CTRL_C:
+                self.write(b'\r\nKeyboardInterrupt!\r\n' + PROMPT)
+                line.clear()
+                continuation = []
+            elif c == CTRL_D:
+                if not line and not continuation:
+                    return "soft_reset"
+            elif c == CTRL_E:
+                self.paste_mode()
+                self.write(PROMPT)
+            elif c == 8 or c == 127:
+                if line:
+                    del line[-1]
+                    self.write(b'\x08 \x08')
+            elif c == 13:
+                self.write(b'\r\n')
+                source = line.decode("utf-8")
+                line.clear()
+                if continuation or source.rstrip().endswith(":"):
+                    if source.strip():
+                        continuation.append(source)
+                        self.write(b'... ')
+                        continue
+                    source = "\n".join(continuation) + "\n"
+                    continuation = []
+                if source.strip():
+                    error = self.execute(source, "single")
+                    if error:
+                        self.write(error.replace("\n", "\r\n").encode("utf-8"))
+                self.write(PROMPT)
+            elif c == 10:
+                pass
+            else:
+                line.append(c)
+                self.write(bytes([c]))
+
+    def paste_mode(self):
+        self.write(b'\r\n' + PASTE_PROMPT)
+        source = bytearray()
+        last = None
+        while True:
+            c = self.read_input(1)[0]
+            if c == CTRL_C:
+                self.write(b'\r\n')
+                return
+            elif c == CTRL_D:
+                self.write(b'\r\n')
+                error = self.execute(source.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n"))
+                if error:
+                    self.write(error.replace("\n", "\r\n").encode("utf-8"))
+                return
+            elif c == 13 or (c == 10 and last != 13):
+                # Both CR LF and LF end a line.
+                source.append(10)
+                self.write(b'\r\n=== ')
+            elif c == 10:
+                pass
+            else:
+                source.append(c)
+                self.write(bytes([c]))
+            last = c
+
+    def raw_paste(self):
+        """Receive code in raw-paste mode, with flow control."""
+        self.write(b'R\x01' + struct.pack('<H', self.window_size))
+        source = bytearray()
+        remaining = self.window_size
+        while True:
+            c = self.read_input(1)[0]
+            if c == CTRL_D:
+                self.write(b'\x04')
+                return source
+            source.append(c)
+            remaining -= 1
+            if remaining == 0:
+                self.write(b'\x01')
+                remaining = self.window_size
+
+    def raw_repl(self):
+        """Run the raw REPL. Returns the next mode: "friendly" or "soft_reset"."""
+        source = bytearray()
+        while True:
+            c = self.read_input(1)[0]
+            if c == CTRL_A:
+                self.write(b'\r\n' + RAW_PROMPT)
+                source.clear()
+                continue
+            elif c == CTRL_B:
+                self.write(b'\r\n' + BANNER)
+                return "friendly"
+            elif c == CTRL_C:
+                source.clear()
+                continue
+            elif c == CTRL_E and not source:
+                if self.read_input(2) == b'A\x01':
+                    code = self.raw_paste()
+                else:
+                    self.write(b'R\x00')
+                    continue
+            elif c == CTRL_D:
+                if not source:
+                    self.write(b'OK\r\nMPY: soft reboot\r\n')
+                    self.globals = self.make_globals()
+                    self.write(RAW_PROMPT)
+                    continue
+                self.write(b'OK')
+                code = source
+            else:
+                source.append(c)
+                continue
+            source = bytearray()
+            error = self.execute(code.decode("utf-8"))
+            self.write(b'\x04')
+            if error:
+                self.write(error.replace("\n", "\r\n").encode("utf-8"))
+            self.write(b'\x04>')
+
+    def serve(self):
+        mode = "friendly"
+        self.boot()
+        while not self.closed:
+            try:
+                if mode == "friendly":
+                    mode = self.friendly_repl()
+                elif mode == "raw":
+                    mode = self.raw_repl()
+                elif mode == "soft_reset":
+                    self.boot(soft=True)
+                    mode = "friendly"
+            except HardReset:
+                self.boot()
+                mode = "friendly"
+            except EOFError:
+                break
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def hard_reset(self):
+        """Reset the device, like the EN pin does. The program that is waiting for input is stopped."""
+        self.reset_requested = True
+
+    def close(self):
+        self.closed = True
+        if self.thread:
+            self.thread.join(1)
+        for fd in [self.master, self.slave]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Emulate a MicroPython device on a pseudo terminal')
+    parser.add_argument("-b", "--baudrate", dest='baudrate', type=int, default=None,
+                        help="Throttle the line to this baud rate. Default is no throttling.")
+    parser.add_argument("--max-baudrate", dest='max_baudrate', type=int, default=None,
+                        help="The line does not work above this baud rate. Default is no limit.")
+    parser.add_argument("-l", "--latency", dest='latency', type=float, default=0.0,
+                        help="Latency of turnarounds in seconds, default is 0.")
+    parser.add_argument("-m", "--mem-free", dest='mem_free', type=int, default=DEFAULT_MEM_FREE,
+                        help="Free heap reported by the device, default is %s" % DEFAULT_MEM_FREE)
+    parser.add_argument("-e", "--error-rate", dest='error_rate', type=float, default=0.0,
+                        help="Probability of corrupting the data read by programs from stdin, default is 0.")
+    parser.add_argument("--stall-after", dest='stall_after', type=int, default=None,
+                        help="The program on the device hangs once, after reading this many bytes from stdin."
+                             " Default is never.")
+    parser.add_argument(dest='root', help="Local directory for the file system of the device")
+    args = parser.parse_args()
+    if not os.path.isdir(args.root):
+        parser.error("Not a directory: %s" % args.root)
+    emulator = EspEmulator(args.root, args.baudrate, args.latency, args.mem_free, error_rate=args.error_rate,
+                           max_baudrate=args.max_baudrate, stall_after=args.stall_after)
+    print(emulator.port)
+    sys.stdout.flush()
+    try:
+        emulator.serve()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+"""Build the file system of a MicroPython device on the host, as a partition image.
+
+Uploading many files through the REPL is slow. Instead, the whole file system can be built on the host, and
+written to the file system partition of the flash with esptool, in a single compressed transfer:
+
+    esp_fsimage.py -p /dev/ttyUSB0 probe --output layout.json --keep /wifi.json --keep-dir kept
+    esp_fsimage.py build --layout layout.json --add libs / --add kept / fs.img
+    esptool.py --baud 921600 write_flash -z 0x200000 fs.img
+    esp_fsimage.py -p /dev/ttyUSB0 verify --layout layout.json fs.img
+
+probe reads the layout of the file system from the device: its type, offset and size. It can also save
+files that should survive the deploy (e.g. the wifi settings), because the image replaces all files.
+build makes the image, and checks that it can be mounted and that it contains the expected tree. FAT images
+are read by this tool, and also by pyfatfs and fsck.fat (dosfstools) when they are installed. Without them,
+the FAT check is only a self-consistency check of this tool.
+verify checks the files on the device after it was flashed and restarted.
+
+The file system type must match the firmware: MicroPython formats the flash of ESP8266 with FAT, and the
+flash of ESP32 with LittleFS. FAT images are made by this tool, LittleFS images need the littlefs-python
+package (pip install littlefs-python).
+"""
+import argparse
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import serial
+
+import espsyncer
+
+FS_FAT = "fat"
+FS_LITTLEFS = "littlefs"
+FS_TYPES = [FS_FAT, FS_LITTLEFS]
+# The erase sector of the flash, the block size of both file systems on the device.
+DEFAULT_BLOCK_SIZE = 4096
+# Local directories that are never put into an image (e.g. the bytecode cache of the host python)
+IGNORED_DIRS = ["__pycache__"]
+
+# MicroPython formats LittleFS with these settings (VfsLfs2.mkfs defaults). Only the block size and the block
+# count are stored in the superblock, but the disk version must be one that the firmware can mount.
+LFS_READ_SIZE = 32
+LFS_PROG_SIZE = 32
+LFS_LOOKAHEAD_SIZE = 32
+LFS_DISK_VERSION = 0x00020000
+
+# FAT images are made like FatFs (the FAT driver of MicroPython) formats a partition: no partition table,
+# one FAT, a cluster per sector and a fixed root directory.
+FAT_ROOT_ENTRIES = 512
+# FatFs tells FAT12 and FAT16 apart by the number of clusters.
+FAT12_MAX_CLUSTERS = 4085
+FAT16_MAX_CLUSTERS = 65525
+FAT_ATTR_DIRECTORY = 0x10
+FAT_ATTR_ARCHIVE = 0x20
+FAT_ATTR_LFN = 0x0F
+# Lower case flags of short names (used instead of long names, when the name is lower case 8.3)
+FAT_LOWER_BASE = 0x08
+FAT_LOWER_EXT = 0x10
+FAT_SHORT_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+# All files get the same timestamp, so the same tree gives the same image.
+FAT_DATE = ((2022 - 1980) << 9) | (1 << 5) | 1
+FAT_TIME = 0
+FAT_DIR_ENTRY = struct.Struct("<11sBBBHHHHHHHI")
+
+# Prints the layout of the file system of the device: (platform, offset, size, block size, file system type).
+# ESP32 has a "vfs" data partition, ESP8266 uses the flash after the firmware (see flashbdev.py).
+PROBE = """
+def _fs_probe():
+    import sys
+    try:
+        import esp32
+        part = esp32.Partition.find(esp32.Partition.TYPE_DATA, label='vfs')[0]
+        offset, size = part.info()[2], part.info()[3]
+        read = part.readblocks
+    except ImportError:
+        import flashbdev
+        bdev = flashbdev.bdev
+        offset, size = bdev.START_SEC * bdev.SEC_SIZE, bdev.blocks * bdev.SEC_SIZE
+        read = bdev.readblocks
+    buf = bytearray(%(block_size)d)
+    kind = None
+    for block in (0, 1):
+        read(block, buf)
+        if buf[8:16] == b'littlefs':
+            kind = %(littlefs)r
+    if kind is None:
+        read(0, buf)
+        if buf[510:512] == b'\\x55\\xaa':
+            kind = %(fat)r
+    print(repr((sys.platform, offset, size, %(block_size)d, kind)))
+_fs_probe()
+""" % {"block_size": DEFAULT_BLOCK_SIZE, "littlefs": FS_LITTLEFS, "fat": FS_FAT}
+
+
+def collect_tree(adds):
+    """Collect the files to be put into the image.
+
+    :param adds: A list of (local path, device directory). The contents of a local directory is copied into
+        the device directory, a local file is copied into the device directory with the same name.
+    :return: (set of device directories, dict of device file path -> local file path)
+    """
+    dirs, files = set(), {}
+    for local, dst in adds:
+        dst = posixpath.normpath("/" + dst.strip("/"))
+        if os.path.isdir(local):
+            for dpath, dnames, fnames in os.walk(local):
+                dnames[:] = sorted(dname for dname in dnames if dname not in IGNORED_DIRS)
+                relpath = os.path.relpath(dpath, local)
+                ddst = dst if relpath == os.curdir else posixpath.join(dst, relpath.replace(os.sep, "/"))
+                dirs.add(ddst)
+                for fname in fnames:
+                    files[posixpath.join(ddst, fname)] = os.path.join(dpath, fname)
+        elif os.path.isfile(local):
+            dirs.add(dst)
+            files[posixpath.join(dst, os.path.basename(local))] = local
+        else:
+            raise SystemExit("Not found: %s" % local)
+    # Parents of all directories
+    for path in list(dirs):
+        while path != "/":
+            path = posixpath.dirname(path)
+            dirs.add(path)
+    dirs.discard("/")
+    return dirs, files
+
+
+def tree_digests(dirs, contents):
+    """The expected tree, as a dict of path -> SHA-256 hex digest (espsyncer.DIR_HASH for directories)."""
+    result = {path: espsyncer.DIR_HASH for path in dirs}
+    for path, data in contents.items():
+        result[path] = hashlib.sha256(data).hexdigest()
+    return result
+
+
+def compare_trees(expected, actual):
+    """Return a list of differences between two trees (see tree_digests)."""
+    errors = []
+    for path in sorted(expected):
+        if path not in actual:
+            errors.append("missing: %s" % path)
+        elif actual[path] != expected[path]:
+            errors.append("different: %s" % path)
+    for path in sorted(set(actual) - set(expected)):
+        errors.append("unexpected: %s" % path)
+    return errors
+
+
+class FatBuilder:
+    """Makes a FAT12 or FAT16 image from a tree of files."""
+
+    def __init__(self, size, sector_size):
+        self.ss = sector_size
+        total = size // sector_size
+        root_sectors = (FAT_ROOT_ENTRIES * 32 + sector_size - 1) // sector_size
+        fat_sectors = 1
+        while True:
+            self.clusters = total - 1 - fat_sectors - root_sectors
+            self.fat12 = self.clusters <= FAT12_MAX_CLUSTERS
+            fat_bytes = (self.clusters + 2) * 3 // 2 + 1 if self.fat12 else (self.clusters + 2) * 2
+            needed = (fat_bytes + sector_size - 1) // sector_size
+            if needed <= fat_sectors:
+                break
+            fat_sectors = needed
+        if self.clusters > FAT16_MAX_CLUSTERS:
+            raise ValueError("The partition is too large for FAT16: %d bytes" % size)
+        self.fat_offset = sector_size
+        self.root_offset = (1 + fat_sectors) * sector_size
+        self.data_offset = (1 + fat_sectors + root_sectors) * sector_size
+        self.image = bytearray(total * sector_size)
+        self.next_cluster = 2
+
+        boot = self.image
+        boot[0:3] = b'\xeb\xfe\x90'
+        boot[3:11] = b'MSDOS5.0'
+        struct.pack_into("<HBHBHHBHHHII", boot, 11, sector_size, 1, 1, 1, FAT_ROOT_ENTRIES,
+                         total if total < 0x10000 else 0, 0xF8, fat_sectors, 63, 255, 0,
+                         total if total >= 0x10000 else 0)
+        struct.pack_into("<BBBI11s8s", boot, 36, 0x80, 0, 0x29, 0x12345678, b'NO NAME    ',
+                         b'FAT12   ' if self.fat12 else b'FAT16   ')
+        boot[510:512] = b'\x55\xaa'
+        self.set_fat(0, 0xFF8 if self.fat12 else 0xFFF8)
+        self.set_fat(1, self.eoc)
+
+    @property
+    def eoc(self):
+        return 0xFFF if self.fat12 else 0xFFFF
+
+    def set_fat(self, cluster, value):
+        if self.fat12:
+            idx = self.fat_offset + cluster * 3 // 2
+            word = struct.unpack_from("<H", self.image, idx)[0]
+            if cluster & 1:
+                word = (word & 0x000F) | (value << 4)
+            else:
+                word = (word & 0xF000) | value
+            struct.pack_into("<H", self.image, idx, word)
+        else:
+            struct.pack_into("<H", self.image, self.fat_offset + cluster * 2, value)
+
+    def allocate(self, data):
+        """Write data into a new cluster chain, and return its first cluster."""
+        count = max(1, (len(data) + self.ss - 1) // self.ss)
+        first = self.next_cluster
+        if first + count - 2 > self.clusters:
+            raise ValueError("The files do not fit into the partition")
+        for cluster in range(first, first + count):
+            self.set_fat(cluster, cluster + 1 if cluster < first + count - 1 else self.eoc)
+        offset = self.data_offset + (first - 2) * self.ss
+        self.image[offset:offset + len(data)] = data
+        self.next_cluster += count
+        return first
+
+    @staticmethod
+    def split_name(name):
+        if "." in name[1:]:
+            base, ext = name.rsplit(".", 1)
+        else:
+            base, ext = name, ""
+        return base, ext
+
+    @classmethod
+    def short_name(cls, name, used):
+        """Return (11 byte short name, case flags, needs a long name) for a file name."""
+        base, ext = cls.split_name(name)
+        if 1 <= len(base) <= 8 and len(ext) <= 3 and set(base.upper() + ext.upper()) <= FAT_SHORT_CHARS \
+                and base in (base.upper(), base.lower()) and ext in (ext.upper(), ext.lower()):
+            short = (base.upper().ljust(8) + ext.upper().ljust(3)).encode("ascii")
+            if short not in used:
+                flags = (FAT_LOWER_BASE if base != base.upper() else 0) | (FAT_LOWER_EXT if ext != ext.upper() else 0)
+                return short, flags, False
+
+        def clean(text):
+            return "".join(char if char in FAT_SHORT_CHARS else "_" for char in text.upper().replace(" ", ""))
+        base, ext = clean(base.replace(".", "")) or "_", clean(ext)[:3]
+        for idx in range(1, 1000000):
+            tail = "~%d" % idx
+            short = ((base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)).encode("ascii")
+            if short not in used:
+                return short, 0, True
+        raise ValueError("Too many similar names: %s" % name)
+
+    @staticmethod
+    def long_entries(name, short):
+        """Long name entries for a short name, in the order they are stored."""
+        checksum = 0
+        for char in short:
+            checksum = (((checksum & 1) << 7) + (checksum >> 1) + char) & 0xFF
+        chars = name.encode("utf-16-le")
+        chars += b'\x00\x00'
+        if len(chars) % 26:
+            chars += b'\xff' * (26 - len(chars) % 26)
+        if len(name.encode("utf-16-le")) % 26 == 0:
+            chars = chars[:-26]
+        count = len(chars) // 26
+        entries = []
+        for idx in range(count):
+            part = chars[idx * 26:(idx + 1) * 26]
+            order = idx + 1 if idx < count - 1 else (idx + 1) | 0x40
+            entries.append(struct.pack("<B10sBBB12sH4s", order, part[:10], FAT_ATTR_LFN, 0, checksum,
+                                       part[10:22], 0, part[22:26]))
+        return list(reversed(entries))
+
+    @staticmethod
+    def dir_entry(short, attr, flags, cluster, size):
+        return FAT_DIR_ENTRY.pack(short, attr, flags, 0, FAT_TIME, FAT_DATE, FAT_DATE, 0, FAT_TIME, FAT_DATE,
+                                  cluster, size)
+
+    def dir_entries(self, names):
+        """Return (short name, case flags, long entries) for the names of a directory."""
+        used, result = set(), []
+        for name in names:
+            short, flags, needs_long = self.short_name(name, used)
+            used.add(short)
+            result.append((short, flags, self.long_entries(name, short) if needs_long else []))
+        return result
+
+    def add_tree(self, dirs, contents):
+        """Write all directories and files.
+
+        :param dirs: Set of directory paths.
+        :param contents: Dict of file path -> data.
+        """
+        children = {}
+        for path in list(dirs) + list(contents):
+            children.setdefault(posixpath.dirname(path), []).append(posixpath.basename(path))
+        self._add_dir("/", None, 0, children, dirs, contents)
+
+    def _add_dir(self, path, cluster, parent_cluster, children, dirs, contents):
+        names = sorted(children.get(path, []))
+        entries = []
+        if cluster is not None:
+            entries.append(self.dir_entry(b'.'.ljust(11), FAT_ATTR_DIRECTORY, 0, cluster, 0))
+            entries.append(self.dir_entry(b'..'.ljust(11), FAT_ATTR_DIRECTORY, 0, parent_cluster, 0))
+        subdirs = []
+        for name, (short, flags, long_entries) in zip(names, self.dir_entries(names)):
+            child = posixpath.join(path, name)
+            if child in dirs:
+                grandchildren = sorted(children.get(child, []))
+                size = 32 * (2 + sum(1 + len(long) for _, _, long in self.dir_entries(grandchildren)))
+                child_cluster = self.allocate(bytes(size))
+                subdirs.append((child, child_cluster))
+                entries += long_entries + [self.dir_entry(short, FAT_ATTR_DIRECTORY, flags, child_cluster, 0)]
+            else:
+                data = contents[child]
+                child_cluster = self.allocate(data) if data else 0
+                entries += long_entries + [self.dir_entry(short, FAT_ATTR_ARCHIVE, flags, child_cluster,
+                                                          len(data))]
+        data = b''.join(entries)
+        if cluster is None:
+            if len(data) > FAT_ROOT_ENTRIES * 32:
+                raise ValueError("Too many files in the root directory")
+            self.image[self.root_offset:self.root_offset + len(data)] = data
+        else:
+            offset = self.data_offset + (cluster - 2) * self.ss
+            self.image[offset:offset + len(data)] = data
+        for child, child_cluster in subdirs:
+            self._add_dir(child, child_cluster, cluster or 0, children, dirs, contents)
+
+
+def read_fat_image(image):
+    """Read the tree of a FAT12/FAT16 image: a dict of path -> SHA-256 hex digest (see tree_digests)."""
+    ss, per_cluster, reserved, fats, root_entries, total16, _, fat_sectors = struct.unpack_from(
+        "<HBHBHHBH", image, 11)
+    if image[510:512] != b'\x55\xaa' or not ss:
+        raise ValueError("Not a FAT file system")
+    total = total16 or struct.unpack_from("<I", image, 32)[0]
+    root_offset = (reserved + fats * fat_sectors) * ss
+    data_offset = root_offset + (root_entries * 32 + ss - 1) // ss * ss
+    clusters = (total * ss - data_offset) // (per_cluster * ss)
+    fat12 = clusters <= FAT12_MAX_CLUSTERS
+    fat_offset = reserved * ss
+    cluster_size = per_cluster * ss
+
+    def next_cluster(cluster):
+        if fat12:
+            word = struct.unpack_from("<H", image, fat_offset + cluster * 3 // 2)[0]
+            value = word >> 4 if cluster & 1 else word & 0xFFF
+            return value if value < 0xFF8 else None
+        value = struct.unpack_from("<H", image, fat_offset + cluster * 2)[0]
+        return value if value < 0xFFF8 else None
+
+    def read_chain(cluster, size=None):
+        data = bytearray()
+        while cluster is not None and cluster >= 2 and (size is None or len(data) < size):
+            offset = data_offset + (cluster - 2) * cluster_size
+            data += image[offset:offset + cluster_size]
+            cluster = next_cluster(cluster)
+        return bytes(data if size is None else data[:size])
+
+    result = {}
+
+    def read_dir(path, data):
+        long_name = b''
+        for idx in range(0, len(data), 32):
+            entry = data[idx:idx + 32]
+            if entry[0] == 0:
+                break
+            if entry[0] == 0xE5:
+                long_name = b''
+                continue
+            if entry[11] == FAT_ATTR_LFN:
+                long_name = entry[1:11] + entry[14:26] + entry[28:32] + long_name
+                continue
+            short, attr, flags, _, _, _, _, _, _, _, cluster, size = FAT_DIR_ENTRY.unpack(entry)
+            if long_name:
+                name = long_name.decode("utf-16-le").split("\x00")[0]
+            else:
+                base, ext = short[:8].decode("ascii").rstrip(), short[8:].decode("ascii").rstrip()
+                base = base.lower() if flags & FAT_LOWER_BASE else base
+                ext = ext.lower() if flags & FAT_LOWER_EXT else ext
+                name = base + ("." + ext if ext else "")
+            long_name = b''
+            if name in (".", "..") or attr & 0x08:
+                continue
+            child = posixpath.join(path, name)
+            if attr & FAT_ATTR_DIRECTORY:
+                result[child] = espsyncer.DIR_HASH
+                read_dir(child, read_chain(cluster))
+            else:
+                result[child] = hashlib.sha256(read_chain(cluster, size) if size else b'').hexdigest()
+
+    read_dir("/", image[root_offset:root_offset + root_entries * 32])
+    return result
+
+
+def check_fat_image(image):
+    """Check a FAT image with implementations that do not share code with FatBuilder and read_fat_image, when
+    they are available: pyfatfs (pip install pyfatfs) reads the tree, and fsck.fat (dosfstools) checks the
+    structure.
+
+    :return: A tuple of (tree or None, list of errors, names of the checks that were made). The tree (see
+        tree_digests) is None when pyfatfs is not installed.
+    """
+    checks, errors, tree = [], [], None
+    with tempfile.TemporaryDirectory(prefix="esp_fsimage_") as tmpdir:
+        path = os.path.join(tmpdir, "fs.img")
+        with open(path, "wb") as fout:
+            fout.write(image)
+        try:
+            from pyfatfs.PyFatFS import PyFatFS
+        except ImportError:
+            pass
+        else:
+            checks.append("pyfatfs")
+            tree = {}
+            fs = PyFatFS(path, read_only=True)
+            try:
+                for dpath, dirs, files in fs.walk("/"):
+                    for info in dirs:
+                        tree[posixpath.join(dpath, info.name)] = espsyncer.DIR_HASH
+                    for info in files:
+                        with fs.openbin(posixpath.join(dpath, info.name)) as fin:
+                            tree[posixpath.join(dpath, info.name)] = hashlib.sha256(fin.read()).hexdigest()
+            finally:
+                fs.close()
+        fsck = shutil.which("fsck.fat") or shutil.which("fsck.vfat")
+        if fsck:
+            checks.append("fsck.fat")
+            result = subprocess.run([fsck, "-n", path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if result.returncode:
+                errors.append("fsck.fat: " + result.stdout.decode("utf-8", "replace").strip())
+    return tree, errors, checks
+
+
+def _littlefs(layout, image=None):
+    try:
+        import littlefs
+    except ImportError:
+        raise SystemExit("LittleFS images require the littlefs-python package: pip install littlefs-python")
+    context = littlefs.UserContext(layout["size"])
+    if image is not None:
+        context.buffer[:] = image
+    return littlefs.LittleFS(context=context, mount=image is not None, block_size=layout["block_size"],
+                             block_count=layout["size"] // layout["block_size"], read_size=LFS_READ_SIZE,
+                             prog_size=LFS_PROG_SIZE, lookahead_size=LFS_LOOKAHEAD_SIZE,
+                             disk_version=LFS_DISK_VERSION)
+
+
+def build_image(layout, dirs, contents):
+    """Make a file system image for the given layout (see Main.get_layout)."""
+    if layout["fs"] == FS_FAT:
+        builder = FatBuilder(layout["size"], layout["block_size"])
+        builder.add_tree(dirs, contents)
+        return bytes(builder.image)
+    fs = _littlefs(layout)
+    fs.format()
+    fs.mount()
+    for path in sorted(dirs):
+        fs.makedirs(path, exist_ok=True)
+    for path in sorted(contents):
+        with fs.open(path, "wb") as fout:
+            fout.write(contents[path])
+    fs.unmount()
+    return bytes(fs.context.buffer)
+
+
+def read_image(layout, image):
+    """Mount an image, and return its tree (see tree_digests)."""
+    if layout["fs"] == FS_FAT:
+        return read_fat_image(image)
+    fs = _littlefs(layout, image)
+    result = {}
+    for dpath, dnames, fnames in fs.walk("/"):
+        for dname in dnames:
+            result[posixpath.join(dpath, dname)] = espsyncer.DIR_HASH
+        for fname in fnames:
+            with fs.open(posixpath.join(dpath, fname), "rb") as fin:
+                result[posixpath.join(dpath, fname)] = hashlib.sha256(fin.read()).hexdigest()
+    return result
+
+
+class Main:
+    def __init__(self, args):
+        self.args = args
+
+    def log(self, s):
+        if self.args.verbose:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+    def session(self):
+        """Open a session with the device (raw protocol)."""
+        if not self.args.port:
+            raise SystemExit("Either --port must be given or ESP_PORT environment variable must be set.")
+        ser = serial.Serial(self.args.port, baudrate=self.args.baudrate, timeout=self.args.timeout)
+        syncer = espsyncer.EspSyncer(ser, self.args.timeout, self.log, reset_mode=self.args.reset)
+        syncer.reset()
+        return ser, syncer
+
+    def get_layout(self):
+        """The layout of the file system: from the --layout file, overridden by the other options."""
+        layout = {"fs": None, "offset": None, "size": None, "block_size": DEFAULT_BLOCK_SIZE}
+        if self.args.layout:
+            with open(self.args.layout) as fin:
+                layout.update(json.load(fin))
+        for name in ["fs", "offset", "size", "block_size"]:
+            if getattr(self.args, name) is not None:
+                layout[name] = getattr(self.args, name)
+        for name in ["fs", "size"]:
+            if layout[name] is None:
+                raise SystemExit("The %s of the file system is not known, use --layout or --%s" % (name, name))
+        if layout["size"] % layout["block_size"]:
+            raise SystemExit("The size of the file system must be a multiple of the block size")
+        return layout
+
+    def probe(self):
+        ser, syncer = self.session()
+        with ser:
+            platform, offset, size, block_size, fs = eval(syncer.exec_raw(PROBE))
+            layout = {"platform": platform, "fs": fs, "offset": offset, "size": size, "block_size": block_size}
+            print("%s: %s file system at 0x%x, %d KB" % (platform, fs or "unknown", offset, size // 1024))
+            if self.args.keep:
+                if not self.args.keep_dir:
+                    raise SystemExit("--keep requires --keep-dir")
+                hashes = syncer.remote_hashes_of(self.args.keep)
+                for path in self.args.keep:
+                    local = os.path.join(self.args.keep_dir, *path.strip("/").split("/"))
+                    if hashes[path] is None or hashes[path] == espsyncer.DIR_HASH:
+                        # A copy from an earlier probe (e.g. of another device) must not get into the image.
+                        if os.path.isfile(local):
+                            os.unlink(local)
+                        self.log("KEEP %s: not found\n" % path)
+                        continue
+                    os.makedirs(os.path.dirname(local), exist_ok=True)
+                    with open(local, "wb") as fout:
+                        syncer.get_raw(path, fout)
+                    self.log("KEEP %s -> %s\n" % (path, local))
+        if self.args.output:
+            with open(self.args.output, "w") as fout:
+                json.dump(layout, fout, indent=2)
+        return layout
+
+    def build(self):
+        layout = self.get_layout()
+        dirs, files = collect_tree(self.args.adds or [])
+        contents = {}
+        for path in sorted(files):
+            with open(files[path], "rb") as fin:
+                contents[path] = fin.read()
+        started = time.time()
+        total = sum(len(data) for data in contents.values())
+        try:
+            image = build_image(layout, dirs, contents)
+        except ValueError as e:
+            raise SystemExit("Cannot build the image: %s. The files are %d bytes (%.1f KB), the partition is %d"
+                             " bytes (%.1f KB)." % (e, total, total / 1024.0, layout["size"], layout["size"] / 1024.0))
+        expected = tree_digests(dirs, contents)
+        errors = compare_trees(expected, read_image(layout, image))
+        if layout["fs"] == FS_FAT:
+            tree, check_errors, checks = check_fat_image(image)
+            errors += check_errors
+            if tree is not None:
+                # pyfatfs ignores the lower case flags of short names (an NT extension, that FatFs supports), so
+                # the names are compared case-insensitively. The reader of this tool checks them.
+                errors += ["pyfatfs: " + error for error in compare_trees(
+                    {path.upper(): digest for path, digest in expected.items()},
+                    {path.upper(): digest for path, digest in tree.items()})]
+            if checks:
+                self.log("Checked with %s\n" % ", ".join(checks))
+            else:
+                print("Warning: the FAT image was only checked with the reader of esp_fsimage.py. Install pyfatfs"
+                      " (pip install pyfatfs) or dosfstools (fsck.fat) for an independent check.")
+        if errors:
+            raise SystemExit("The image is not correct:\n    " + "\n    ".join(errors))
+        with open(self.args.image, "wb") as fout:
+            fout.write(image)
+        print("%s: %s image, %d directories, %d files, %.1f KB of %.1f KB, %.2fs" % (
+            self.args.image, layout["fs"], len(dirs), len(contents), total / 1024.0, len(image) / 1024.0,
+            time.time() - started))
+        if layout.get("offset") is not None:
+            print("Flash it with: esptool.py write_flash -z 0x%x %s" % (layout["offset"], self.args.image))
+
+    def verify(self):
+        layout = self.get_layout()
+        with open(self.args.image, "rb") as fin:
+            expected = read_image(layout, fin.read())
+        ser, syncer = self.session()
+        with ser:
+            actual = {path: espsyncer.DIR_HASH for path, isdir, size in syncer.walk(["/"]) if isdir and path != "/"}
+            actual.update(syncer.remote_tree_hashes("/", rehash=True))
+        errors = compare_trees(expected, actual)
+        missing = [error for error in errors if not error.startswith("unexpected")]
+        for error in errors:
+            print(error)
+        if missing:
+            raise SystemExit("The file system of the device does not match the image")
+        print("The file system of the device matches the image: %d files and directories" % len(expected))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the file system of a MicroPython device as a partition image')
+    parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
+                        help="Be verbose")
+    parser.add_argument("-p", "--port", dest='port', default=os.environ.get("ESP_PORT"),
+                        help="Port of the device (for probe and verify), default is the ESP_PORT environment"
+                             " variable.")
+    parser.add_argument("-b", "--baudrate", dest='baudrate', type=int, default=espsyncer.DEFAULT_BAUD_RATE,
+                        help="Baud rate, default is %s" % espsyncer.DEFAULT_BAUD_RATE)
+    parser.add_argument("-t", "--timeout", dest='timeout', type=int, default=espsyncer.DEFAULT_TIMEOUT,
+                        help="Timeout, default is %s" % espsyncer.DEFAULT_TIMEOUT)
+    parser.add_argument("--reset", dest='reset', choices=espsyncer.RESET_MODES, default=espsyncer.RESET_HARD,
+                        help="How the device is reset, see espsyncer.py. Default is %s." % espsyncer.RESET_HARD)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    probe_parser = subparsers.add_parser("probe", help="Read the layout of the file system from the device")
+    probe_parser.add_argument("--output", dest='output', default=None,
+                              help="Write the layout into this file, as JSON")
+    probe_parser.add_argument("--keep", dest='keep', action="append", default=[],
+                              help="Download this file from the device (if it exists) into --keep-dir, so it can"
+                                   " be put into the image. When it does not exist, its copy in --keep-dir is"
+                                   " deleted. Can be given multiple times.")
+    probe_parser.add_argument("--keep-dir", dest='keep_dir', default=None,
+                              help="Local directory for the files of --keep")
+
+    for name, help in [("build", "Build an image, and check it. FAT images are also checked with pyfatfs and"
+                                 " fsck.fat when they are installed, otherwise the check is only a"
+                                 " self-consistency check of this tool."),
+                       ("verify", "Check the files on the device against an image")]:
+        sub = subparsers.add_parser(name, help=help)
+        sub.add_argument("--layout", dest='layout', default=None,
+                         help="Layout of the file system (JSON, see probe)")
+        sub.add_argument("--fs", dest='fs', choices=FS_TYPES, default=None,
+                         help="File system type, overrides the layout")
+        sub.add_argument("--offset", dest='offset', type=lambda value: int(value, 0), default=None,
+                         help="Flash offset of the file system, overrides the layout")
+        sub.add_argument("--size", dest='size', type=lambda value: int(value, 0), default=None,
+                         help="Size of the file system in bytes, overrides the layout")
+        sub.add_argument("--block-size", dest='block_size', type=int, default=None,
+                         help="Block size of the file system, default is %d" % DEFAULT_BLOCK_SIZE)
+        if name == "build":
+            sub.add_argument("--add", dest='adds', nargs=2, action="append", metavar=("LOCAL", "DEVICE_DIR"),
+                             help="Put a local file, or the contents of a local directory, into a directory of"
+                                  " the image. Can be given multiple times.")
+        sub.add_argument(dest='image', help="Image file")
+
+    args = parser.parse_args()
+    if args.timeout <= 0:
+        args.timeout = None
+    main = Main(args)
+    getattr(main, args.command)()
@@ -1,13 +1,442 @@
 import argparse
+import base64
+import hashlib
+import mimetypes
 import os
+import posixpath
 import stat
 import shutil
-import gzip
+import struct
 import json
 import re
 import io
+import sys
+import fnmatch
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
 DEFAULT_EXCLUDE_EXTENSIONS = [".map"]
+# Files referenced from CSS (icons, fonts) and stylesheets of index.html are inlined up to this size (bytes).
+DEFAULT_INLINE_LIMIT = 2048
+# The loader of index.html downloads this many files at the same time. ESP8266 can only handle a few connections.
+DEFAULT_PARALLEL = 2
+# Failed downloads are tried again this many times, the first retry is after DEFAULT_RETRY_DELAY seconds, and the
+# delay is doubled after every retry.
+DEFAULT_RETRIES = 4
+DEFAULT_RETRY_DELAY = 0.5
+# Deploy time estimate: baud rate of the serial line, and bits sent per byte (start, 8 data and stop bits)
+DEFAULT_SERIAL_BAUDRATE = 115200
+SERIAL_BITS_PER_BYTE = 10
+# Page load estimate: throughput of the soft-AP of the device (kbit/s), and the time it takes the device to
+# accept a connection and open a file, for every request (seconds). The loader requests --parallel files at a time.
+DEFAULT_LINK_RATE = 1000
+DEFAULT_REQUEST_LATENCY = 0.1
+# Budget names that are not file name patterns
+BUDGET_TOTAL = "total"  # Total size of the output
+BUDGET_PAGE = "page"  # Total size of index.html and the files it loads
+BUDGET_REQUESTS = "requests"  # Number of requests to load the page
+BUDGET_LOAD_TIME = "load_time"  # Estimated page load time (seconds)
+BUDGET_DEPLOY_TIME = "deploy_time"  # Estimated time to upload the output over the serial line (seconds)
+BUDGET_TIMES = [BUDGET_LOAD_TIME, BUDGET_DEPLOY_TIME]
+# Service worker that precaches the output, registered by frontend/src/serviceWorker.js. Its manifest has the
+# hash of every file, so changed files are downloaded again.
+SERVICE_WORKER_PATH = "service-worker.js"
+# Minified and compressed files are cached here, by the hash of their contents.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "esp_minify_www")
+DEFAULT_JOBS = os.cpu_count() or 1
+
+# gzip header without file name and modification time, with "unknown" OS, so the output only depends on the
+# contents. The extra flags (2) tell that the slowest compression was used.
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff"
+# (memory level, strategy) of the deflate trials with --max-compression, the smallest output is kept. The first
+# one is the default of gzip.
+GZIP_TRIALS = [
+    (8, zlib.Z_DEFAULT_STRATEGY),
+    (9, zlib.Z_DEFAULT_STRATEGY),
+    (9, zlib.Z_FILTERED),
+    (9, zlib.Z_RLE),
+    (9, zlib.Z_FIXED),
+]
+
+# Stages of the minification, the size of the output is measured after each of them.
+STAGE_SOURCE = "source"
+STAGE_MINIFY = "minify"
+STAGE_INLINE = "inline"
+STAGE_BUNDLE = "bundle"
+STAGE_GZIP = "gzip"
+STAGES = [STAGE_SOURCE, STAGE_MINIFY, STAGE_INLINE, STAGE_BUNDLE, STAGE_GZIP]
+
+# A slash after these starts a regular expression in javascript, not a division.
+JS_REGEX_AFTER_CHARS = "(,=:[!&|?{};+-*%<>~^"
+JS_REGEX_AFTER_WORDS = {"return", "typeof", "instanceof", "in", "of", "new", "delete", "void", "throw", "case",
+                        "do", "else", "yield", "await"}
+# A line break can be dropped after and before these, automatic semicolon insertion never happens there.
+JS_NO_ASI_AFTER = "{[(,;:=?&|!<>+-*/%^~"
+JS_NO_ASI_BEFORE = ")]},;:.?"
+# Whitespace can be dropped around these in CSS. It can't be dropped before a colon (a :hover is not a:hover).
+CSS_PUNCTUATION = "{};,>"
+# Scripts with other types (e.g. JSON data, templates) are not minified
+HTML_SCRIPT_TYPES = ["text/javascript", "application/javascript", "module"]
+RE_SOURCE_MAP = re.compile(r'^\s*//[#@] sourceMappingURL=.*$', re.M)
+RE_CSS_URL = re.compile(r'url\(\s*(["\']?)([^"\')]+)\1\s*\)')
+RE_HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+RE_HTML_SPECIAL = re.compile(r'<(script|style|pre|textarea)\b([^>]*)>(.*?)</\1\s*>', re.S | re.I)
+
+
+def is_js_ident_char(c):
+    return c.isalnum() or c in "_$\\" or ord(c) > 127
+
+
+def is_preserved_comment(comment):
+    """License comments are kept, like other minifiers do."""
+    return comment.startswith("/*!") or "@license" in comment or "@preserve" in comment
+
+
+class JsMinifier:
+    """Removes comments and whitespace from javascript.
+
+    This is not a parser. It only knows enough about the syntax to find strings, template literals, regular
+    expressions and comments, and it keeps line breaks where automatic semicolon insertion could depend on them.
+    The output is the same program, but it is not as small as the output of a real minifier (names are kept).
+    """
+
+    def __init__(self, src):
+        self.src = src
+        self.out = []
+        self.last = ""  # Last character of the output
+        self.word = ""  # Last word of the output, when it ends with an identifier
+        self.double = False  # The output ends with ++ or --
+        self.separated = False  # Whitespace was written after the last token
+
+    def emit(self, text, literal=False):
+        """Write a token (or a part of it)."""
+        joined = not self.separated
+        if is_js_ident_char(text[-1]) and not literal:
+            self.word = (self.word if joined and len(text) == 1 else "") + text
+        else:
+            self.word = ""
+        self.double = joined and text in "+-" and text == self.last
+        self.separated = False
+        self.out.append(text)
+        # A string, regex or template literal is a value, like a number: a slash after it is a division, and
+        # line breaks after it are kept.
+        self.last = "0" if literal else text[-1]
+
+    def separate(self, text):
+        """Write whitespace (or a comment) between tokens. It does not change the context."""
+        if text:
+            self.out.append(text)
+            self.separated = True
+
+    def separator(self, next_char, newline):
+        """What must be kept from the whitespace (or comments) between the output and next_char."""
+        if not self.last:
+            return ""
+        need_space = (is_js_ident_char(self.last) and is_js_ident_char(next_char)) or \
+                     (self.last in "+-" and next_char in "+-") or (self.last == "/" and next_char in "/*")
+        # a++ can end a statement
+        after_operator = self.last in JS_NO_ASI_AFTER and not self.double
+        if newline and (need_space or (not after_operator and next_char not in JS_NO_ASI_BEFORE)):
+            return "\n"
+        return " " if need_space else ""
+
+    def regex_allowed(self):
+        if not self.last:
+            return True
+        if self.word:
+            return self.word in JS_REGEX_AFTER_WORDS
+        if self.double:
+            # a++ / 2 is a division
+            return False
+        return self.last in JS_REGEX_AFTER_CHARS
+
+    def copy_quoted(self, i, quote):
+        """Copy a string literal starting at i, return the index after it."""
+        j = i + 1
+        while j < len(self.src) and self.src[j] != quote:
+            j += 2 if self.src[j] == "\\" else 1
+        self.emit(self.src[i:j + 1], literal=True)
+        return j + 1
+
+    def copy_regex(self, i):
+        j = i + 1
+        in_class = False
+        while j < len(self.src):
+            c = self.src[j]
+            if c == "\\":
+                j += 2
+                continue
+            if c == "[":
+                in_class = True
+            elif c == "]":
+                in_class = False
+            elif c == "/" and not in_class:
+                break
+            elif c == "\n":
+                break
+            j += 1
+        j += 1
+        while j < len(self.src) and is_js_ident_char(self.src[j]):
+            j += 1
+        self.emit(self.src[i:j], literal=True)
+        return j
+
+    def copy_template(self, i):
+        """Copy a template literal, and minify the code of its substitutions."""
+        j = i + 1
+        start = i
+        while j < len(self.src):
+            c = self.src[j]
+            if c == "\\":
+                j += 2
+            elif c == "`":
+                break
+            elif c == "$" and self.src[j + 1:j + 2] == "{":
+                self.emit(self.src[start:j + 2])
+                j = self.minify_code(j + 2, in_template=True)
+                start = j
+                # minify_code stops at the closing brace, it is copied with the rest of the literal.
+            else:
+                j += 1
+        self.emit(self.src[start:j + 1], literal=True)
+        return j + 1
+
+    def minify_code(self, i=0, in_template=False):
+        depth = 0
+        pending_ws = False
+        newline = False
+        src = self.src
+        while i < len(src):
+            c = src[i]
+            if c in " \t\r\n\f\v\u00a0\ufeff\u2028\u2029":
+                pending_ws = True
+                newline = newline or c in "\n\r\u2028\u2029"
+                i += 1
+                continue
+            if c == "/" and src[i + 1:i + 2] == "/":
+                end = src.find("\n", i)
+                i = len(src) if end < 0 else end
+                pending_ws = True
+                continue
+            if c == "/" and src[i + 1:i + 2] == "*":
+                end = src.find("*/", i + 2)
+                end = len(src) if end < 0 else end + 2
+                comment = src[i:end]
+                i = end
+                if not is_preserved_comment(comment):
+                    pending_ws = True
+                    newline = newline or "\n" in comment
+                    continue
+                # The comment does not change the context (e.g. whether a slash can start a regex)
+                self.separate(("\n" if self.last else "") + comment + "\n")
+                pending_ws = newline = False
+                continue
+            if in_template and c == "}" and depth == 0:
+                return i
+            if pending_ws:
+                self.separate(self.separator(c, newline))
+                pending_ws = newline = False
+            if c in "'\"":
+                i = self.copy_quoted(i, c)
+            elif c == "`":
+                i = self.copy_template(i)
+            elif c == "/" and self.regex_allowed():
+                i = self.copy_regex(i)
+            else:
+                if c == "{":
+                    depth += 1
+                elif c == "}":
+                    depth -= 1
+                self.emit(c)
+                i += 1
+        return i
+
+    def minify(self):
+        self.minify_code()
+        return "".join(self.out).strip()
+
+
+def minify_js(data):
+    return JsMinifier(data).minify()
+
+
+def minify_css(data):
+    out = []
+    i = 0
+    pending_ws = False
+    while i < len(data):
+        c = data[i]
+        if c in " \t\r\n\f":
+            pending_ws = True
+            i += 1
+            continue
+        if c == "/" and data[i + 1:i + 2] == "*":
+            end = data.find("*/", i + 2)
+            end = len(data) if end < 0 else end + 2
+            comment = data[i:end]
+            i = end
+            if is_preserved_comment(comment):
+                out.append(comment)
+            else:
+                pending_ws = True
+            continue
+        if pending_ws:
+            last = out[-1][-1] if out else ""
+            if last and last not in CSS_PUNCTUATION + ":" and c not in CSS_PUNCTUATION:
+                out.append(" ")
+            pending_ws = False
+        if c in "'\"":
+            j = i + 1
+            while j < len(data) and data[j] != c:
+                j += 2 if data[j] == "\\" else 1
+            out.append(data[i:j + 1])
+            i = j + 1
+        elif data.startswith("url(", i):
+            # Unquoted urls may contain anything, e.g. //
+            j = data.find(")", i)
+            j = len(data) if j < 0 else j + 1
+            out.append(data[i:j])
+            i = j
+        elif c == "}" and out and out[-1] == ";":
+            out[-1] = c
+            i += 1
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out).strip()
+
+
+def minify_html(data):
+    """Remove comments and whitespace between tags, minify embedded scripts and styles."""
+    parts = []
+    pos = 0
+    for match in RE_HTML_SPECIAL.finditer(data):
+        parts.append(_minify_html_text(data[pos:match.start()]))
+        tag, attribs, contents = match.groups()
+        script_type = re.search(r'type=["\']?([^"\'\s>]+)', attribs)
+        if tag.lower() == "script" and (not script_type or script_type.group(1).lower() in HTML_SCRIPT_TYPES):
+            contents = minify_js(contents)
+        elif tag.lower() == "style":
+            contents = minify_css(contents)
+        parts.append("<%s%s>%s</%s>" % (tag, attribs, contents, tag))
+        pos = match.end()
+    parts.append(_minify_html_text(data[pos:]))
+    return "".join(parts).strip()
+
+
+def _minify_html_text(data):
+    data = RE_HTML_COMMENT.sub("", data)
+    # This text is between tags (or scripts and styles), whitespace next to them is dropped.
+    data = re.sub(r'>\s+<', '><', data)
+    data = re.sub(r'^\s+(?=<)|(?<=>)\s+$', '', data)
+    return "" if data.isspace() else re.sub(r'\s+', ' ', data)
+
+
+def minify_json(data):
+    return json.dumps(json.loads(data), separators=(",", ":"), ensure_ascii=False)
+
+
+# File extension -> minifier function (str -> str)
+MINIFIERS = {
+    ".js": minify_js,
+    ".mjs": minify_js,
+    ".css": minify_css,
+    ".html": minify_html,
+    ".htm": minify_html,
+    ".svg": minify_html,
+    ".json": minify_json,
+}
+
+
+def gzip_compress(data, max_compression=False):
+    """Compress with deflate level 9 into the gzip format. The output is the same for the same input, on every
+    platform and python version."""
+    best = None
+    for mem_level, strategy in GZIP_TRIALS if max_compression else GZIP_TRIALS[:1]:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level, strategy)
+        deflated = compressor.compress(data) + compressor.flush()
+        if best is None or len(deflated) < len(best):
+            best = deflated
+    return GZIP_HEADER + best + struct.pack("<II", zlib.crc32(data), len(data) & 0xffffffff)
+
+
+class BuildCache:
+    """Results of the minifiers and the compression, stored in files named by the hash of the input. The hash of
+    this script is a part of the key, so changes of the minifiers invalidate the cache."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.abspath(__file__), "rb") as fin:
+            self.version = hashlib.sha256(fin.read()).digest()
+
+    def key(self, *parts):
+        digest = hashlib.sha256(self.version)
+        for part in parts:
+            part = part if isinstance(part, bytes) else repr(part).encode("UTF-8")
+            digest.update(struct.pack("<Q", len(part)) + part)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as fin:
+                return fin.read()
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Other processes may write the same entry, so it appears at once, complete.
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp_path, path)
+
+
+def run_task(cache_dir, kind, arg, data):
+    """Minify (kind="minify", arg is the file extension) or compress (kind="gzip", arg is max_compression) data,
+    or get the result from the cache. This runs in the worker processes.
+
+    :return: (result, True when it was found in the cache, error message or None)
+    """
+    cache = BuildCache(cache_dir) if cache_dir else None
+    key = cache.key(kind, arg, data) if cache else None
+    if cache:
+        result = cache.get(key)
+        if result is not None:
+            return result, True, None
+    if kind == "minify":
+        try:
+            result = MINIFIERS[arg](data.decode("UTF-8")).encode("UTF-8")
+        except (UnicodeDecodeError, ValueError) as e:
+            # Errors are not cached, they are reported on every build.
+            return data, False, str(e)
+    else:
+        result = gzip_compress(data, arg)
+    if cache:
+        cache.put(key, result)
+    return result, False, None
+
+
+def parse_budget(text):
+    """Parse a NAME=LIMIT budget. Sizes can be given in K or M (kilobytes, megabytes), times in seconds."""
+    name, sep, limit = text.partition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError("Invalid budget, it must be NAME=LIMIT: %s" % text)
+    multiplier = {"K": 1024, "M": 1024 * 1024}.get(limit[-1:].upper(), 1)
+    try:
+        value = float(limit[:-1] if multiplier > 1 else limit.rstrip("s")) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid budget limit: %s" % text)
+    return name, value
+
+
+def data_uri(fname, data):
+    mime = mimetypes.guess_type(fname)[0] or "application/octet-stream"
+    return "data:%s;base64,%s" % (mime, base64.b64encode(data).decode("ascii"))
 
 
 class Main:
@@ -15,13 +444,218 @@ class Main:
         self.args = args
         self.total_src_size = 0
         self.total_dst_size = 0
+        # Stage -> total size of the output after that stage
+        self.stage_sizes = {stage: 0 for stage in STAGES}
+        # Files (relative to the source directory) that were inlined or bundled, they are not copied.
+        self.consumed = set()
+        # Number of files index.html loads, before and after bundling and inlining
+        self.requests_before = self.requests_after = 0
+        # (file extension, hash of the input) -> minified data
+        self.minified = {}
+        # Output files to be compressed and written: (destination path, data, sizes after the stages)
+        self.outputs = []
+        self.cache_hits = self.cache_lookups = 0
+        self.pool = None
+        # Paths of index.html and the files it loads (relative to the destination directory)
+        self.page_paths = []
+        # A dict for every output file: path (as it is requested), file (as it is written), raw and sent size
+        self.assets = []
 
     def log(self, *params):
         if self.args.verbose:
             print(*params)
 
-    @staticmethod
-    def convert_index_html(data) -> str:
+    def resolve(self, url, base_dir=""):
+        """Local path of an url (relative to the source directory), or None when it is not a local file."""
+        if re.match(r'^([a-z]+:|//|#)', url, re.I):
+            return None
+        url = url.split("#")[0].split("?")[0]
+        path = posixpath.normpath(url.lstrip("/") if url.startswith("/") else posixpath.join(base_dir, url))
+        if path.startswith("..") or not os.path.isfile(os.path.join(self.args.src_dir, *path.split("/"))):
+            return None
+        return path
+
+    def read_source(self, path):
+        with open(os.path.join(self.args.src_dir, *path.split("/")), "rb") as fin:
+            return fin.read()
+
+    def can_inline(self, data):
+        return 0 < len(data) <= self.args.inline_limit
+
+    def run_tasks(self, tasks):
+        """Run (kind, arg, data) tasks (see run_task), on the process pool when there are more of them.
+
+        :return: A list of (result, error) for the tasks.
+        """
+        cache_dir = self.args.cache_dir if self.args.use_cache else None
+        if self.pool and len(tasks) > 1:
+            results = list(self.pool.map(run_task, *zip(*[(cache_dir,) + task for task in tasks])))
+        else:
+            results = [run_task(cache_dir, *task) for task in tasks]
+        if cache_dir:
+            self.cache_lookups += len(tasks)
+            self.cache_hits += sum(1 for result, hit, error in results if hit)
+        return [(result, error) for result, hit, error in results]
+
+    def minify_key(self, path, data):
+        """Key of the minified data in self.minified, or None when the file is not minified."""
+        ext = posixpath.splitext(path)[1].lower()
+        if not self.args.minify or ext not in MINIFIERS:
+            return None
+        return ext, hashlib.sha256(data).digest()
+
+    def minify_all(self, paths):
+        """Minify the given files (relative to the source directory) in parallel, before they are needed."""
+        tasks, keys, names = [], [], []
+        for path in paths:
+            data = self.read_source(path)
+            key = self.minify_key(path, data)
+            if key and key not in self.minified and key not in keys:
+                tasks.append(("minify", key[0], data))
+                keys.append(key)
+                names.append(path)
+        for key, path, (result, error) in zip(keys, names, self.run_tasks(tasks)):
+            if error:
+                self.log("WARNING cannot minify %s: %s" % (path, error))
+            self.minified[key] = result
+
+    def minify_data(self, path, data):
+        """Minify the contents of a file, if its type is known. Returns the data as it is on errors."""
+        key = self.minify_key(path, data)
+        if key is None:
+            return data
+        if key not in self.minified:
+            [(result, error)] = self.run_tasks([("minify", key[0], data)])
+            if error:
+                self.log("WARNING cannot minify %s: %s" % (path, error))
+            self.minified[key] = result
+        return self.minified[key]
+
+    def process_css(self, path, css, dst_dir):
+        """Inline small files referenced from a stylesheet, and make the other urls relative to dst_dir (the
+        directory the stylesheet will be served from). When dst_dir is None, the stylesheet goes into index.html,
+        and the urls are made absolute."""
+        base_dir = posixpath.dirname(path)
+
+        def replace(match):
+            url = match.group(2).strip()
+            ref = self.resolve(url, base_dir)
+            if ref is None:
+                return match.group(0)
+            data = self.read_source(ref)
+            if self.can_inline(data):
+                data = self.minify_data(ref, data)
+                self.log("INLINE", ref, "into", path)
+                return 'url(%s)' % data_uri(ref, data)
+            if url.startswith("/") or base_dir == dst_dir:
+                return match.group(0)
+            if dst_dir is None:
+                return 'url(/%s)' % ref
+            return 'url(%s)' % posixpath.relpath(ref, dst_dir or os.curdir)
+
+        return RE_CSS_URL.sub(replace, css)
+
+    def add_stages(self, sizes):
+        for stage in STAGES:
+            self.stage_sizes[stage] += sizes[stage]
+
+    def write_output(self, dst_path, data, sizes):
+        """Add an output file. The files are compressed and written by write_outputs, all at once."""
+        self.outputs.append((dst_path, data, sizes))
+
+    def write_outputs(self):
+        """Compress the output files in parallel, write them, and account for their size in every stage. Files
+        that did not change are not written, so their modification time is kept.
+
+        :return: Set of the written (or unchanged) paths.
+        """
+        compressed = [os.path.splitext(dst_path)[1] != ".gz" and self.args.use_gzip
+                      for dst_path, data, sizes in self.outputs]
+        results = iter(self.run_tasks([("gzip", self.args.max_compression, data)
+                                       for (dst_path, data, sizes), gz in zip(self.outputs, compressed) if gz]))
+        written = set()
+        for (dst_path, data, sizes), gz in zip(self.outputs, compressed):
+            path = dst_path
+            if gz:
+                result, error = next(results)
+                if len(result) < len(data):
+                    data = result
+                    dst_path += ".gz"
+            sizes[STAGE_GZIP] = len(data)
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            try:
+                with open(dst_path, "rb") as fin:
+                    changed = fin.read() != data
+            except OSError:
+                changed = True
+            if changed:
+                with open(dst_path, "wb+") as fout:
+                    fout.write(data)
+            written.add(os.path.abspath(dst_path))
+            self.assets.append({
+                "path": os.path.relpath(dst_path[:-3] if dst_path != path else dst_path, self.args.dst_dir)
+                .replace(os.sep, "/"),
+                "file": os.path.relpath(dst_path, self.args.dst_dir).replace(os.sep, "/"),
+                "raw": sizes[STAGE_BUNDLE],
+                "size": sizes[STAGE_GZIP],
+            })
+            self.add_stages(sizes)
+            self.total_src_size += sizes[STAGE_SOURCE]
+            self.total_dst_size += sizes[STAGE_GZIP]
+            percent = 100.0 * sizes[STAGE_GZIP] / sizes[STAGE_SOURCE] if sizes[STAGE_SOURCE] else 100.0
+            self.log("WRITE" if changed else "SAME ", dst_path, "%.1f %%" % percent)
+        self.outputs = []
+        return written
+
+    def prune(self, dst_dir, written):
+        """Remove the files of the destination that are not outputs of this build (e.g. old bundles), and the
+        empty directories."""
+        for dpath, dnames, fnames in os.walk(dst_dir, topdown=False):
+            for fname in fnames:
+                fpath = os.path.join(dpath, fname)
+                if os.path.abspath(fpath) not in written:
+                    self.log("RM", fpath)
+                    os.unlink(fpath)
+            if dpath != dst_dir and not os.listdir(dpath):
+                self.log("RMDIR", dpath)
+                os.rmdir(dpath)
+
+    def make_bundle(self, paths, ext):
+        """Concatenate the given stylesheets or scripts into a single file. The bundle is put next to the first
+        file, its name contains the hash of its contents. The files of the bundle are not copied.
+
+        :return: (path of the bundle relative to the destination directory, its contents, sizes after the stages)
+        """
+        bundle_dir = posixpath.dirname(paths[0])
+        sizes = {stage: 0 for stage in STAGES}
+        parts = []
+        for path in paths:
+            data = self.read_source(path)
+            sizes[STAGE_SOURCE] += len(data)
+            data = self.minify_data(path, data)
+            sizes[STAGE_MINIFY] += len(data)
+            text = data.decode("UTF-8")
+            if ext == ".css":
+                text = self.process_css(path, text, bundle_dir)
+            else:
+                text = RE_SOURCE_MAP.sub("", text)
+            sizes[STAGE_INLINE] += len(text.encode("UTF-8"))
+            parts.append(text)
+            self.consumed.add(path)
+        # A line break ends a // comment, the semicolon ends the last statement of the previous script.
+        data = ("\n" if ext == ".css" else "\n;").join(parts).encode("UTF-8")
+        sizes[STAGE_BUNDLE] = len(data)
+        path = posixpath.join(bundle_dir, "bundle.%s%s" % (hashlib.sha256(data).hexdigest()[:8], ext))
+        self.log("BUNDLE", path, "from", " ".join(paths))
+        return path, data, sizes
+
+    def write_bundle(self, path, data, sizes):
+        dst_path = os.path.join(self.args.dst_dir, *path.split("/"))
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        self.write_output(dst_path, data, sizes)
+        return "/" + path
+
+    def convert_index_html(self, data) -> str:
         all_styles = []
         hrefs = re.findall(r'href="([^\"]+)"', data)
         for href in hrefs:
@@ -38,6 +672,50 @@ class Main:
                 all_js.append(srcs[0])
             else:
                 all_embedded_js.append("<script>%s</script>" % contents)
+        self.requests_before = len(all_styles) + len(all_js)
+
+        head = []
+        for attribs in re.findall(r'<link([^>]*rel="[^"]*icon[^"]*"[^>]*)>', data):
+            href = re.search(r'href="([^"]+)"', attribs)
+            path = href and self.resolve(href.group(1))
+            if path:
+                icon = self.read_source(path)
+                if self.can_inline(icon):
+                    self.log("INLINE", path, "into index.html")
+                    attribs = attribs.replace(href.group(0), 'href="%s"' % data_uri(path, icon))
+            head.append("<link%s>" % attribs.rstrip("/"))
+
+        # (url, local path or None, contents or None when it was not loaded yet, sizes of a bundle)
+        styles = [(href, self.resolve(href), None, None) for href in all_styles]
+        if self.args.bundle and len(styles) > 1 and all(path for href, path, css, sizes in styles):
+            path, css, sizes = self.make_bundle([path for href, path, css, sizes in styles], ".css")
+            styles = [("/" + path, path, css, sizes)]
+        # The order of stylesheets matters, so only the leading small ones are inlined.
+        while styles and styles[0][1]:
+            href, path, css, sizes = styles[0]
+            if css is None:
+                source = self.read_source(path)
+                css = self.minify_data(path, source)
+                sizes = {STAGE_SOURCE: len(source), STAGE_MINIFY: len(css)}
+            if not self.can_inline(css):
+                break
+            self.consumed.add(path)
+            # The inlined stylesheet is a part of index.html after the minify stage
+            for stage in [STAGE_SOURCE, STAGE_MINIFY]:
+                self.stage_sizes[stage] += sizes[stage]
+            self.total_src_size += sizes[STAGE_SOURCE]
+            self.log("INLINE", path, "into index.html")
+            head.append("<style>%s</style>" % self.process_css(path, css.decode("UTF-8"), None))
+            styles.pop(0)
+        all_styles = [self.write_bundle(path, css, sizes) if sizes and STAGE_BUNDLE in sizes else href
+                      for href, path, css, sizes in styles]
+
+        scripts = [self.resolve(src) for src in all_js]
+        if self.args.bundle and len(scripts) > 1 and all(scripts):
+            all_js = [self.write_bundle(*self.make_bundle(scripts, ".js"))]
+        self.requests_after = len(all_styles) + len(all_js)
+        self.page_paths = ["index.html"] + [posixpath.normpath(url.lstrip("/")) for url in all_styles + all_js
+                                            if not re.match(r'^([a-z]+:|//)', url, re.I)]
 
         with io.StringIO() as fout:
             fout.write("""<!doctype html>
@@ -47,76 +725,146 @@ class Main:
     <meta name="viewport" content="width=device-width,initial-scale=1,shrink-to-fit=no"/>
     <meta name="theme-color" content="#000000"/>
     <title>Wifi Beállítása</title>
+%(head)s
+</head>
 <body>
     <noscript>Az alkalmazás futtatásához JavaScript-re van szükség.</noscript>
     <div id="root"></div>
 %(embedded_js)s
 <script>
+(function() {
 var root = document.getElementById("root");
 var all_styles = %(all_styles)s;
 var all_js = %(all_js)s;
+// Files loaded at the same time, the device has only a few sockets.
+var parallel = %(parallel)d;
+// A file is tried this many times again, the first retry is after retryDelay ms, then the delay is doubled.
+var retries = %(retries)d;
+var retryDelay = %(retry_delay)d;
 
-var fetchStyle = function(index) {
-  return new Promise((resolve, reject) => {
-    if (index>=all_styles.length) {
-        fetchJs(0).then(function() { resolve() });
-    } else {
-        var url = all_styles[index];    
-        root.appendChild(document.createTextNode("."));
-        let link = document.createElement('link');
-        link.setAttribute('type', 'text/css');
-        link.setAttribute('rel', 'stylesheet');
-        link.onload = function() { 
-            fetchStyle(index+1).then( function() { resolve(); } ) 
+var withRetries = function(load, url) {
+    return new Promise(function(resolve, reject) {
+        var attempt = function(n) {
+            load(url).then(resolve, function(error) {
+                if (n >= retries) {
+                    reject(error);
+                } else {
+                    setTimeout(function() { attempt(n + 1); }, retryDelay * Math.pow(2, n));
+                }
+            });
         };
-        link.setAttribute('href', url);
-        let headScript = document.querySelector('script');
-        headScript.parentNode.insertBefore(link, headScript);
-    }
-  });
+        attempt(0);
+    });
 };
 
-var fetchJs = function(index) {
-  return new Promise((resolve, reject) => {
-    if (index>=all_js.length) {
-            resolve();
-    } else {
-        var url = all_js[index];
-        root.appendChild(document.createTextNode("."));
-        let link = document.createElement('script');
-        link.setAttribute('type', 'text/javascript');
-        link.onload = function() {
-            fetchJs(index+1).then( function() { resolve(); } ) 
-        };
-        link.setAttribute('src', url);
-        let headScript = document.querySelector('script');
-        headScript.parentNode.insertBefore(link, headScript);
+// Stylesheets are linked at their own place, so their order is kept.
+var loadStyle = function(marker) {
+    return function(url) {
+        return new Promise(function(resolve, reject) {
+            var link = document.createElement('link');
+            link.setAttribute('rel', 'stylesheet');
+            link.onload = resolve;
+            link.onerror = function() {
+                link.parentNode.removeChild(link);
+                reject(new Error(url));
+            };
+            link.setAttribute('href', url);
+            marker.parentNode.insertBefore(link, marker);
+        });
+    };
+};
+
+var fetchScript = function(url) {
+    return fetch(url).then(function(response) {
+        if (!response.ok) {
+            throw new Error(url + ": " + response.status);
+        }
+        return response.text();
+    });
+};
+
+// Scripts are downloaded in any order, but they are executed in their original order, after the stylesheets.
+var texts = [];
+var executed = 0;
+var pendingStyles = all_styles.length;
+var runScripts = function() {
+    while (!pendingStyles && executed < all_js.length && texts[executed] !== undefined) {
+        var script = document.createElement('script');
+        script.text = texts[executed] + "\\n//# sourceURL=" + all_js[executed];
+        document.body.appendChild(script);
+        executed++;
     }
-  });
 };
 
-setTimeout(function() {fetchStyle(0)}, 1000);
+var tasks = all_styles.map(function(url) {
+    var marker = document.createComment(url);
+    document.head.appendChild(marker);
+    return function() {
+        return withRetries(loadStyle(marker), url).then(function() {
+            pendingStyles--;
+            runScripts();
+        });
+    };
+}).concat(all_js.map(function(url, index) {
+    return function() {
+        return withRetries(fetchScript, url).then(function(text) {
+            texts[index] = text;
+            runScripts();
+        });
+    };
+}));
+
+// Start the tasks in order, at most `parallel` of them at a time.
+var next = 0;
+var failed = false;
+var start = function() {
+    if (failed || next >= tasks.length) {
+        return;
+    }
+    var task = tasks[next++];
+    task().then(function() {
+        // Progress dots, until the application takes over the root element.
+        if (executed < all_js.length) {
+            root.appendChild(document.createTextNode("."));
+        }
+        start();
+    }, function(error) {
+        failed = true;
+        console.error(error);
+        root.textContent = "Az alkalmazás betöltése nem sikerült, kérjük töltse újra az oldalt.";
+    });
+};
+for (var i = 0; i < parallel; i++) {
+    start();
+}
+runScripts();
+})();
 
 </script>
 </body>
-</html>            
+</html>
             """ % {
+                "head": "\n".join(head),
                 "embedded_js": "\n".join(all_embedded_js),
                 "all_styles": json.dumps(all_styles),
                 "all_js": json.dumps(all_js),
+                "parallel": max(1, self.args.parallel),
+                "retries": self.args.retries,
+                "retry_delay": int(self.args.retry_delay * 1000),
             })
             fout.seek(0)
             return fout.read()
 
-    def minify_dir(self, src_dir, dst_dir, is_root=False):
+    def minify_dir(self, src_dir, dst_dir):
         for fname in sorted(os.listdir(src_dir)):
             src_path = os.path.join(src_dir, fname)
             dst_path = os.path.join(dst_dir, fname)
+            path = os.path.relpath(src_path, self.args.src_dir).replace(os.sep, "/")
             if os.path.isdir(src_path):
-                if not os.path.isdir(dst_path):
-                    self.log("MKDIR", dst_path)
-                    os.mkdir(dst_path)
+                # Directories are created when their files are written
                 self.minify_dir(src_path, dst_path)
+            elif path in self.consumed:
+                self.log("SKIP", src_path, "(inlined or bundled)")
             else:
                 src_ext = os.path.splitext(src_path)[1]
                 if src_ext in self.args.exclude_extensions:
@@ -125,26 +873,179 @@ setTimeout(function() {fetchStyle(0)}, 1000);
                 else:
                     with open(src_path, "rb") as fin:
                         data = fin.read()
-                    if is_root and fname == "index.html":
-                        data = self.convert_index_html(data.decode("UTF-8")).encode("UTF-8")
-                    src_size = len(data)
-                    dst_size = src_size
-                    if self.args.use_gzip and src_ext != ".gz":
-                        compressed = gzip.compress(data)
-                        if len(compressed) < len(data):
-                            data = compressed
-                            dst_size = len(compressed)
-                            dst_path += ".gz"
+                    sizes = {STAGE_SOURCE: len(data)}
+                    data = self.minify_data(path, data)
+                    sizes[STAGE_MINIFY] = len(data)
+                    if src_ext == ".css":
+                        data = self.process_css(path, data.decode("UTF-8"), posixpath.dirname(path)).encode("UTF-8")
+                    sizes[STAGE_INLINE] = sizes[STAGE_BUNDLE] = len(data)
+                    self.write_output(dst_path, data, sizes)
+
+    def source_files(self):
+        """All files of the source directory (relative paths), except the excluded ones."""
+        result = []
+        for dpath, dnames, fnames in os.walk(self.args.src_dir):
+            for fname in fnames:
+                if os.path.splitext(fname)[1] not in self.args.exclude_extensions:
+                    path = os.path.relpath(os.path.join(dpath, fname), self.args.src_dir)
+                    result.append(path.replace(os.sep, "/"))
+        return sorted(result)
+
+    def write_service_worker(self, dst_dir):
+        """Add a service worker to the outputs, with the hash of all other outputs in its manifest.
+
+        It serves these files from its cache, and only fetches the files whose hash is not in the cache. When any
+        of the files changes, the service worker changes too, so the browser installs it again."""
+        sw_path = os.path.join(dst_dir, *SERVICE_WORKER_PATH.split("/"))
+        for output in self.outputs:
+            if output[0] == sw_path:
+                self.log("REPLACE", sw_path)
+                self.outputs.remove(output)
+                break
+        manifest = {}
+        for dst_path, data, sizes in self.outputs:
+            url = "/" + os.path.relpath(dst_path, dst_dir).replace(os.sep, "/")
+            manifest[url] = hashlib.sha256(data).hexdigest()[:16]
+        data = ("""
+// Generated by esp_minify_www.py, do not edit.
+var MANIFEST = %(manifest)s;
+var CACHE = "esp_minify_www";
+
+// The hash of a file is stored in the cached url, so changed files are not found in the cache.
+var cacheKey = function(path) {
+    return path + "?" + MANIFEST[path];
+};
+
+var manifestPath = function(request) {
+    var url = new URL(request.url);
+    if (request.method !== "GET" || url.origin !== self.location.origin) {
+        return null;
+    }
+    var path = url.pathname === "/" ? "/index.html" : url.pathname;
+    return MANIFEST.hasOwnProperty(path) ? path : null;
+};
+
+var cached = function(cache, path) {
+    return cache.match(cacheKey(path)).then(function(response) {
+        return response || fetch(path, {cache: "no-store"}).then(function(response) {
+            if (!response.ok) {
+                throw new Error(path + ": " + response.status);
+            }
+            return cache.put(cacheKey(path), response.clone()).then(function() {
+                return response;
+            });
+        });
+    });
+};
+
+// Files are downloaded one at a time, the device has only a few sockets.
+self.addEventListener("install", function(event) {
+    event.waitUntil(caches.open(CACHE).then(function(cache) {
+        return Object.keys(MANIFEST).reduce(function(previous, path) {
+            return previous.then(function() {
+                return cached(cache, path);
+            });
+        }, Promise.resolve());
+    }).then(function() {
+        return self.skipWaiting();
+    }));
+});
+
+self.addEventListener("activate", function(event) {
+    event.waitUntil(caches.open(CACHE).then(function(cache) {
+        return cache.keys().then(function(requests) {
+            return Promise.all(requests.filter(function(request) {
+                var url = new URL(request.url);
+                return url.search !== "?" + MANIFEST[url.pathname];
+            }).map(function(request) {
+                return cache.delete(request);
+            }));
+        });
+    }).then(function() {
+        return self.clients.claim();
+    }));
+});
 
-                    with open(dst_path, "wb+") as fout:
-                        fout.write(data)
+// Files of the manifest are served from the cache, everything else (e.g. the api) from the device.
+self.addEventListener("fetch", function(event) {
+    var path = manifestPath(event.request);
+    if (path) {
+        event.respondWith(caches.open(CACHE).then(function(cache) {
+            return cached(cache, path);
+        }));
+    }
+});
+""" % {"manifest": json.dumps(manifest, sort_keys=True)}).encode("UTF-8")
+        sizes = {STAGE_SOURCE: len(data)}
+        data = self.minify_data(SERVICE_WORKER_PATH, data)
+        sizes[STAGE_MINIFY] = sizes[STAGE_INLINE] = sizes[STAGE_BUNDLE] = len(data)
+        self.log("SERVICE WORKER", SERVICE_WORKER_PATH, "with %d files" % len(manifest))
+        self.write_output(sw_path, data, sizes)
+
+    def estimates(self):
+        """Add the estimated serial upload and page load time to every asset, and return the totals."""
+        page = {path: None for path in self.page_paths}
+        for asset in self.assets:
+            asset["deploy_time"] = asset["size"] * SERIAL_BITS_PER_BYTE / float(self.args.serial_baudrate)
+            if asset["path"] in page:
+                asset["load_time"] = asset["size"] * 8 / (self.args.link_rate * 1000.0) + self.args.request_latency
+                page[asset["path"]] = asset
+            else:
+                asset["load_time"] = None
+        page_assets = [asset for asset in page.values() if asset]
+        page_size = sum(asset["size"] for asset in page_assets)
+        # index.html is loaded first, then the loader requests `--parallel` files at a time, so their latencies
+        # overlap. The link is shared, so the transfer times add up.
+        rounds = 1 + -(-(len(page_assets) - 1) // max(1, self.args.parallel)) if page_assets else 0
+        return {
+            BUDGET_TOTAL: sum(asset["size"] for asset in self.assets),
+            BUDGET_PAGE: page_size,
+            BUDGET_REQUESTS: len(page_assets),
+            BUDGET_LOAD_TIME: page_size * 8 / (self.args.link_rate * 1000.0) + rounds * self.args.request_latency,
+            BUDGET_DEPLOY_TIME: sum(asset["deploy_time"] for asset in self.assets),
+        }
 
-                    self.total_src_size += src_size
-                    self.total_dst_size += dst_size
+    def print_assets(self, totals):
+        print("%-48s %10s %10s %8s %8s" % ("Asset", "Raw", "Sent", "Deploy", "Load"))
+        for asset in sorted(self.assets, key=lambda asset: asset["path"]):
+            print("%-48s %9.2fK %9.2fK %7.2fs %8s" % (
+                asset["file"], asset["raw"] / 1024.0, asset["size"] / 1024.0, asset["deploy_time"],
+                "" if asset["load_time"] is None else "%.2fs" % asset["load_time"]))
+        print("Deploy: %.2fK in %.1fs over serial at %d baud" % (
+            totals[BUDGET_TOTAL] / 1024.0, totals[BUDGET_DEPLOY_TIME], self.args.serial_baudrate))
+        print("Page load: %d requests, %.2fK in %.2fs over the soft-AP at %d kbit/s" % (
+            totals[BUDGET_REQUESTS], totals[BUDGET_PAGE] / 1024.0, totals[BUDGET_LOAD_TIME], self.args.link_rate))
 
-                    percent = 100.0 * dst_size / src_size
+    def check_budgets(self, totals):
+        """Check the budgets. Returns a list of dicts with name, limit, value (the largest matching file for file
+        name patterns), and ok."""
+        results = []
+        for name, limit in self.args.budgets:
+            if name in totals:
+                value = totals[name]
+            else:
+                matches = [asset["size"] for asset in self.assets
+                           if fnmatch.fnmatch(asset["path"], name) or fnmatch.fnmatch(asset["file"], name)]
+                value = max(matches) if matches else 0
+            results.append({"name": name, "limit": limit, "value": value, "ok": value <= limit})
+            if value > limit:
+                unit = "s" if name in BUDGET_TIMES else ("" if name == BUDGET_REQUESTS else " bytes")
+                print("BUDGET EXCEEDED %s: %g%s, the limit is %g%s" % (name, value, unit, limit, unit))
+        return results
 
-                    self.log("COPY", src_path, "%.1f %%" % percent)
+    def print_stages(self):
+        """Print the size of the output after each stage, and the savings of the stage."""
+        self.log("Stage      Size         Saved")
+        previous = None
+        for stage in STAGES:
+            size = self.stage_sizes[stage]
+            line = "%-10s %9.2fK" % (stage, size / 1024.0)
+            if previous:
+                line += "  %9.2fK %5.1f %%" % ((previous - size) / 1024.0, 100.0 * (previous - size) / previous)
+            if stage == STAGE_BUNDLE and self.requests_before:
+                line += "  (index.html loads %d files instead of %d)" % (self.requests_after, self.requests_before)
+            self.log(line)
+            previous = size
 
     def run(self):
         src_dir = self.args.src_dir
@@ -168,7 +1069,38 @@ setTimeout(function() {fetchStyle(0)}, 1000);
         self.total_src_size = 0
         self.total_dst_size = 0
 
-        self.minify_dir(args.src_dir, args.dst_dir, True)
+        if self.args.jobs > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.args.jobs)
+        try:
+            return self.build(src_dir, dst_dir)
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+                self.pool = None
+
+    def build(self, src_dir, dst_dir):
+        # Everything is minified first in parallel (or found in the cache), the other stages use the results.
+        self.minify_all(self.source_files())
+
+        # index.html is converted first, because it decides which files are inlined and bundled.
+        index_path = os.path.join(src_dir, "index.html")
+        if os.path.isfile(index_path):
+            with open(index_path, "rb") as fin:
+                data = fin.read()
+            # The converted index.html has the loader script, the inlined stylesheets and icons, so only the
+            # original is measured in the minify stage.
+            sizes = {STAGE_SOURCE: len(data), STAGE_MINIFY: len(self.minify_data("index.html", data))}
+            data = self.minify_data("index.html", self.convert_index_html(data.decode("UTF-8")).encode("UTF-8"))
+            sizes[STAGE_INLINE] = sizes[STAGE_BUNDLE] = len(data)
+            self.write_output(os.path.join(dst_dir, "index.html"), data, sizes)
+            self.consumed.add("index.html")
+
+        self.minify_dir(src_dir, dst_dir)
+        if self.args.service_worker:
+            self.write_service_worker(dst_dir)
+        written = self.write_outputs()
+        if self.args.prune:
+            self.prune(dst_dir, written)
 
         if not self.total_dst_size:
             self.log("-----------------------------")
@@ -176,13 +1108,35 @@ setTimeout(function() {fetchStyle(0)}, 1000);
         else:
             percent = 100.0 * self.total_dst_size / self.total_src_size
             self.log("-----------------------------")
+            self.print_stages()
+            self.log("-----------------------------")
             self.log("Original size:   %.2fK" % (self.total_src_size / 1024.0))
             self.log("Minified size:   %.2fK" % (self.total_dst_size / 1024.0))
             self.log("Ratio:           %.2f%%" % percent)
+        if self.cache_lookups:
+            self.log("Cache:           %d of %d results reused" % (self.cache_hits, self.cache_lookups))
+
+        totals = self.estimates()
+        if self.args.verbose:
+            self.log("-----------------------------")
+            self.print_assets(totals)
+        budgets = self.check_budgets(totals)
+        if self.args.report:
+            with open(self.args.report, "w") as fout:
+                json.dump({
+                    "stages": self.stage_sizes,
+                    "assets": sorted(self.assets, key=lambda asset: asset["path"]),
+                    "totals": totals,
+                    "serial_baudrate": self.args.serial_baudrate,
+                    "link_rate": self.args.link_rate,
+                    "request_latency": self.args.request_latency,
+                    "budgets": budgets,
+                }, fout, indent=2)
+        return all(budget["ok"] for budget in budgets)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Process some integers.')
+    parser = argparse.ArgumentParser(description='Minify and compress a web application for the ESP.')
 
     parser.add_argument("-c", "--clean", dest='clean', action="store_true", default=False,
                         help="Clean output directory before minifying.")
@@ -193,7 +1147,59 @@ if __name__ == "__main__":
                         help="Exclude files with this extension. Can be specified"
                              " multiple times. Default values is %s." % DEFAULT_EXCLUDE_EXTENSIONS)
     parser.add_argument("-n", "--no-gzip", dest='use_gzip', action="store_false", default=True,
-                        help="Be verbose")
+                        help="Do not compress the files.")
+    parser.add_argument("--no-minify", dest='minify', action="store_false", default=True,
+                        help="Do not remove whitespace and comments from html, css, javascript, svg and json files.")
+    parser.add_argument("-i", "--inline-limit", dest='inline_limit', type=int, default=DEFAULT_INLINE_LIMIT,
+                        help="Inline files referenced from stylesheets, icons and the leading stylesheets of"
+                             " index.html up to this size (bytes). 0 disables inlining. Default is %d."
+                             % DEFAULT_INLINE_LIMIT)
+    parser.add_argument("-b", "--bundle", dest='bundle', action="store_true", default=False,
+                        help="Merge the scripts and the stylesheets loaded by index.html into a single script and"
+                             " a single stylesheet, so the page is loaded with fewer requests.")
+
+    parser.add_argument("--parallel", dest='parallel', type=int, default=DEFAULT_PARALLEL,
+                        help="The loader of index.html downloads this many files at the same time, default is %d."
+                             % DEFAULT_PARALLEL)
+    parser.add_argument("--retries", dest='retries', type=int, default=DEFAULT_RETRIES,
+                        help="The loader of index.html tries a failed download again this many times, default is %d."
+                             % DEFAULT_RETRIES)
+    parser.add_argument("--retry-delay", dest='retry_delay', type=float, default=DEFAULT_RETRY_DELAY,
+                        help="Delay before the first retry (seconds), it is doubled after every retry. Default is %s."
+                             % DEFAULT_RETRY_DELAY)
+    parser.add_argument("--no-service-worker", dest='service_worker', action="store_false", default=True,
+                        help="Do not generate %s, the service worker that caches the files in the browser."
+                             % SERVICE_WORKER_PATH)
+    parser.add_argument("-p", "--prune", dest='prune', action="store_true", default=False,
+                        help="Remove files from the output directory that are not the outputs of this build (e.g."
+                             " old bundles). Unlike --clean, unchanged files are kept as they are.")
+    parser.add_argument("-j", "--jobs", dest='jobs', type=int, default=DEFAULT_JOBS,
+                        help="Number of processes that minify and compress the files, default is %d." % DEFAULT_JOBS)
+    parser.add_argument("-z", "--max-compression", dest='max_compression', action="store_true", default=False,
+                        help="Try more deflate strategies for every file, and keep the smallest output. Slower, but"
+                             " the output is still plain gzip.")
+    parser.add_argument("--cache-dir", dest='cache_dir', default=DEFAULT_CACHE_DIR,
+                        help="Minified and compressed files are cached here, by the hash of their contents. Default"
+                             " is %s" % DEFAULT_CACHE_DIR)
+    parser.add_argument("--no-cache", dest='use_cache', action="store_false", default=True,
+                        help="Do not use the cache.")
+
+    parser.add_argument("--serial-baudrate", dest='serial_baudrate', type=int, default=DEFAULT_SERIAL_BAUDRATE,
+                        help="Baud rate for the deploy time estimate, default is %d." % DEFAULT_SERIAL_BAUDRATE)
+    parser.add_argument("--link-rate", dest='link_rate', type=float, default=DEFAULT_LINK_RATE,
+                        help="Throughput of the soft-AP for the page load estimate (kbit/s), default is %d."
+                             % DEFAULT_LINK_RATE)
+    parser.add_argument("--request-latency", dest='request_latency', type=float, default=DEFAULT_REQUEST_LATENCY,
+                        help="Time the device needs to start serving a request (seconds), for the page load"
+                             " estimate. Default is %s." % DEFAULT_REQUEST_LATENCY)
+    parser.add_argument("--budget", dest='budgets', type=parse_budget, action="append", default=[],
+                        help="Fail the build when a limit is exceeded, can be given multiple times. NAME=LIMIT where"
+                             " NAME is a file name pattern (e.g. '*.js=200K', the limit applies to every matching"
+                             " file), %s or %s (total size of the output, or of index.html and the files it loads),"
+                             " %s, %s or %s (seconds). Sizes are compressed sizes." % (
+                                 BUDGET_TOTAL, BUDGET_PAGE, BUDGET_REQUESTS, BUDGET_LOAD_TIME, BUDGET_DEPLOY_TIME))
+    parser.add_argument("--report", dest='report', default=None,
+                        help="Write the sizes, estimates and budgets into this file as JSON.")
 
     parser.add_argument(dest='src_dir', help="Source directory")
     parser.add_argument(dest='dst_dir', help="Dest directory")
@@ -201,4 +1207,5 @@ if __name__ == "__main__":
     args = parser.parse_args()
     if not args.exclude_extensions:
         args.exclude_extensions = DEFAULT_EXCLUDE_EXTENSIONS
-    Main(args).run()
+    if not Main(args).run():
+        sys.exit(1)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Run the same espsyncer.py operations on many devices at once.
+
+Every device gets its own espsyncer session on its own serial port, and the sessions run on a thread pool.
+The operations are given in the same way as for espsyncer.py: a single command, or a batch file. Ports can
+be given as glob patterns, e.g. /dev/ttyUSB*. Devices that failed are retried after all others are done.
+At the end, a result is printed for every device, and it can also be written as a JSON report.
+
+    espfleet.py -p '/dev/ttyUSB*' --report fleet.json batch deploy.txt
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import espsyncer
+
+DEFAULT_JOBS = 8
+DEFAULT_RETRIES = 1
+DEFAULT_PROGRESS_INTERVAL = 2.0
+
+STATUS_WAITING = "waiting"
+STATUS_RUNNING = "running"
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+
+
+def expand_ports(patterns):
+    """Expand glob patterns of port names. Names that are not patterns are kept as they are (e.g. COM3)."""
+    ports = []
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        for port in matches:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+
+class DeviceSession(espsyncer.Main):
+    """An espsyncer session with a single device of the fleet. Its log goes into a file, or it is dropped."""
+
+    def __init__(self, args, port, fout):
+        args = copy.copy(args)
+        args.port = port
+        args.verbose = False
+        # The telemetry of the sessions is in the report of the fleet.
+        args.telemetry_report = None
+        super().__init__(args)
+        self.fout = fout
+
+    def log(self, s):
+        if self.fout:
+            self.fout.write(s)
+            self.fout.flush()
+
+
+class Device:
+    def __init__(self, port):
+        self.port = port
+        self.status = STATUS_WAITING
+        # A dict for each session: duration, error (None on success), the telemetry counters of the session
+        # (see EspSyncer.counters) and its phases.
+        self.attempts = []
+        # The session that is running now
+        self.session = None
+
+    def bytes_transferred(self):
+        total = sum(attempt["bytes"] for attempt in self.attempts)
+        session = self.session
+        if session and session.syncer:
+            total += session.syncer.bytes_transferred
+        return total
+
+    def result(self):
+        return {
+            "port": self.port,
+            "status": self.status,
+            "bytes": self.bytes_transferred(),
+            "duration": sum(attempt["duration"] for attempt in self.attempts),
+            "attempts": self.attempts,
+        }
+
+
+class Main:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def log(self, s):
+        if self.args.verbose:
+            with self.lock:
+                sys.stdout.write(s)
+                sys.stdout.flush()
+
+    def open_device_log(self, port):
+        if not self.args.log_dir:
+            return None
+        os.makedirs(self.args.log_dir, exist_ok=True)
+        fname = port.strip("/\\").replace("/", "_").replace("\\", "_") or "device"
+        return open(os.path.join(self.args.log_dir, fname + ".log"), "a", encoding="UTF-8")
+
+    def run_device(self, device, operations, batch_name):
+        """Run a session with a single device, and record the result."""
+        fout = self.open_device_log(device.port)
+        session = DeviceSession(self.args, device.port, fout)
+        with self.lock:
+            device.session = session
+            device.status = STATUS_RUNNING
+        self.log("START %s\n" % device.port)
+        started = time.time()
+        error = None
+        try:
+            if fout:
+                fout.write("\n--- %s attempt %d\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), len(device.attempts) + 1))
+            session.run_session(operations, batch_name)
+        except (Exception, SystemExit) as e:
+            error = "%s: %s" % (e.__class__.__name__, e)
+            if fout:
+                fout.write("\nERROR %s\n" % error)
+        finally:
+            if fout:
+                fout.close()
+        syncer = session.syncer
+        attempt = {
+            "duration": time.time() - started,
+            "bytes": syncer.bytes_transferred if syncer else 0,
+            "retries": syncer.retries if syncer else 0,
+            "error": error,
+        }
+        if syncer:
+            attempt.update(syncer.counters())
+            attempt["phases"] = syncer.phase_stats
+        with self.lock:
+            device.attempts.append(attempt)
+            device.session = None
+            device.status = STATUS_OK if error is None else STATUS_FAILED
+        if error:
+            self.log("FAILED %s: %s\n" % (device.port, error))
+        else:
+            self.log("OK %s in %.2fs\n" % (device.port, attempt["duration"]))
+
+    def print_progress(self, devices):
+        with self.lock:
+            counts = {}
+            for device in devices:
+                counts[device.status] = counts.get(device.status, 0) + 1
+            total = sum(device.bytes_transferred() for device in devices)
+            sys.stdout.write("[%7.1fs] %d/%d ok, %d failed, %d running, %d waiting, %.1f KB transferred\n" % (
+                time.time() - self.started, counts.get(STATUS_OK, 0), len(devices), counts.get(STATUS_FAILED, 0),
+                counts.get(STATUS_RUNNING, 0), counts.get(STATUS_WAITING, 0), total / 1024.0))
+            sys.stdout.flush()
+
+    def run_pass(self, devices, all_devices, operations, batch_name):
+        """Run sessions with the given devices on the thread pool, and show the progress of all devices."""
+        for device in devices:
+            device.status = STATUS_WAITING
+        with ThreadPoolExecutor(max_workers=max(1, min(self.args.jobs, len(devices)))) as executor:
+            futures = [executor.submit(self.run_device, device, operations, batch_name) for device in devices]
+            while True:
+                done, not_done = wait(futures, timeout=self.args.progress_interval or None)
+                if self.args.progress_interval:
+                    self.print_progress(all_devices)
+                if not not_done:
+                    break
+        for future in futures:
+            # Errors of the sessions are recorded by run_device, this only raises on a bug.
+            future.result()
+
+    def print_report(self, devices):
+        print("%-24s %-8s %8s %12s %10s  %s" % ("Port", "Status", "Attempts", "Transferred", "Duration", "Error"))
+        for device in devices:
+            result = device.result()
+            errors = [attempt["error"] for attempt in device.attempts if attempt["error"]]
+            print("%-24s %-8s %8d %9.1f KB %9.2fs  %s" % (
+                device.port, device.status, len(device.attempts), result["bytes"] / 1024.0, result["duration"],
+                errors[-1] if errors and device.status == STATUS_FAILED else ""))
+
+    def run(self, ports, command, params):
+        if command != espsyncer.Commands.BATCH.value and command not in espsyncer.BATCH_COMMANDS:
+            raise SystemExit("Invalid command for a fleet: %s" % command)
+        operations = espsyncer.Main(self.args).get_operations(command, params)
+        batch_name = params[0] if command == espsyncer.Commands.BATCH.value else None
+        devices = [Device(port) for port in ports]
+        pending = devices
+        for attempt in range(self.args.retries + 1):
+            if attempt:
+                self.log("RETRY %s\n" % " ".join(device.port for device in pending))
+            self.run_pass(pending, devices, operations, batch_name)
+            pending = [device for device in devices if device.status == STATUS_FAILED]
+            if not pending:
+                break
+
+        self.print_report(devices)
+        ok = sum(1 for device in devices if device.status == STATUS_OK)
+        elapsed = time.time() - self.started
+        print("%d of %d devices OK in %.2fs" % (ok, len(devices), elapsed))
+        if self.args.report:
+            with open(self.args.report, "w") as fout:
+                json.dump({
+                    "command": command,
+                    "params": params,
+                    "duration": elapsed,
+                    "ok": ok,
+                    "failed": len(devices) - ok,
+                    "devices": [device.result() for device in devices],
+                }, fout, indent=2)
+        return ok == len(devices)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run espsyncer operations on many devices at once')
+    parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
+                        help="Be verbose")
+    espsyncer.add_operation_arguments(parser)
+
+    parser.add_argument("-p", "--port", dest='ports', action="append", default=None,
+                        help="Port or glob pattern of ports, can be given multiple times. Default is the value of"
+                             " the ESP_PORTS environment variable (separated by spaces).")
+    espsyncer.add_session_arguments(parser)
+    parser.add_argument("-j", "--jobs", dest='jobs', type=int, default=DEFAULT_JOBS,
+                        help="Number of devices that are synced at the same time, default is %s" % DEFAULT_JOBS)
+    parser.add_argument("--retries", dest='retries', type=int, default=DEFAULT_RETRIES,
+                        help="Run the operations again on the failed devices this many times, default is %s"
+                             % DEFAULT_RETRIES)
+    parser.add_argument("--log-dir", dest='log_dir', default=None,
+                        help="Write the log of every device into a file in this directory.")
+    parser.add_argument("--progress-interval", dest='progress_interval', type=float,
+                        default=DEFAULT_PROGRESS_INTERVAL,
+                        help="Print the progress of the fleet this often (seconds), 0 disables it. Default is %s"
+                             % DEFAULT_PROGRESS_INTERVAL)
+    parser.add_argument("--report", dest='report', default=None,
+                        help="Write a machine readable report of the results into this file.")
+
+    parser.add_argument(dest='command', default=None,
+                        help="Command to be executed on every device: one of %s, or batch with a file name"
+                             " (or - for stdin)." % ", ".join(espsyncer.BATCH_COMMANDS))
+    parser.add_argument(dest='params', default=[], nargs='*')
+
+    args = parser.parse_args()
+    if not args.ports:
+        if os.environ.get("ESP_PORTS"):
+            args.ports = os.environ["ESP_PORTS"].split()
+        else:
+            parser.error("Either --port must be given or ESP_PORTS environment variable must be set.")
+    ports = expand_ports(args.ports)
+    if not ports:
+        parser.error("No ports found: %s" % " ".join(args.ports))
+
+    if args.timeout <= 0:
+        args.timeout = None
+
+    if not Main(args).run(ports, args.command, args.params):
+        sys.exit(1)
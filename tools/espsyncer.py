@@ -5,13 +5,39 @@ import time
 import sys
 import os
 import select
+import struct
+import binascii
+import contextlib
+import io
+import json
+import shlex
+import hashlib
+import zlib
+from collections import deque
 from enum import Enum
 from typing import Optional
 
+from file_watcher import FileWatcher, DEFAULT_DEBOUNCE
+
 EOL = b'\r\n'
 DEFAULT_BAUD_RATE = 115200
 DEFAULT_TIMEOUT = 5
 DEFAULT_TERMINATOR = EOL + b'>>> '
+RAW_REPL_PROMPT = b'raw REPL; CTRL-B to exit\r\n>'
+SOFT_REBOOT_MESSAGE = b'soft reboot'
+
+# Hard reset pulls the EN pin of the chip through the RTS line. Soft reset interrupts the running program and
+# reboots MicroPython with Ctrl-D, it also works without RTS/DTR lines (e.g. on a pseudo terminal).
+RESET_HARD = "hard"
+RESET_SOFT = "soft"
+RESET_MODES = [RESET_HARD, RESET_SOFT]
+# live_test_file runs the script again when it (or a library module) was changed. Before that, the device is
+# reset (hard or soft, see above), or the running program is interrupted, and only the changed modules are
+# reloaded: they are uploaded and removed from sys.modules, so the script imports them again.
+RELOAD_MODULES = "modules"
+RELOAD_MODES = [RESET_HARD, RESET_SOFT, RELOAD_MODULES]
+# Module files of the library directory of live_test_file
+MODULE_SUFFIXES = [".py", ".mpy"]
 
 ST_TYPE_FILE = 32768
 ST_TYPE_DIRECTORY = 16384
@@ -19,6 +45,79 @@ ST_TYPE_DIRECTORY = 16384
 IDENT = '    '
 MAX_WRITE_PER_PASS = 64
 MAX_READ_PER_PASS = 64
+# Frame sizes for file transfers through the agent (raw protocol). Uploads start with the default frame
+# size, and it is adapted between the minimum and the maximum. The maximum is also limited by the free heap
+# of the device: a frame can use at most 1/HEAP_FRAME_RATIO of it.
+DEFAULT_FRAME_SIZE = 1024
+MIN_FRAME_SIZE = 128
+MAX_FRAME_SIZE = 8192
+HEAP_FRAME_RATIO = 4
+# Number of frames sent before waiting for an acknowledgement.
+DEFAULT_WINDOW = 4
+# Grow the frame size (then the window) after this many frames were acknowledged without errors.
+GROW_AFTER = 8
+# Give up after this many consecutive errors (without any acknowledged frame between them).
+MAX_RETRIES = 16
+# The device is considered lost after this many consecutive acknowledgement timeouts (no answer at all, not even
+# to the padding that completes a damaged frame). TimeoutError is raised then, so the upload can be resumed.
+MAX_ACK_TIMEOUTS = 3
+FRAME_MAGIC = 0xa5
+FRAME_HEADER = struct.Struct('<BHI')
+# Checksum sync: SHA-256 hashes of the files on the device are cached in this file, with their size and mtime.
+MANIFEST_PATH = "/.espsyncer_manifest"
+# Cached hashes are only used for files modified after this year, by the clock of the device. Without a set clock
+# (e.g. ESP8266 after boot), mtimes start again from the epoch on every boot, so a changed file can have the same
+# size and mtime as before.
+MANIFEST_MIN_YEAR = 2020
+# Hash of directories in the result of _sy_hashes
+DIR_HASH = ""
+# Resumable uploads (raw protocol): files are written into path + PART_SUFFIX, and renamed when complete. When an
+# upload is interrupted, the next one continues from the end of the partial file (if its hash is right). When the
+# device stops responding during an upload, it is reset and the upload is resumed, at most RESUME_ATTEMPTS times.
+PART_SUFFIX = ".sypart"
+RESUME_ATTEMPTS = 2
+# Snapshot archives start with SNAPSHOT_MAGIC, followed by entries. Each entry is a type (b'D' for directories,
+# b'F' for files, b'E' at the end), and the 2 byte length of the name, followed by the name. Names are relative
+# to the parent of the saved path. File entries continue with a 4 byte size, the data, and the SHA-256 digest
+# of the data. All numbers are little endian.
+SNAPSHOT_MAGIC = b'ESPSNAP1'
+SNAPSHOT_ENTRY = struct.Struct('<cH')
+SNAPSHOT_SIZE = struct.Struct('<I')
+SNAPSHOT_DIGEST_SIZE = 32
+# Compressed uploads: raw deflate with a small window, so the device can decompress it with little RAM.
+# The window is the largest one that fits into 1/HEAP_WINDOW_RATIO of the free heap of the device.
+MIN_COMPRESS_WBITS = 9
+MAX_COMPRESS_WBITS = 12
+HEAP_WINDOW_RATIO = 8
+COMPRESS_LEVEL = 9
+# These are sent without compression: files that are compressed already, and files that would not shrink
+# below COMPRESS_MAX_RATIO of their size.
+COMPRESS_SKIP_EXTENSIONS = (".gz", ".zip", ".png", ".jpg", ".jpeg", ".ico")
+COMPRESS_MAX_RATIO = 0.9
+# Baud rate negotiation: the REPL UART of the device is switched to a higher baud rate for file transfers, and
+# it is switched back at the end of the session. These rates are tried in this order, when "auto" is given.
+REPL_UART_ID = 0
+FAST_BAUD_RATES = [921600, 460800, 230400]
+# The device waits this long (ms) for BAUD_SYNC and BAUD_GO, then it falls back to the original baud rate.
+BAUD_SWITCH_TIMEOUT = 500
+BAUD_SYNC = b'<sy-sync>'
+BAUD_ACK = b'<sy-ack>'
+BAUD_GO = b'<sy-go>'
+# Used when the device does not support raw-paste mode: send this many bytes, then wait a bit.
+RAW_CHUNK_SIZE = 256
+RAW_CHUNK_DELAY = 0.01
+# communicate() waits this long (seconds) for input from stdin or from the device.
+COMMUNICATE_SELECT_TIMEOUT = 0.1
+# The execute command takes it as a reset of the device, when it does not get anything for this long (seconds)
+# before the end of the execution. After machine.reset(), the device talks at its boot baud rate, or runs main.py.
+EXECUTE_RESET_TIMEOUT = 2.0
+
+# Friendly REPL: every command is echoed back, and file data is sent with repr() in small pieces.
+PROTOCOL_REPL = "repl"
+# Raw REPL: an agent is pushed to the device in raw-paste mode, and file data is streamed through it
+# in binary frames.
+PROTOCOL_RAW = "raw"
+PROTOCOLS = [PROTOCOL_RAW, PROTOCOL_REPL]
 
 # http://www.physics.udel.edu/~watson/scen103/ascii.html
 CTRL_A = b'\x01'
@@ -41,12 +140,516 @@ class Commands(Enum):
     EXECUTE_FILE = "execute_file"
     EXECUTE = "execute"
     LIVE_TEST_FILE = "live_test_file"
+    BATCH = "batch"
+    SNAPSHOT = "snapshot"
+    RESTORE = "restore"
 
 
 VALID_COMMANDS = []
 for item in Commands:
     VALID_COMMANDS.append(item.value)
 
+# Commands that can be used in a batch
+BATCH_COMMANDS = [
+    Commands.LS.value, Commands.MKDIR.value, Commands.MAKEDIRS.value, Commands.RMTREE.value,
+    Commands.UPLOAD.value, Commands.DOWNLOAD.value, Commands.EXECUTE.value, Commands.SNAPSHOT.value,
+    Commands.RESTORE.value,
+]
+
+# This code is pushed to the device once per session, in raw protocol mode.
+#
+# _sy_put(path, size, max_frame, wbits, file_size, offset, final) receives a file of size bytes. Each frame starts with a 7 byte
+#   header: FRAME_MAGIC, 2 byte length and 4 byte CRC32 of the data (little endian), followed by the data.
+#   The agent sends b'R' when it is ready to receive, and b'A' after each good frame. On a bad frame, it drops
+#   all input until the line is idle, and sends b'N' + 4 byte offset: the host must continue from there.
+#   Keyboard interrupt is disabled during the transfer, so the data is binary safe. When wbits is not zero,
+#   then the data is a raw deflate stream with a window of 2**wbits bytes. It is decompressed on the fly with
+#   DecompIO, and the result must be file_size bytes long. When offset is not zero, the data is appended to the
+#   existing file, that must be offset bytes long. The file is flushed after every 16K, so most of it is kept
+#   when the transfer is interrupted. When final is given, then the file is renamed to final at the end.
+#   _SyRx is the receiving side: a stream of the data in the good frames.
+# _sy_get(path, frame_size) sends a file: b'R', then frames with a 2 byte length and 4 byte CRC32 header,
+#   then an empty frame.
+# _sy_mem() returns the free heap.
+AGENT = """
+import os
+import sys
+import gc
+import io
+import select
+import micropython
+import ubinascii
+_sy_in = sys.stdin.buffer
+_sy_out = sys.stdout.buffer
+_sy_poll = select.poll()
+_sy_poll.register(sys.stdin, select.POLLIN)
+
+
+def _sy_readinto(mv):
+    got = 0
+    while got < len(mv):
+        got += _sy_in.readinto(mv[got:])
+
+
+def _sy_mem():
+    gc.collect()
+    return gc.mem_free()
+
+
+def _sy_drain():
+    while _sy_poll.poll(100):
+        _sy_in.read(1)
+
+
+class _SyRx(io.IOBase):
+    def __init__(self, size, max_frame):
+        self.size = size
+        self.max_frame = max_frame
+        self.mv = memoryview(bytearray(max_frame))
+        self.hdr = memoryview(bytearray(7))
+        self.got = 0
+        self.pos = 0
+        self.cnt = 0
+
+    def frame(self):
+        hdr = self.hdr
+        while True:
+            _sy_readinto(hdr)
+            cnt = hdr[1] | hdr[2] << 8
+            if hdr[0] == 0xa5 and 0 < cnt <= self.max_frame:
+                _sy_readinto(self.mv[:cnt])
+                if ubinascii.crc32(self.mv[:cnt]) == hdr[3] | hdr[4] << 8 | hdr[5] << 16 | hdr[6] << 24:
+                    self.got += cnt
+                    _sy_out.write(b'A')
+                    return cnt
+            _sy_drain()
+            _sy_out.write(b'N' + self.got.to_bytes(4, 'little'))
+
+    def readinto(self, buf):
+        if self.pos >= self.cnt:
+            if self.got >= self.size:
+                return 0
+            self.cnt = self.frame()
+            self.pos = 0
+        cnt = min(len(buf), self.cnt - self.pos)
+        buf[:cnt] = self.mv[self.pos:self.pos + cnt]
+        self.pos += cnt
+        return cnt
+
+
+def _sy_put(path, size, max_frame, wbits=0, file_size=None, offset=0, final=None):
+    rx = _SyRx(size, max_frame)
+    written = flushed = 0
+    with open(path, 'ab' if offset else 'wb') as fout:
+        micropython.kbd_intr(-1)
+        try:
+            _sy_out.write(b'R')
+            if wbits:
+                try:
+                    import zlib
+                except ImportError:
+                    import uzlib as zlib
+                buf = bytearray(512)
+                mv = memoryview(buf)
+                dec = zlib.DecompIO(rx, -wbits)
+                while True:
+                    cnt = dec.readinto(buf)
+                    if not cnt:
+                        break
+                    fout.write(mv[:cnt])
+                    written += cnt
+                    if written - flushed >= 16384:
+                        fout.flush()
+                        flushed = written
+                while rx.readinto(buf):
+                    pass
+            else:
+                while rx.got < size:
+                    cnt = rx.frame()
+                    fout.write(rx.mv[:cnt])
+                    written += cnt
+                    if written - flushed >= 16384:
+                        fout.flush()
+                        flushed = written
+        finally:
+            micropython.kbd_intr(3)
+    if file_size is not None and written != file_size:
+        raise ValueError('size mismatch %d != %d' % (written, file_size))
+    if final:
+        try:
+            os.rename(path, final)
+        except OSError:
+            # Some file systems (FAT) cannot rename over an existing file.
+            os.remove(final)
+            os.rename(path, final)
+
+
+def _sy_get(path, frame_size):
+    buf = bytearray(frame_size)
+    mv = memoryview(buf)
+    with open(path, 'rb') as fin:
+        _sy_out.write(b'R')
+        while True:
+            cnt = fin.readinto(buf)
+            if not cnt:
+                break
+            _sy_out.write(bytes((cnt & 255, cnt >> 8)))
+            _sy_out.write(ubinascii.crc32(mv[:cnt]).to_bytes(4, 'little'))
+            _sy_out.write(mv[:cnt])
+    _sy_out.write(bytes(6))
+"""
+
+# Agent extensions are pushed on demand, after the agent.
+#
+# _sy_hashes(paths) returns the SHA-256 hex digests of the given files: None for missing files and DIR_HASH for
+#   directories. Hashes are taken from the manifest when the size and the mtime of the file did not change,
+#   unless rehash is set. Files with an mtime before MANIFEST_MIN_YEAR are always hashed, and left out of the
+#   manifest.
+# _sy_hash_tree(path, rehash) returns a dict of path -> hex digest for all files below path, except the partial
+#   files of interrupted uploads.
+# _sy_part(path) returns the size and the hex digest of a partial file, or None when it does not exist.
+# _sy_mf_save(updates, drops) stores the hashes of the uploaded files (a dict of path -> hex digest) in the
+#   manifest, forgets the dropped paths (files that were written without a hash) and the files that do not exist
+#   anymore, and writes the manifest atomically (when it changed): into a temporary file, that is renamed over
+#   the old one.
+AGENT_HASH = """
+import os
+import json
+import time
+import uhashlib
+_sy_mf = None
+_sy_mf_dirty = False
+_sy_min_mtime = (%(min_year)d - time.gmtime(0)[0]) * 31557600
+
+
+def _sy_mf_load():
+    global _sy_mf
+    if _sy_mf is None:
+        try:
+            with open(%(manifest)r) as fin:
+                _sy_mf = json.load(fin)
+        except (OSError, ValueError):
+            _sy_mf = {}
+    return _sy_mf
+
+
+def _sy_sha(path):
+    h = uhashlib.sha256()
+    buf = bytearray(512)
+    mv = memoryview(buf)
+    with open(path, 'rb') as fin:
+        while True:
+            cnt = fin.readinto(buf)
+            if not cnt:
+                break
+            h.update(mv[:cnt])
+    return ubinascii.hexlify(h.digest()).decode()
+
+
+def _sy_hash(path, st, rehash):
+    global _sy_mf_dirty
+    mf = _sy_mf_load()
+    ent = mf.get(path)
+    if st[8] < _sy_min_mtime:
+        if ent:
+            del mf[path]
+            _sy_mf_dirty = True
+        return _sy_sha(path)
+    if rehash or not ent or ent[0] != st[6] or ent[1] != st[8]:
+        ent = mf[path] = [st[6], st[8], _sy_sha(path)]
+        _sy_mf_dirty = True
+    return ent[2]
+
+
+def _sy_hashes(paths, rehash):
+    result = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            result.append(None)
+            continue
+        if st[0] & 0x4000:
+            result.append(%(dir_hash)r)
+        else:
+            result.append(_sy_hash(path, st, rehash))
+    return result
+
+
+def _sy_part(path):
+    try:
+        return os.stat(path)[6], _sy_sha(path)
+    except OSError:
+        return None
+
+
+def _sy_hash_tree(path, rehash):
+    result = {}
+    st = os.stat(path)
+    if st[0] & 0x4000:
+        for item in os.ilistdir(path):
+            result.update(_sy_hash_tree(path.rstrip('/') + '/' + item[0], rehash))
+    elif path != %(manifest)r and not path.endswith(%(part_suffix)r):
+        result[path] = _sy_hash(path, st, rehash)
+    return result
+
+
+def _sy_mf_save(updates, drops):
+    global _sy_mf_dirty
+    mf = _sy_mf_load()
+    for path in drops:
+        if path in mf:
+            del mf[path]
+            _sy_mf_dirty = True
+    for path in updates:
+        st = os.stat(path)
+        if st[8] >= _sy_min_mtime:
+            mf[path] = [st[6], st[8], updates[path]]
+            _sy_mf_dirty = True
+        elif path in mf:
+            del mf[path]
+            _sy_mf_dirty = True
+    for path in list(mf):
+        try:
+            os.stat(path)
+        except OSError:
+            del mf[path]
+            _sy_mf_dirty = True
+    if _sy_mf_dirty:
+        tmp = %(manifest)r + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(mf, fout)
+        try:
+            os.rename(tmp, %(manifest)r)
+        except OSError:
+            # Some file systems (FAT) cannot rename over an existing file.
+            os.remove(%(manifest)r)
+            os.rename(tmp, %(manifest)r)
+        _sy_mf_dirty = False
+    return len(mf)
+""" % dict(manifest=MANIFEST_PATH, dir_hash=DIR_HASH, part_suffix=PART_SUFFIX, min_year=MANIFEST_MIN_YEAR)
+
+# _sy_walk(paths) returns (path, isdir, size) for the given paths and everything below them. Missing paths
+#   are left out.
+# _sy_rmtree(path) deletes path recursively, and returns the deleted (path, isdir) pairs.
+# _sy_makedirs(paths) creates the given directories with their parents. Returns (created, conflict), where
+#   conflict is the first path that exists but it is not a directory (or None).
+AGENT_FS = """
+import os
+
+
+def _sy_walk_dir(path, result):
+    for item in os.ilistdir(path):
+        fpath = path.rstrip('/') + '/' + item[0]
+        if item[1] & 0x4000:
+            result.append((fpath, True, 0))
+            _sy_walk_dir(fpath, result)
+        elif len(item) > 3:
+            result.append((fpath, False, item[3]))
+        else:
+            result.append((fpath, False, os.stat(fpath)[6]))
+
+
+def _sy_walk(paths):
+    result = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st[0] & 0x4000:
+            result.append((path, True, 0))
+            _sy_walk_dir(path, result)
+        else:
+            result.append((path, False, st[6]))
+    return result
+
+
+def _sy_rmtree(path, result=None):
+    if result is None:
+        result = []
+    if os.stat(path)[0] & 0x4000:
+        for fname in sorted(os.listdir(path)):
+            _sy_rmtree(path.rstrip('/') + '/' + fname, result)
+        if path != '/':
+            os.rmdir(path)
+            result.append((path, True))
+    else:
+        os.remove(path)
+        result.append((path, False))
+    return result
+
+
+def _sy_makedirs(paths):
+    created = []
+    for path in paths:
+        parts = path.strip('/').split('/')
+        for idx in range(len(parts)):
+            dpath = '/' + '/'.join(parts[:idx + 1])
+            try:
+                st = os.stat(dpath)
+            except OSError:
+                os.mkdir(dpath)
+                created.append(dpath)
+                continue
+            if not st[0] & 0x4000:
+                return created, dpath
+    return created, None
+"""
+
+# _sy_snapshot(path, strip, frame_size) sends path (recursively) in the format of snapshot archives, without
+#   SNAPSHOT_MAGIC: b'R', then the entries. Names are the paths without their first strip characters. Instead of
+#   the size, file data is sent in the same frames as in _sy_get (terminated by an empty frame), then the digest.
+#   The manifest is left out.
+# _sy_restore(dst, size, max_frame, wbits) receives a snapshot archive (without SNAPSHOT_MAGIC) of size bytes, in
+#   the same way as _sy_put, and extracts it into the dst directory in a single pass. Returns the number of
+#   restored files, and the list of files that had a bad digest.
+AGENT_SNAPSHOT = """
+import os
+import uhashlib
+
+
+def _sy_snap_head(kind, name):
+    name = name.encode()
+    _sy_out.write(kind + len(name).to_bytes(2, 'little') + name)
+
+
+def _sy_snap_file(path, name, buf, mv):
+    _sy_snap_head(b'F', name)
+    h = uhashlib.sha256()
+    with open(path, 'rb') as fin:
+        while True:
+            cnt = fin.readinto(buf)
+            if not cnt:
+                break
+            h.update(mv[:cnt])
+            _sy_out.write(bytes((cnt & 255, cnt >> 8)))
+            _sy_out.write(ubinascii.crc32(mv[:cnt]).to_bytes(4, 'little'))
+            _sy_out.write(mv[:cnt])
+    _sy_out.write(bytes(6))
+    _sy_out.write(h.digest())
+
+
+def _sy_snap(path, strip, buf, mv):
+    if os.stat(path)[0] & 0x4000:
+        if len(path) > strip:
+            _sy_snap_head(b'D', path[strip:])
+        for fname in sorted(os.listdir(path)):
+            _sy_snap(path.rstrip('/') + '/' + fname, strip, buf, mv)
+    elif path not in %(skip)r:
+        _sy_snap_file(path, path[strip:], buf, mv)
+
+
+def _sy_snapshot(path, strip, frame_size):
+    buf = bytearray(frame_size)
+    mv = memoryview(buf)
+    _sy_out.write(b'R')
+    _sy_snap(path, strip, buf, mv)
+    _sy_out.write(b'E' + bytes(2))
+
+
+def _sy_rx_read(src, mv):
+    got = 0
+    while got < len(mv):
+        cnt = src.readinto(mv[got:])
+        if not cnt:
+            raise EOFError
+        got += cnt
+
+
+def _sy_restore(dst, size, max_frame, wbits=0):
+    rx = _SyRx(size, max_frame)
+    src = rx
+    if wbits:
+        try:
+            import zlib
+        except ImportError:
+            import uzlib as zlib
+        src = zlib.DecompIO(rx, -wbits)
+    buf = bytearray(512)
+    mv = memoryview(buf)
+    files, bad = 0, []
+    micropython.kbd_intr(-1)
+    try:
+        _sy_out.write(b'R')
+        while True:
+            _sy_rx_read(src, mv[:3])
+            kind, cnt = buf[0], buf[1] | buf[2] << 8
+            if kind == 69:
+                break
+            _sy_rx_read(src, mv[:cnt])
+            path = dst.rstrip('/') + '/' + bytes(mv[:cnt]).decode()
+            if kind == 68:
+                try:
+                    os.mkdir(path)
+                except OSError:
+                    if not os.stat(path)[0] & 0x4000:
+                        raise
+                continue
+            _sy_rx_read(src, mv[:4])
+            left = buf[0] | buf[1] << 8 | buf[2] << 16 | buf[3] << 24
+            h = uhashlib.sha256()
+            with open(path, 'wb') as fout:
+                while left:
+                    cnt = min(left, len(buf))
+                    _sy_rx_read(src, mv[:cnt])
+                    h.update(mv[:cnt])
+                    fout.write(mv[:cnt])
+                    left -= cnt
+            _sy_rx_read(src, mv[:32])
+            files += 1
+            if h.digest() != bytes(mv[:32]):
+                bad.append(path)
+        while rx.readinto(buf):
+            pass
+    finally:
+        micropython.kbd_intr(3)
+    return files, bad
+""" % dict(skip=(MANIFEST_PATH, MANIFEST_PATH + ".tmp"))
+
+# Switch the REPL UART of the device to another baud rate. With handshake, the host must send BAUD_SYNC at
+# the new rate, the device answers BAUD_ACK, and then the host must send BAUD_GO. Otherwise the device goes
+# back to the old baud rate, so the session can continue.
+BAUD_SWITCH_CODE = """
+import sys
+import time
+import select
+import machine
+
+
+def _sy_wait(pattern, ms):
+    poll = select.poll()
+    poll.register(sys.stdin, select.POLLIN)
+    buf = b''
+    started = time.ticks_ms()
+    while time.ticks_diff(time.ticks_ms(), started) < ms:
+        if poll.poll(10):
+            buf = (buf + sys.stdin.buffer.read(1))[-len(pattern):]
+            if buf == pattern:
+                return True
+    return False
+
+
+time.sleep_ms(20)
+machine.UART(%(uart)d, %(new)d)
+if %(handshake)r:
+    if _sy_wait(%(sync)r, %(timeout)d):
+        sys.stdout.buffer.write(%(ack)r)
+        if not _sy_wait(%(go)r, %(timeout)d):
+            machine.UART(%(uart)d, %(old)d)
+    else:
+        machine.UART(%(uart)d, %(old)d)
+else:
+    # Give time to the host to switch, before the end of the output is sent.
+    time.sleep_ms(300)
+"""
+
+AGENT_EXTENSIONS = {
+    "hash": AGENT_HASH,
+    "fs": AGENT_FS,
+    "snapshot": AGENT_SNAPSHOT,
+}
+
 
 class StatResult:
     def __init__(self, st):
@@ -61,6 +664,43 @@ class StatResult:
         self.size = st[6]
 
 
+def iter_snapshot(data):
+    """Parse a snapshot archive, and check the digests of its files.
+
+    :param data: Contents of the archive
+    :return: A generator of (kind, name, file data) for the entries. kind is b'D' or b'F', and file data
+        is None for directories.
+    """
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("Not a snapshot archive")
+    view = memoryview(data)
+    pos = len(SNAPSHOT_MAGIC)
+    try:
+        while True:
+            kind, size = SNAPSHOT_ENTRY.unpack_from(data, pos)
+            pos += SNAPSHOT_ENTRY.size
+            if kind == b'E':
+                break
+            name = bytes(view[pos:pos + size]).decode('utf-8')
+            pos += size
+            if kind == b'D':
+                yield kind, name, None
+            elif kind == b'F':
+                size = SNAPSHOT_SIZE.unpack_from(data, pos)[0]
+                pos += SNAPSHOT_SIZE.size
+                content = bytes(view[pos:pos + size])
+                pos += size
+                digest = bytes(view[pos:pos + SNAPSHOT_DIGEST_SIZE])
+                pos += SNAPSHOT_DIGEST_SIZE
+                if hashlib.sha256(content).digest() != digest:
+                    raise ValueError("Checksum error in snapshot archive: %s" % name)
+                yield kind, name, content
+            else:
+                raise ValueError("Invalid entry in snapshot archive: %s" % repr(kind))
+    except struct.error:
+        raise ValueError("Truncated snapshot archive")
+
+
 class EspException(Exception):
     def __init__(self, message):
         self.message = message
@@ -77,21 +717,92 @@ class EspException(Exception):
 
 
 class EspSyncer:
-    def __init__(self, ser: serial.Serial, timeout, logger):
+    def __init__(self, ser: serial.Serial, timeout, logger, protocol=PROTOCOL_RAW, frame_size=DEFAULT_FRAME_SIZE,
+                 window=DEFAULT_WINDOW, compress=False, reset_mode=RESET_HARD):
         self.ser = ser
         self.timeout = timeout
-        self.buffer = b''
+        # Received, but not processed data.
+        self.buffer = bytearray()
         self.logger = logger
+        self.protocol = protocol
+        self.frame_size = frame_size
+        self.window = window
+        self.compress = compress
+        self.reset_mode = reset_mode
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.compress_wbits = MIN_COMPRESS_WBITS
         self.os_imported = False
-
-    def reset(self, esp32r0_delay=False):
+        self.raw_mode = False
+        self.raw_paste = None
+        self.agent_loaded = False
+        self.agent_extensions = set()
+        self.remote_hashes = {}
+        self.remote_tree = None
+        self.remote_children = None
+        self.manifest_updates = {}
+        # Paths written without a hash, their entries are removed from the manifest by save_manifest.
+        self.manifest_drops = set()
+        self.bytes_transferred = 0
+        self.retries = 0
+        # Telemetry (see measure): bytes on the serial line, turnarounds (data was sent, then the host had to wait
+        # for an answer), and the time spent waiting for data from the device.
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.round_trips = 0
+        self.wait_time = 0.0
+        self.turnaround = False
+        self.phase_stats = []
+        self.file_stats = []
+        self.initial_baudrate = ser.baudrate
+        # Baud rates given to negotiate_baudrate, they are negotiated again after a reset during a transfer.
+        self.fast_baudrates = []
+        # The executed code has reset the device (see execute), it has to be reset again before the next command.
+        self.rebooted = False
+
+    def reset(self, esp32r0_delay=False, mode=None):
+        """Reset the device, and wait for the prompt.
+
+        :param mode: RESET_HARD or RESET_SOFT, the default is the reset mode of the session.
+        """
         # See https://github.com/espressif/esptool/blob/master/esptool.py#L411 - these are active low
 
-        self.ser.setDTR(False)  # IO0=HIGH
-        self.ser.setRTS(True)  # EN=LOW, chip in reset
-        time.sleep(0.5)
-        self.ser.setRTS(False)  # EN=LOW, chip in reset
+        if (mode or self.reset_mode) == RESET_SOFT:
+            # Interrupt the running program, leave raw REPL, then soft reboot. The REPL UART keeps its baud rate.
+            self.send(CTRL_C + CTRL_C + CTRL_B)
+            time.sleep(0.2)
+            self.ser.reset_input_buffer()
+            self.buffer.clear()
+            self.send(CTRL_D)
+            self.recv(SOFT_REBOOT_MESSAGE)
+        else:
+            # The device boots with its default baud rate
+            if self.ser.baudrate != self.initial_baudrate:
+                self.ser.baudrate = self.initial_baudrate
+            self.ser.setDTR(False)  # IO0=HIGH
+            self.ser.setRTS(True)  # EN=LOW, chip in reset
+            time.sleep(0.5)
+            self.ser.setRTS(False)  # EN=LOW, chip in reset
         data = self.recv(b">>>")
+        self.os_imported = False
+        self.raw_mode = False
+        self.agent_loaded = False
+        self.agent_extensions = set()
+        self.rebooted = False
+        if self.protocol == PROTOCOL_RAW:
+            self.enter_raw_mode()
+
+    def interrupt(self):
+        """Stop the running program with Ctrl-C, and wait for the prompt. Unlike reset, this keeps the state of
+        the interpreter: imported modules, globals and the agent."""
+        self.send(CTRL_C + CTRL_C)
+        time.sleep(0.2)
+        self.ser.reset_input_buffer()
+        self.buffer.clear()
+        self.send(EOL)
+        self.recv(DEFAULT_TERMINATOR)
+        self.raw_mode = False
+        if self.protocol == PROTOCOL_RAW:
+            self.enter_raw_mode()
 
     def send(self, data):
         """Send data to MicroPython prompt.
@@ -100,23 +811,111 @@ class EspSyncer:
         idx = 0
         while idx < len(data):
             idx += self.ser.write(data[idx:])
+        self.bytes_sent += len(data)
+        self.turnaround = True
+
+    @contextlib.contextmanager
+    def _port_timeout(self, timeout):
+        """Lower the timeout of the serial port while waiting for something, that has a shorter timeout."""
+        saved_timeout = self.ser.timeout
+        if timeout is not None and (saved_timeout is None or timeout < saved_timeout):
+            self.ser.timeout = timeout
+        try:
+            yield
+        finally:
+            if self.ser.timeout != saved_timeout:
+                self.ser.timeout = saved_timeout
+
+    def _read_into_buffer(self, size=1):
+        """Read at least size bytes (or less on timeout), and everything else that is already waiting."""
+        if self.turnaround:
+            self.round_trips += 1
+            self.turnaround = False
+        started = time.perf_counter()
+        data = self.ser.read(max(size, self.ser.in_waiting))
+        self.wait_time += time.perf_counter() - started
+        self.bytes_received += len(data)
+        self.buffer += data
+
+    def counters(self):
+        """Current values of the telemetry counters."""
+        return {
+            "bytes": self.bytes_transferred,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "round_trips": self.round_trips,
+            "wait_time": self.wait_time,
+            "retries": self.retries,
+        }
+
+    @contextlib.contextmanager
+    def measure(self, records, **record):
+        """Measure the counters while the block runs, and append them to records (phase_stats or file_stats).
+
+        The record is a dict of the keyword arguments, the block can add more items to it. The counters are the
+        increments during the block: bytes of file data, bytes sent and received on the serial line, round trips,
+        time spent waiting for the device, and retries. They are completed with the duration, the throughput of
+        file data and the error, if the block raised an exception. Measurements can be nested.
+        """
+        start = self.counters()
+        started = time.perf_counter()
+        record["error"] = None
+        # Appended first, so records are in the order they were started (outer phases before inner ones).
+        records.append(record)
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = "%s: %s" % (e.__class__.__name__, e)
+            raise
+        finally:
+            record["duration"] = time.perf_counter() - started
+            for name, value in self.counters().items():
+                record[name] = value - start[name]
+            record["throughput"] = record["bytes"] / record["duration"] if record["duration"] > 0 else 0.0
+
+    def _take(self, size, skip=0):
+        """Remove size + skip bytes from the beginning of the buffer, and return the first size bytes."""
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size + skip]
+        return chunk
 
-    def recv(self, terminator=DEFAULT_TERMINATOR):
+    def recv(self, terminator=DEFAULT_TERMINATOR, timeout=None):
         """Receive data from MicroPython prompt.
 
-        This receives data until the given terminator."""
-        started = time.time()
-        while terminator not in self.buffer:
-            data = self.ser.read()
-            self.buffer += data
-            elapsed = time.time() - started
-            if self.timeout is not None and elapsed > self.timeout:
-                raise TimeoutError
+        This receives data until the given terminator.
 
-        idx = self.buffer.find(terminator)
-        chunk = self.buffer[:idx]
-        self.buffer = self.buffer[idx + len(terminator):]
-        return chunk
+        :param timeout: Use this timeout instead of the default."""
+        if timeout is None:
+            timeout = self.timeout
+        started = time.time()
+        # Only the new data is searched for the terminator (and the end of the old data, where it might start).
+        searched = 0
+        with self._port_timeout(timeout):
+            while True:
+                idx = self.buffer.find(terminator, searched)
+                if idx >= 0:
+                    break
+                searched = max(0, len(self.buffer) - len(terminator) + 1)
+                self._read_into_buffer()
+                elapsed = time.time() - started
+                if timeout is not None and elapsed > timeout:
+                    raise TimeoutError
+        return self._take(idx, len(terminator))
+
+    def recv_exactly(self, size, timeout=None):
+        """Receive exactly size bytes.
+
+        :param timeout: Use this timeout instead of the default."""
+        if timeout is None:
+            timeout = self.timeout
+        started = time.time()
+        with self._port_timeout(timeout):
+            while len(self.buffer) < size:
+                self._read_into_buffer(size - len(self.buffer))
+                elapsed = time.time() - started
+                if timeout is not None and elapsed > timeout:
+                    raise TimeoutError
+        return self._take(size)
 
     def dump(self):
         while True:
@@ -131,7 +930,411 @@ class EspSyncer:
     def enter_raw_mode(self):
         # http://www.physics.udel.edu/~watson/scen103/ascii.html
         self.send(CTRL_A)
-        self.recv(terminator=b'raw REPL; CTRL-B to exit')
+        self.recv(terminator=RAW_REPL_PROMPT)
+        self.raw_mode = True
+
+    def exit_raw_mode(self):
+        self.send(CTRL_B)
+        self.recv(terminator=DEFAULT_TERMINATOR)
+        self.raw_mode = False
+
+    def _raw_paste_write(self, data):
+        """Send code in raw-paste mode, respecting the flow control window of the device."""
+        window_size = struct.unpack('<H', self.recv_exactly(2))[0]
+        window_remain = window_size
+        idx = 0
+        while idx < len(data):
+            while window_remain == 0 or self.buffer or self.ser.in_waiting:
+                flow = self.recv_exactly(1)
+                if flow == b'\x01':
+                    window_remain += window_size
+                elif flow == CTRL_D:
+                    # The device has aborted the paste, most likely because of a syntax error.
+                    self.send(CTRL_D)
+                    return
+                else:
+                    raise EspException("Unexpected data during raw paste: %s" % repr(flow))
+            chunk = data[idx:idx + window_remain]
+            self.send(chunk)
+            window_remain -= len(chunk)
+            idx += len(chunk)
+        self.send(CTRL_D)
+        self.recv(CTRL_D)
+
+    def exec_raw_start(self, code):
+        """Start executing code in raw mode, but do not wait for the result.
+
+        The output of the code can be read with recv/recv_exactly, and then exec_raw_follow() must be called."""
+        if isinstance(code, str):
+            code = code.encode('utf-8')
+        if self.raw_paste is not False:
+            self.send(CTRL_E + b'A' + CTRL_A)
+            answer = self.recv_exactly(2)
+            if answer == b'R\x01':
+                self.raw_paste = True
+                self._raw_paste_write(code)
+                return
+            elif answer != b'R\x00':
+                # Very old firmware, it does not know about raw-paste mode.
+                self.recv(RAW_REPL_PROMPT)
+            self.raw_paste = False
+        for idx in range(0, len(code), RAW_CHUNK_SIZE):
+            self.send(code[idx:idx + RAW_CHUNK_SIZE])
+            time.sleep(RAW_CHUNK_DELAY)
+        self.send(CTRL_D)
+        answer = self.recv_exactly(2)
+        if answer != b'OK':
+            raise EspException("Could not execute code in raw mode: %s" % repr(answer))
+
+    def exec_raw_follow(self):
+        """Wait until the code started with exec_raw_start() finishes, and return its output."""
+        out = self.recv(CTRL_D)
+        err = self.recv(CTRL_D)
+        self.recv(b'>')
+        if err:
+            raise EspException(err.decode('utf-8').replace('\r', '').strip())
+        return out.decode('utf-8')
+
+    def exec_raw(self, code):
+        """Execute code in raw mode, and return its output."""
+        self.exec_raw_start(code)
+        return self.exec_raw_follow()
+
+    def _take_raw_result(self):
+        """Remove the output and the error of a finished raw execution from the buffer, and return them.
+
+        :return: None when the end of the execution is not in the buffer (yet). Data received at another baud rate
+            can contain CTRL_D too, but it is not taken for the end, unless it is followed by the prompt, and the
+            output and the error are text.
+        """
+        out_end = self.buffer.find(CTRL_D)
+        err_end = self.buffer.find(CTRL_D, out_end + 1) if out_end >= 0 else -1
+        if err_end < 0 or self.buffer[err_end + 1:err_end + 2] != b'>':
+            return None
+        try:
+            out = self.buffer[:out_end].decode('utf-8')
+            err = self.buffer[out_end + 1:err_end].decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        del self.buffer[:err_end + 2]
+        return out, err
+
+    def execute(self, code):
+        """Execute code that may reset the device (e.g. machine.reset()), and return its output.
+
+        In raw mode, the device is taken as reset when it shows the prompt of the friendly REPL before the end of
+        the execution, or it does not send anything for EXECUTE_RESET_TIMEOUT seconds. Then the serial port is
+        switched back to the initial baud rate, nothing is sent to the device (it may be running main.py), and
+        self.rebooted is set. The output is everything that was received, with the messages of the boot, or up to
+        the first byte that is not text, when the port was at another baud rate.
+        """
+        if not self.raw_mode:
+            return self(code, expect_echo=False)
+        self.exec_raw_start(code)
+        started = last_data = time.time()
+        silence = EXECUTE_RESET_TIMEOUT if self.timeout is None else min(EXECUTE_RESET_TIMEOUT, self.timeout)
+        with self._port_timeout(COMMUNICATE_SELECT_TIMEOUT):
+            while True:
+                size = len(self.buffer)
+                self._read_into_buffer()
+                now = time.time()
+                if len(self.buffer) > size:
+                    last_data = now
+                result = self._take_raw_result()
+                if result is not None:
+                    out, err = result
+                    if err:
+                        raise EspException(err.replace('\r', '').strip())
+                    return out
+                if self.buffer.endswith(DEFAULT_TERMINATOR) or now - last_data > silence:
+                    break
+                if self.timeout is not None and now - started > self.timeout:
+                    raise TimeoutError
+        output = self._take(len(self.buffer)).decode('utf-8', errors='replace')
+        self.logger("REBOOTED\n")
+        if self.ser.baudrate != self.initial_baudrate:
+            # What the device sent after the reset is not readable at this baud rate.
+            for idx, char in enumerate(output):
+                if not (char.isprintable() or char in '\r\n\t'):
+                    output = output[:idx]
+                    break
+            self._switch_port(self.initial_baudrate)
+        self.os_imported = False
+        self.raw_mode = False
+        self.agent_loaded = False
+        self.agent_extensions = set()
+        self.rebooted = True
+        return output
+
+    def _baud_switch_code(self, baudrate, handshake):
+        return BAUD_SWITCH_CODE % dict(uart=REPL_UART_ID, old=self.ser.baudrate, new=baudrate,
+                                       handshake=handshake, timeout=BAUD_SWITCH_TIMEOUT,
+                                       sync=BAUD_SYNC, ack=BAUD_ACK, go=BAUD_GO)
+
+    def _switch_port(self, baudrate):
+        """Change the baud rate of the serial port, after the device had time to change its own."""
+        self.ser.flush()
+        time.sleep(0.1)
+        self.ser.baudrate = baudrate
+        self.ser.reset_input_buffer()
+        self.buffer.clear()
+
+    def probe(self):
+        """Check that the link works, by echoing a random token."""
+        token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        return self.exec_raw("print(%s)" % repr(token)).strip() == token
+
+    def _resync(self, baudrates, wait=True):
+        """Find the raw REPL again after a failed baud rate switch, trying the given baud rates.
+
+        :param wait: Wait until the device gives up waiting for the handshake."""
+        if wait:
+            time.sleep(2 * BAUD_SWITCH_TIMEOUT / 1000.0)
+        for baudrate in baudrates:
+            self._switch_port(baudrate)
+            # Stop whatever is running, and go back to the friendly REPL
+            self.send(CTRL_C + CTRL_C + CTRL_B)
+            try:
+                self.recv(DEFAULT_TERMINATOR, timeout=1.0)
+                self.enter_raw_mode()
+                return
+            except TimeoutError:
+                pass
+        raise EspException("Lost connection to the device while changing the baud rate, please reset it.")
+
+    def switch_baudrate(self, baudrate):
+        """Switch the REPL UART of the device, and the serial port to the given baud rate, in raw mode.
+
+        :return: True on success. On failure, both sides are switched back to the current baud rate.
+        """
+        old = self.ser.baudrate
+        if baudrate == old:
+            return True
+        self.exec_raw_start(self._baud_switch_code(baudrate, True))
+        self._switch_port(baudrate)
+        self.send(BAUD_SYNC)
+        try:
+            self.recv(BAUD_ACK, timeout=BAUD_SWITCH_TIMEOUT / 1000.0 + 0.5)
+        except TimeoutError:
+            # The device has given up already, and it is back at the old baud rate.
+            self._resync([old, baudrate], wait=False)
+            return self.ser.baudrate == baudrate
+        try:
+            self.send(BAUD_GO)
+            self.exec_raw_follow()
+            if self.probe():
+                return True
+        except (TimeoutError, EspException, UnicodeDecodeError):
+            pass
+        self._resync([old, baudrate])
+        if self.ser.baudrate == baudrate:
+            # The device did not get BAUD_GO, but the next step was successful. Weird, but fine.
+            return True
+        return False
+
+    def negotiate_baudrate(self, baudrates):
+        """Switch to the first baud rate from the list that works.
+
+        :return: The new baud rate, or the original one when none of them worked.
+        """
+        self._require_raw_mode("--fast-baudrate")
+        self.fast_baudrates = baudrates
+        for baudrate in baudrates:
+            if baudrate <= self.ser.baudrate:
+                break
+            self.logger("BAUDRATE %d -> %d " % (self.ser.baudrate, baudrate))
+            if self.switch_baudrate(baudrate):
+                self.logger("OK\n")
+                break
+            self.logger("FAILED\n")
+        return self.ser.baudrate
+
+    def restore_baudrate(self):
+        """Switch back to the initial baud rate, at the end of the session."""
+        if self.ser.baudrate == self.initial_baudrate:
+            return
+        self.logger("BAUDRATE %d -> %d\n" % (self.ser.baudrate, self.initial_baudrate))
+        old = self.ser.baudrate
+        if not self.raw_mode:
+            self.enter_raw_mode()
+        self.exec_raw_start(self._baud_switch_code(self.initial_baudrate, False))
+        self._switch_port(self.initial_baudrate)
+        try:
+            self.exec_raw_follow()
+            if self.probe():
+                return
+        except (TimeoutError, EspException, UnicodeDecodeError):
+            pass
+        self._resync([self.initial_baudrate, old])
+
+    def load_agent(self):
+        """Push the agent code to the device, unless it is already there.
+
+        This also limits the maximum frame size and the compression window, according to the free heap of the
+        device."""
+        if not self.agent_loaded:
+            with self.measure(self.phase_stats, phase="load_agent"):
+                self.exec_raw(AGENT)
+                mem_free = int(self.exec_raw("print(_sy_mem())"))
+            self.agent_loaded = True
+            self.max_frame_size = max(MIN_FRAME_SIZE, min(MAX_FRAME_SIZE, mem_free // HEAP_FRAME_RATIO))
+            self.compress_wbits = MIN_COMPRESS_WBITS
+            while self.compress_wbits < MAX_COMPRESS_WBITS and \
+                    2 ** (self.compress_wbits + 1) <= mem_free // HEAP_WINDOW_RATIO:
+                self.compress_wbits += 1
+
+    def load_agent_extension(self, name):
+        """Push an extension of the agent (see AGENT_EXTENSIONS) to the device, unless it is already there."""
+        self.load_agent()
+        if name not in self.agent_extensions:
+            with self.measure(self.phase_stats, phase="load_agent_extension", params=[name]):
+                self.exec_raw(AGENT_EXTENSIONS[name])
+            self.agent_extensions.add(name)
+
+    def _agent_expect(self, expected):
+        """Receive a single byte from the agent, and raise an exception if it is not the expected one."""
+        answer = self.recv_exactly(1)
+        if answer != expected:
+            if answer == CTRL_D:
+                # The agent has stopped, the rest is an error message.
+                err = self.recv(CTRL_D)
+                self.recv(b'>')
+                raise EspException(err.decode('utf-8').replace('\r', '').strip())
+            raise EspException("Unexpected answer from agent: %s" % repr(answer + bytes(self.buffer)))
+
+    def _ack_timeout(self, in_flight):
+        """Time to wait for an acknowledgement when in_flight bytes have been sent."""
+        return 1.0 + 2.0 * in_flight * 10.0 / self.ser.baudrate
+
+    def put_raw(self, dst, data, progress=None, wbits=0, file_size=None, offset=None):
+        """Write data into a file on the device, through the agent.
+
+        Several frames are kept in flight. The frame size and the window are halved on errors (bad frame or
+        lost data), and they are increased again after GROW_AFTER frames were acknowledged.
+
+        :param dst: Destination file path on the device
+        :param data: Binary data to be sent
+        :param progress: A callable that is called with the number of bytes sent after each frame.
+        :param wbits: When not zero, data is a raw deflate stream (see compress_data), that is decompressed
+            on the device.
+        :param file_size: Size of the decompressed file, it is checked by the device.
+        :param offset: When not None, the upload is resumable: data is written into dst + PART_SUFFIX, after
+            the first offset bytes of it, and the file is renamed to dst when it is complete.
+        :return: A tuple of (frame size, window, retries) at the end of the transfer.
+        """
+        self.load_agent()
+        if offset is None:
+            path, offset, final = dst, 0, None
+        else:
+            path, final = dst + PART_SUFFIX, dst
+        self.exec_raw_start("_sy_put(%s,%d,%d,%d,%s,%d,%s)" % (
+            repr(path), len(data), self.max_frame_size, wbits, repr(file_size), offset, repr(final)))
+        result = self._put_frames(data, dst, progress)
+        self.exec_raw_follow()
+        return result
+
+    def _put_frames(self, data, name, progress=None):
+        """Send data to an agent function that receives it with _SyRx. See put_raw.
+
+        The function must have been started with exec_raw_start(), and exec_raw_follow() must be called after.
+
+        :param name: Used in error messages.
+        :return: A tuple of (frame size, window, retries) at the end of the transfer.
+        :raises TimeoutError: When the device did not answer MAX_ACK_TIMEOUTS times in a row.
+        :raises EspException: When there were too many bad frames.
+        """
+        max_frame = self.max_frame_size
+        frame = max(MIN_FRAME_SIZE, min(self.frame_size, max_frame))
+        window = self.window
+        self._agent_expect(b'R')
+        view = memoryview(data)
+        written, sent = 0, 0
+        in_flight = deque()
+        clean, retries, failures, timeouts = 0, 0, 0, 0
+        while written < len(data):
+            while sent < len(data) and len(in_flight) < window:
+                chunk = view[sent:sent + frame]
+                self.send(FRAME_HEADER.pack(FRAME_MAGIC, len(chunk), binascii.crc32(chunk)) + chunk)
+                in_flight.append(len(chunk))
+                sent += len(chunk)
+            try:
+                answer = self.recv_exactly(1, self._ack_timeout(sent - written))
+                timeouts = 0
+            except TimeoutError:
+                answer = None
+                timeouts += 1
+                if timeouts >= MAX_ACK_TIMEOUTS:
+                    raise TimeoutError("The device stopped responding while uploading %s" % name)
+            if answer == b'A':
+                size = in_flight.popleft()
+                written += size
+                self.bytes_transferred += size
+                clean += 1
+                failures = 0
+                if clean >= GROW_AFTER:
+                    clean = 0
+                    if frame < max_frame:
+                        frame = min(frame * 2, max_frame)
+                    elif window < self.window:
+                        window += 1
+                if progress:
+                    progress(written)
+                continue
+            elif answer == b'N':
+                written = sent = struct.unpack('<I', self.recv_exactly(4))[0]
+                in_flight.clear()
+            elif answer is None:
+                # Data was lost, and the agent is waiting for the rest of a frame. Fill it up, so it can detect
+                # the error. Then it will tell where to continue from.
+                self.send(bytes(max_frame + FRAME_HEADER.size))
+            elif answer == CTRL_D:
+                self.buffer[:0] = answer
+                self._agent_expect(b'A')
+            else:
+                raise EspException("Unexpected answer from agent: %s" % repr(answer + bytes(self.buffer)))
+            retries += 1
+            failures += 1
+            self.retries += 1
+            if failures > MAX_RETRIES:
+                raise EspException("Too many errors while uploading %s" % name)
+            frame = max(MIN_FRAME_SIZE, frame // 2)
+            window = max(1, window // 2)
+            clean = 0
+        return frame, window, retries
+
+    def get_raw(self, src, fout, progress=None):
+        """Read a file from the device, through the agent.
+
+        :param src: Source file path on the device
+        :param fout: Binary file-like object, the data is written here
+        :param progress: A callable that is called with the number of bytes read after each frame.
+        :return: Number of bytes read.
+        """
+        self.load_agent()
+        self.exec_raw_start("_sy_get(%s,%d)" % (repr(src), self.frame_size))
+        self._agent_expect(b'R')
+        total_read = self._get_frames(src, fout, progress)
+        self.exec_raw_follow()
+        return total_read
+
+    def _get_frames(self, src, fout, progress=None):
+        """Receive frames sent by the agent (see _sy_get), until an empty frame.
+
+        :return: Number of bytes read."""
+        total_read = 0
+        while True:
+            size, crc = struct.unpack('<HI', self.recv_exactly(6))
+            if not size:
+                break
+            data = self.recv_exactly(size)
+            if binascii.crc32(data) != crc:
+                raise EspException("Checksum error while downloading %s" % src)
+            fout.write(data)
+            total_read += size
+            self.bytes_transferred += size
+            if progress:
+                progress(total_read)
+        return total_read
 
     def enter_paste_mode(self):
         self.send(CTRL_E)
@@ -140,7 +1343,7 @@ class EspSyncer:
         self.send(CTRL_D)
 
     def communicate(self, stdin, stdout, sdtin_encoding=None, stdout_encoding=None,
-                    absolute_timeout=None, timeout=1, paste_mode=True, watch_file_path=None,
+                    absolute_timeout=None, timeout=1, paste_mode=True, watcher=None,
                     no_select=False):
         """Communicate with device. Connects stdin and stdout with the serial line of the device.
 
@@ -153,52 +1356,77 @@ class EspSyncer:
         :param timeout: Timeout between read/write operations. None means infinite.
         :param paste_mode: Post all data in paste mode, then exit paste mode. In this mode, we presume
             that the whole input file can be read within 1 second.
-        :param watch_file_path: When specified, it should be a file path. This file will be monitored, and when it
-            is changed, then communicate() will return True. This can be used to continuously monitor
+        :param watcher: When specified, it should be a FileWatcher. When the watched files are changed, then
+            communicate() returns the set of changed paths. This can be used to continuously monitor
             for file changes of test scripts, and re-execute them on the MCU when they are changed.
+            The timeout does not apply while waiting for changes.
         :param no_select: When this flag is set, the input file is read at once. When this flag is not set (default),
             the input file is read continuously when data is available (it is checked with select.select).
         """
+        if self.raw_mode:
+            self.exit_raw_mode()
         if paste_mode:
             self.enter_paste_mode()
-        sendbuf = b''
+        sendbuf, sendpos = bytearray(), 0
         started, absolute_elapsed = time.time(), 0
         last_comm, elapsed = started, 0
         eof_reached = False
         paste_mode_exited = False
-        if watch_file_path:
-            last_changed = os.stat(watch_file_path).st_mtime
-        else:
-            last_changed = 0
         if no_select:
-            sendbuf = stdin.read()
+            sendbuf += stdin.read()
             eof_reached = True
+        try:
+            # Wait for the device too, instead of polling it.
+            ser_fd = self.ser.fileno()
+        except (AttributeError, OSError, ValueError):
+            ser_fd = None
         while True:
             was_comm = False
 
-            if not no_select:
-                # stdin -> buf
-                rlist, wlist, xlist = select.select([stdin], [], [], 0.01)
-                if rlist:
-                    data = stdin.read()
-                    if data:
-                        was_comm = True
-                        if sdtin_encoding:
-                            data = data.decode(sdtin_encoding)
-                        sendbuf += data
-                    elif not sendbuf:
-                        # select.select returns the file, but it reads as an empty string -> EOF reached.
-                        if not eof_reached:
-                            eof_reached = True
+            rfds = []
+            if not no_select and not eof_reached:
+                rfds.append(stdin)
+            if ser_fd is not None:
+                rfds.append(ser_fd)
+            if watcher and watcher.fileno() is not None:
+                rfds.append(watcher.fileno())
+            if sendpos < len(sendbuf) or (eof_reached and not paste_mode_exited):
+                wait = 0
+            elif ser_fd is None:
+                wait = 0.01
+            else:
+                wait = COMMUNICATE_SELECT_TIMEOUT
+            if watcher and watcher.timeout() is not None:
+                wait = min(wait, watcher.timeout())
+            if rfds:
+                rlist, wlist, xlist = select.select(rfds, [], [], wait)
+            else:
+                rlist = []
+                time.sleep(wait)
+
+            # stdin -> buf
+            if stdin in rlist:
+                data = stdin.read()
+                if data:
+                    was_comm = True
+                    if isinstance(data, str):
+                        data = data.encode(sdtin_encoding or 'utf-8')
+                    sendbuf += data
+                else:
+                    # select.select returns the file, but it reads as an empty string -> EOF reached.
+                    eof_reached = True
 
             if eof_reached and not paste_mode_exited:
                 sendbuf += CTRL_D  # exit paste mode
                 paste_mode_exited = True
 
             # buf -> MCU
-            if sendbuf:
-                sent = self.ser.write(sendbuf)
-                sendbuf = sendbuf[sent:]
+            if sendpos < len(sendbuf):
+                with memoryview(sendbuf) as view:
+                    sendpos += self.ser.write(view[sendpos:]) or 0
+                if sendpos == len(sendbuf):
+                    sendbuf.clear()
+                    sendpos = 0
                 was_comm = True
 
             # MCU -> stdout
@@ -222,17 +1450,19 @@ class EspSyncer:
                 if absolute_timeout < absolute_elapsed:
                     raise TimeoutError("AbsoluteTimeoutError")
 
-            if timeout is not None:
+            if timeout is not None and watcher is None:
                 if timeout < elapsed:
                     raise TimeoutError("TimeoutError")
 
-            if watch_file_path:
-                changed = os.stat(watch_file_path).st_mtime
-                if changed != last_changed:
-                    return True
+            if watcher:
+                changed = watcher.poll()
+                if changed:
+                    return changed
 
     def __call__(self, cmd, terminator=DEFAULT_TERMINATOR, expect_echo=True):
         """Send a single line of command and return the result."""
+        if self.raw_mode:
+            return self.exec_raw(cmd)
         cmd = cmd.encode('ascii')
         if not cmd.endswith(EOL):
             cmd += EOL
@@ -251,12 +1481,15 @@ class EspSyncer:
         if not self.os_imported:
             self("import os", expect_echo=False)
             self.os_imported = True
+        if self.raw_mode:
+            return eval(self("print(repr(%s))" % cmd))
         return eval(self(cmd))
 
     def ls(self, relpath):
         return self.eval("os.listdir(%s)" % repr(relpath))
 
     def rm(self, relpath):
+        self.manifest_drops.add(relpath)
         assert self.eval("os.remove(%s) or True" % repr(relpath)) is True
 
     def rmdir(self, relpath):
@@ -267,6 +1500,15 @@ class EspSyncer:
 
     def makedirs(self, realpath):
         assert realpath.startswith("/")
+        if self.raw_mode:
+            self.load_agent_extension("fs")
+            created, conflict = self.eval("_sy_makedirs(%s)" % repr([realpath]))
+            if conflict:
+                raise Exception(
+                    "Wanted to create directory %s but it already exists and it is not a directory." %
+                    conflict
+                )
+            return
         parts = realpath[1:].split("/")
         for idx in range(len(parts)):
             path = "/" + "/".join(parts[:idx + 1])
@@ -290,6 +1532,41 @@ class EspSyncer:
             else:
                 raise e
 
+    def reload_modules(self, changed, lib_dir, dst):
+        """Upload changed modules of a local library directory, and forget all modules of the library.
+
+        Only the changed files are uploaded (deleted files are removed from the device), but all modules of the
+        library are removed from sys.modules: modules that import a changed module would keep using the old
+        one otherwise. They are imported again by the next program that uses them.
+
+        :param changed: Changed local paths (see FileWatcher), files outside lib_dir are ignored.
+        :param lib_dir: Local library directory.
+        :param dst: Library directory on the device, e.g. /lib
+        """
+        lib_dir = os.path.abspath(lib_dir)
+        for path in sorted(changed):
+            relpath = os.path.relpath(path, lib_dir)
+            if relpath.startswith(os.pardir) or os.path.isdir(path):
+                continue
+            remote_path = self._remote_join(dst, relpath.replace(os.sep, "/"))
+            if os.path.isfile(path):
+                self.makedirs(remote_path.rsplit("/", 1)[0] or "/")
+                self.upload(path, remote_path.rsplit("/", 1)[0] or "/", False, True, False)
+            elif self.stat(remote_path) is not None:
+                self.logger("DELETE %s\n" % remote_path)
+                self.rm(remote_path)
+        names = []
+        for dpath, dnames, fnames in os.walk(lib_dir):
+            for fname in fnames:
+                base, ext = os.path.splitext(fname)
+                if ext in MODULE_SUFFIXES:
+                    parts = os.path.relpath(os.path.join(dpath, base), lib_dir).split(os.sep)
+                    if parts[-1] == "__init__":
+                        parts = parts[:-1]
+                    if parts:
+                        names.append(".".join(parts))
+        self("import sys;[sys.modules.pop(n, None) for n in %s]" % repr(sorted(set(names))), expect_echo=False)
+
     def rmtree(self, relpath, ident=''):
         """Delete all files and directories from the flash.
 
@@ -305,6 +1582,13 @@ class EspSyncer:
         if relpath != "/" and relpath.endswith("/"):
             relpath = relpath[:-1]
 
+        if self.raw_mode:
+            self.load_agent_extension("fs")
+            for path, isdir in self.eval("_sy_rmtree(%s)" % repr(relpath)):
+                self.logger(ident + ("RMDIR " if isdir else "RM ") + path + "\n")
+                self.manifest_drops.add(path)
+            return
+
         st = self.stat(relpath)
 
         if st.isfile:
@@ -321,9 +1605,134 @@ class EspSyncer:
                 self.logger(ident + "RMDIR " + relpath + "\n")
                 self.rmdir(relpath)
 
-    def _upload_file(self, src, dst, overwrite, quick):
-        """Internal method, to not use directly."""
-        st = self.stat(dst)
+    def walk(self, paths):
+        """Walk the given paths on the device, in a single round trip.
+
+        :param paths: List of absolute paths. Missing paths are ignored.
+        :return: A list of (path, isdir, size) for the given paths and everything below them.
+        """
+        self.load_agent_extension("fs")
+        return self.eval("_sy_walk(%s)" % repr(list(paths)))
+
+    def _cache_remote_tree(self, paths):
+        """Walk paths on the device, and use the result instead of stat() and ls() calls below them.
+
+        This only works in raw mode, and the cache must be dropped with _drop_remote_tree() when finished."""
+        self.remote_tree = {}
+        self.remote_children = {}
+        for path, isdir, size in self.walk(paths):
+            self._cache_entry(path, isdir, size)
+
+    def _cache_entry(self, path, isdir, size=0):
+        self.remote_tree[path] = StatResult((ST_TYPE_DIRECTORY if isdir else ST_TYPE_FILE, 0, 0, 0, 0, 0, size))
+        if isdir:
+            self.remote_children.setdefault(path, [])
+        if path != "/":
+            parent, fname = path.rsplit("/", 1)
+            children = self.remote_children.get(parent or "/")
+            if children is not None and fname not in children:
+                children.append(fname)
+
+    def _drop_remote_tree(self):
+        self.remote_tree = None
+        self.remote_children = None
+
+    def _cached_stat(self, relpath) -> Optional[StatResult]:
+        if self.remote_tree is None:
+            return self.stat(relpath)
+        return self.remote_tree.get(relpath)
+
+    def _cached_ls(self, relpath):
+        if self.remote_children is None:
+            return self.ls(relpath)
+        return list(self.remote_children[relpath])
+
+    def remote_hashes_of(self, paths, rehash=False):
+        """Get the SHA-256 hashes of files on the device, in a single round trip.
+
+        :param paths: List of absolute paths
+        :param rehash: Compute all hashes again, instead of using the manifest on the device.
+        :return: A dict of path -> hex digest. The digest is None for missing files, and DIR_HASH for directories.
+        """
+        self.load_agent_extension("hash")
+        return dict(zip(paths, self.eval("_sy_hashes(%s,%s)" % (repr(list(paths)), repr(rehash)))))
+
+    def remote_tree_hashes(self, relpath, rehash=False):
+        """Get the SHA-256 hashes of all files below relpath on the device, in a single round trip."""
+        self.load_agent_extension("hash")
+        return self.eval("_sy_hash_tree(%s,%s)" % (repr(relpath), repr(rehash)))
+
+    def save_manifest(self):
+        """Store the hashes of the uploaded files in the manifest on the device, and forget the files that were
+        written without a hash (raw protocol only)."""
+        if not self.raw_mode:
+            return
+        if self.manifest_updates or self.manifest_drops or "hash" in self.agent_extensions:
+            self.load_agent_extension("hash")
+            self.eval("_sy_mf_save(%s,%s)" % (repr(self.manifest_updates), repr(sorted(self.manifest_drops))))
+            self.manifest_updates = {}
+            self.manifest_drops = set()
+
+    def _require_raw_mode(self, option):
+        if not self.raw_mode:
+            raise Exception("%s requires the %s protocol" % (option, PROTOCOL_RAW))
+
+    @staticmethod
+    def compress_data(path, data, wbits):
+        """Compress the contents of a file for uploading, unless it is not worth it.
+
+        :return: A tuple of (data, wbits). wbits is zero when data was not compressed.
+        """
+        if path.lower().endswith(COMPRESS_SKIP_EXTENSIONS):
+            return data, 0
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -wbits, 9)
+        packed = compressor.compress(data) + compressor.flush()
+        if len(packed) > len(data) * COMPRESS_MAX_RATIO:
+            return data, 0
+        return packed, wbits
+
+    @staticmethod
+    def _remote_join(dst, fname):
+        if dst == "/":
+            return "/" + fname
+        else:
+            return dst + "/" + fname
+
+    def _upload_targets(self, src, dst):
+        """Source and destination paths of files and directories, that are copied by _upload(src, dst)."""
+        dst_path = self._remote_join(dst, os.path.split(src)[1])
+        yield src, dst_path
+        if os.path.isdir(src):
+            for fname in sorted(os.listdir(src)):
+                if fname not in [os.pardir, os.curdir]:
+                    yield from self._upload_targets(os.path.join(src, fname), dst_path)
+
+    def _progress_logger(self, full_size=None):
+        """Create a progress callback for put_raw/get_raw. It draws a dot for each frame."""
+        lcnt = [0]
+
+        def progress(total):
+            self.logger('.')
+            lcnt[0] += 1
+            if lcnt[0] % 16 == 0:
+                if full_size:
+                    self.logger(' %.2fK, %.2f%% \n    ' % (total / 1024.0, 100.0 * total / full_size))
+                else:
+                    self.logger(' %.2fK \n    ' % (total / 1024.0))
+
+        return progress
+
+    @staticmethod
+    def _format_speed(size, started):
+        elapsed = time.time() - started
+        if elapsed > 0:
+            return '%.2f KB, %.2f KB/s' % (size / 1024.0, size / 1024.0 / elapsed)
+        else:
+            return '%.2f KB' % (size / 1024.0)
+
+    def _upload_file(self, src, dst, overwrite, quick, checksum=False):
+        """Internal method, to not use directly. Returns False when the file was skipped."""
+        st = self._cached_stat(dst)
         if st and not overwrite:
             raise Exception("Destination %s already exist." % dst)
         if st and st.isdir:
@@ -331,20 +1740,64 @@ class EspSyncer:
         with open(src, "rb") as fin:
             data = fin.read()
 
-        if quick:
+        if checksum:
+            digest = hashlib.sha256(data).hexdigest()
+            if st is not None and digest == self.remote_hashes.get(dst):
+                self.logger('SKIP ' + dst + '\n')
+                return False
+        elif quick:
             src_size = os.stat(src).st_size
             if st is not None and src_size == st.size:
                 self.logger('SKIP ' + dst + '\n')
-                return
+                return False
 
+        started = time.time()
+        full_size = len(data)
+        if self.raw_mode:
+            offset = 0
+            if self._cached_stat(dst + PART_SUFFIX) is not None:
+                offset = self._resume_offset(dst, data)
+            attempts = 0
+            while True:
+                wire_data, wbits = data[offset:], 0
+                if self.compress:
+                    self.load_agent()
+                    wire_data, wbits = self.compress_data(src, wire_data, self.compress_wbits)
+                self.logger('UPLOAD ' + dst)
+                if offset:
+                    self.logger(' (resumed at %.2fK)' % (offset / 1024.0))
+                if wbits:
+                    self.logger(' (compressed %.2fK -> %.2fK)' % ((full_size - offset) / 1024.0,
+                                                                   len(wire_data) / 1024.0))
+                self.logger('\n    ')
+                try:
+                    frame, window, retries = self.put_raw(dst, wire_data, self._progress_logger(len(wire_data)),
+                                                          wbits, full_size - offset, offset)
+                    break
+                except TimeoutError:
+                    attempts += 1
+                    if attempts > RESUME_ATTEMPTS:
+                        raise
+                    self.logger('\nTIMEOUT %s, resetting the device\n' % dst)
+                    self.reset()
+                    if self.fast_baudrates:
+                        self.negotiate_baudrate(self.fast_baudrates)
+                    offset = self._resume_offset(dst, data)
+            self.logger(' -- %s, frame %d, window %d, %d retries OK\n' % (
+                self._format_speed(len(wire_data), started), frame, window, retries))
+            if checksum:
+                self.manifest_updates[dst] = digest
+            else:
+                self.manifest_drops.add(dst)
+            return True
         self.logger('UPLOAD ' + dst + '\n    ')
         self("_fout = open(%s,'wb+')" % repr(dst), expect_echo=False)
         lcnt = 0
-        full_size = len(data)
         total_written = 0
         while data:
             written = self.eval("_fout.write(%s)" % repr(data[:MAX_WRITE_PER_PASS]))
             total_written += written
+            self.bytes_transferred += written
             data = data[written:]
             self.logger('.')
             lcnt += 1
@@ -353,17 +1806,28 @@ class EspSyncer:
                 self.logger(' %.2fK, %.2f%% \n    ' % (total_written / 1024.0, percent))
         self("_fout.close()", expect_echo=False)
         self("del _fout", expect_echo=False)
-        self.logger(' -- %.2f KB OK\n' % (total_written / 1024.0))
+        self.logger(' -- %s OK\n' % self._format_speed(total_written, started))
+        return True
 
-    def _upload(self, src, dst, overwrite, quick):
-        fname = os.path.split(src)[1]
-        if dst == "/":
-            dst_path = "/" + fname
-        else:
-            dst_path = dst + "/" + fname
+    def _resume_offset(self, dst, data):
+        """Find out where an interrupted upload of data to dst can be continued from.
+
+        :return: The size of the partial file on the device, when it is the beginning of data. Otherwise zero.
+        """
+        self.load_agent_extension("hash")
+        part = self.eval("_sy_part(%s)" % repr(dst + PART_SUFFIX))
+        if part is None:
+            return 0
+        size, digest = part
+        if size <= len(data) and hashlib.sha256(data[:size]).hexdigest() == digest:
+            return size
+        return 0
+
+    def _upload(self, src, dst, overwrite, quick, checksum=False):
+        dst_path = self._remote_join(dst, os.path.split(src)[1])
 
         if os.path.isdir(src):
-            st = self.stat(dst_path)
+            st = self._cached_stat(dst_path)
             if st is None:
                 self.logger("MKDIR " + dst_path + "\n")
                 self.mkdir(dst_path)
@@ -372,13 +1836,15 @@ class EspSyncer:
 
             for fname in sorted(os.listdir(src)):
                 if fname not in [os.pardir, os.curdir]:
-                    self._upload(os.path.join(src, fname), dst_path, overwrite, quick)
+                    self._upload(os.path.join(src, fname), dst_path, overwrite, quick, checksum)
         elif os.path.isfile(src):
-            self._upload_file(src, dst_path, overwrite, quick)
+            with self.measure(self.file_stats, path=dst_path, action="upload") as record:
+                if not self._upload_file(src, dst_path, overwrite, quick, checksum):
+                    record["action"] = "skip"
         else:
             raise Exception("Source is not a regular file or directory: %s" % src)
 
-    def upload(self, src, dst, contents, overwrite, quick):
+    def upload(self, src, dst, contents, overwrite, quick, checksum=False, rehash=False):
         """Upload local files to the device.
 
         :param src: Source directory or file to be uploaded.
@@ -387,6 +1853,9 @@ class EspSyncer:
             When set, src must be a directory.
         :param overwrite: Set this flag if you want to automatically overwrite existing files.
         :param quick: Copy only if size differs
+        :param checksum: Copy only if the SHA-256 hash differs. The hashes of all destination files are
+            queried at once, and the manifest on the device is updated at the end.
+        :param rehash: Do not use the manifest on the device, compute all hashes again.
         """
         st = self.stat(dst)
         if st is not None and not st.isdir:
@@ -395,30 +1864,78 @@ class EspSyncer:
         if contents:
             if not os.path.isdir(src):
                 raise Exception("upload: --contents was given but the source %s is not a directory" % src)
-            for fname in sorted(os.listdir(src)):
-                if fname not in [os.pardir, os.curdir]:
-                    self._upload(os.path.join(src, fname), dst, overwrite, quick)
+            sources = [os.path.join(src, fname) for fname in sorted(os.listdir(src))
+                       if fname not in [os.pardir, os.curdir]]
         else:
-            self._upload(src, dst, overwrite, quick)
-
-    def _download_file(self, src, dst, overwrite, quick):
-        """Internal method, to not use directly."""
+            sources = [src]
+
+        if checksum:
+            self._require_raw_mode("--checksum")
+        if self.compress:
+            self._require_raw_mode("--compress")
+        if not self.raw_mode:
+            for source in sources:
+                self._upload(source, dst, overwrite, quick)
+            return
+
+        # Query the existing files and directories (and their hashes) at once, and create all missing
+        # directories in a single call.
+        targets = []
+        for source in sources:
+            targets += self._upload_targets(source, dst)
+        top_paths = [self._remote_join(dst, os.path.split(source)[1]) for source in sources]
+        # Partial files of interrupted uploads are found by the walk below directories, but not at the top.
+        self._cache_remote_tree(top_paths + [path + PART_SUFFIX for path in top_paths])
+        try:
+            if checksum:
+                self.remote_hashes = self.remote_hashes_of(
+                    [dst_path for _, dst_path in targets if dst_path in self.remote_tree], rehash)
+            missing = [dst_path for src_path, dst_path in targets
+                       if os.path.isdir(src_path) and dst_path not in self.remote_tree]
+            if missing:
+                created, conflict = self.eval("_sy_makedirs(%s)" % repr(missing))
+                for path in created:
+                    self.logger("MKDIR " + path + "\n")
+                    self._cache_entry(path, True)
+                if conflict:
+                    raise Exception("upload: cannot overwrite a file with a directory: %s" % conflict)
+            for source in sources:
+                self._upload(source, dst, overwrite, quick, checksum)
+            self.save_manifest()
+        finally:
+            self._drop_remote_tree()
+
+    def _download_file(self, src, dst, overwrite, quick, checksum=False):
+        """Internal method, to not use directly. Returns False when the file was skipped."""
         if os.path.isdir(dst):
             raise Exception("Cannot overwrite a directory with a file: %s -> %s" % (src, dst))
         if os.path.isfile(dst) and not overwrite:
             raise Exception("Destination file %s already exist." % dst)
 
-        if quick:
-            st = self.stat(src)
+        if checksum:
+            if os.path.isfile(dst):
+                with open(dst, "rb") as fin:
+                    if hashlib.sha256(fin.read()).hexdigest() == self.remote_hashes.get(src):
+                        self.logger('SKIP ' + dst + '\n')
+                        return False
+        elif quick:
+            st = self._cached_stat(src)
             if st is not None:
                 if os.path.isfile(dst):
                     dst_size = os.stat(dst).st_size
                     if dst_size == st.size:
                         self.logger('SKIP ' + dst + '\n')
-                        return
+                        return False
 
-        self("_fin = open(%s,'rb')" % repr(src), expect_echo=False)
         self.logger('DOWNLOAD ' + dst + '\n    ')
+        started = time.time()
+        if self.raw_mode:
+            with open(dst, "wb+") as fout:
+                total_read = self.get_raw(src, fout, self._progress_logger())
+            self.logger(' -- %s OK\n' % self._format_speed(total_read, started))
+            return True
+
+        self("_fin = open(%s,'rb')" % repr(src), expect_echo=False)
         with open(dst, "wb+") as fout:
             lcnt = 0
             total_read = 0
@@ -432,12 +1949,14 @@ class EspSyncer:
                 if lcnt % 16 == 0:
                     self.logger(' %.2fK \n    ' % (total_read / 1024.0))
                 total_read += len(data)
+                self.bytes_transferred += len(data)
 
         self("_fin.close()", expect_echo=False)
         self("del _fin", expect_echo=False)
-        self.logger(' -- %.2f KB OK\n' % (total_read / 1024.0))
+        self.logger(' -- %s OK\n' % self._format_speed(total_read, started))
+        return True
 
-    def _download(self, src, dst, overwrite, quick):
+    def _download(self, src, dst, overwrite, quick, checksum=False):
         fname = os.path.split(src)[1]
         # Ez csak unix-on....
         if dst == "/":
@@ -445,7 +1964,7 @@ class EspSyncer:
         else:
             dst_path = os.path.join(dst, fname)
 
-        st = self.stat(src)
+        st = self._cached_stat(src)
 
         if st.isdir:
             if not os.path.isfile(dst_path) and not os.path.isdir(dst_path):
@@ -454,17 +1973,19 @@ class EspSyncer:
             elif os.path.isfile(dst_path):
                 raise Exception("upload: cannot overwrite a file with a directory: %s -> %s" % (src, dst))
 
-            for fname in sorted(self.ls(src)):
-                if fname not in [".", ".."]:
+            for fname in sorted(self._cached_ls(src)):
+                if fname not in [".", ".."] and not fname.endswith(PART_SUFFIX):
                     if src == "/":
                         src_path = "/" + fname
                     else:
                         src_path = src + "/" + fname
-                    self._download(src_path, dst_path, overwrite, quick)
+                    self._download(src_path, dst_path, overwrite, quick, checksum)
         else:
-            self._download_file(src, dst_path, overwrite, quick)
+            with self.measure(self.file_stats, path=src, action="download") as record:
+                if not self._download_file(src, dst_path, overwrite, quick, checksum):
+                    record["action"] = "skip"
 
-    def download(self, src, dst, contents, overwrite, quick):
+    def download(self, src, dst, contents, overwrite, quick, checksum=False, rehash=False):
         """Download files from device.
 
         :param src: Source directory or file to be uploaded.
@@ -473,123 +1994,462 @@ class EspSyncer:
             When set, src must be a directory.
         :param overwrite: Set this flag if you want to automatically overwrite existing files.
         :param quick: set flag to skip files that have the same size on both devices
+        :param checksum: set flag to skip files that have the same SHA-256 hash on both devices
+        :param rehash: Do not use the manifest on the device, compute all hashes again.
         """
         if not os.path.isdir(dst):
             raise Exception("download: cannot download to non-existent directory %s" % dst)
+        if checksum:
+            self._require_raw_mode("--checksum")
+            self.remote_hashes = self.remote_tree_hashes(src, rehash)
+        if self.raw_mode:
+            self._cache_remote_tree([src])
+        try:
+            self._download_all(src, dst, contents, overwrite, quick, checksum)
+        finally:
+            self._drop_remote_tree()
 
+    def _download_all(self, src, dst, contents, overwrite, quick, checksum):
         if contents:
-            st = self.stat(src)
+            st = self._cached_stat(src)
             if not st or not st.isdir:
                 raise Exception("download: --contents was given but the source %s is not a directory" % src)
-            for fname in sorted(self.ls(src)):
-                if fname not in ["..", "."]:
-                    self._download(src + "/" + fname, dst, overwrite, quick)
+            for fname in sorted(self._cached_ls(src)):
+                if fname not in ["..", "."] and not fname.endswith(PART_SUFFIX):
+                    self._download(self._remote_join(src, fname), dst, overwrite, quick, checksum)
         else:
-            self._download(src, dst, overwrite, quick)
+            self._download(src, dst, overwrite, quick, checksum)
+        if checksum:
+            # Keep the hashes that were computed on the device.
+            self.save_manifest()
+
+    def snapshot(self, src, archive):
+        """Save a file or a directory tree of the device into a local snapshot archive.
+
+        The device streams all files in a single pass, and the digest of every file is checked. The archive
+        is written into a temporary file first, so an existing archive is only replaced by a complete one.
+
+        :param src: Source file or directory on the device. Use "/" for the whole file system.
+        :param archive: Path of the local archive file.
+        :return: Number of files saved.
+        """
+        self._require_raw_mode("snapshot")
+        self.load_agent_extension("snapshot")
+        if src == "/":
+            strip = 1
+        else:
+            src = src.rstrip("/")
+            strip = len(src.rsplit("/", 1)[0]) + 1
+        self.logger("SNAPSHOT %s -> %s\n" % (src, archive))
+        started = time.time()
+        total, files = 0, 0
+        tmp_path = archive + ".part"
+        self.exec_raw_start("_sy_snapshot(%s,%d,%d)" % (repr(src), strip, self.frame_size))
+        self._agent_expect(b'R')
+        with open(tmp_path, "wb") as fout:
+            fout.write(SNAPSHOT_MAGIC)
+            while True:
+                kind, size = SNAPSHOT_ENTRY.unpack(self.recv_exactly(SNAPSHOT_ENTRY.size))
+                if kind == b'E':
+                    fout.write(SNAPSHOT_ENTRY.pack(kind, 0))
+                    break
+                name = self.recv_exactly(size)
+                if kind == b'D':
+                    self.logger("    " + name.decode('utf-8') + "/\n")
+                    fout.write(SNAPSHOT_ENTRY.pack(kind, len(name)) + name)
+                elif kind == b'F':
+                    buf = io.BytesIO()
+                    with self.measure(self.file_stats, path=src[:strip] + name.decode('utf-8'), action="snapshot"):
+                        self._get_frames(name.decode('utf-8'), buf)
+                        digest = self.recv_exactly(SNAPSHOT_DIGEST_SIZE)
+                    data = buf.getvalue()
+                    if hashlib.sha256(data).digest() != digest:
+                        raise EspException("Checksum error in snapshot of %s" % name.decode('utf-8'))
+                    self.logger("    %s %.2fK\n" % (name.decode('utf-8'), len(data) / 1024.0))
+                    fout.write(SNAPSHOT_ENTRY.pack(kind, len(name)) + name + SNAPSHOT_SIZE.pack(len(data)))
+                    fout.write(data)
+                    fout.write(digest)
+                    total += len(data)
+                    files += 1
+                else:
+                    raise EspException("Unexpected entry in snapshot: %s" % repr(kind))
+        self.exec_raw_follow()
+        os.replace(tmp_path, archive)
+        self.logger("SNAPSHOT %d files -- %s OK\n" % (files, self._format_speed(total, started)))
+        return files
+
+    def restore(self, archive, dst):
+        """Extract a snapshot archive (see snapshot) into a directory of the device.
+
+        The archive is checked, and then it is sent to the device as a single stream. Existing files are
+        overwritten, other files on the device are kept.
+
+        :param archive: Path of the local archive file.
+        :param dst: Destination directory on the device, it is created when needed.
+        :return: Number of files restored.
+        """
+        self._require_raw_mode("restore")
+        with open(archive, "rb") as fin:
+            data = fin.read()
+        try:
+            names = [name for kind, name, _ in iter_snapshot(data) if kind == b'F']
+        except ValueError as e:
+            raise Exception("restore: %s: %s" % (archive, e))
+        files = len(names)
+        stream, wbits = data[len(SNAPSHOT_MAGIC):], 0
+        if self.compress:
+            stream, wbits = self.compress_data(archive, stream, self.compress_wbits)
+        if dst != "/":
+            self.makedirs(dst)
+        self.load_agent_extension("snapshot")
+        self.logger("RESTORE %s -> %s (%d files)\n    " % (archive, dst, files))
+        started = time.time()
+        with self.measure(self.file_stats, path=archive, action="restore"):
+            self.exec_raw_start("print(repr(_sy_restore(%s,%d,%d,%d)))" % (
+                repr(dst), len(stream), self.max_frame_size, wbits))
+            self._put_frames(stream, archive, self._progress_logger(len(stream)))
+            restored, bad = eval(self.exec_raw_follow())
+        self.manifest_drops.update(dst.rstrip('/') + '/' + name for name in names)
+        self.logger(' -- %s OK\n' % self._format_speed(len(stream), started))
+        if bad:
+            raise EspException("Checksum error after restoring %s" % ", ".join(bad))
+        return restored
+
+
+def add_operation_arguments(parser):
+    """Options of a single operation. They can be given on the command line, and in every line of a batch."""
+    parser.add_argument("-o", "--overwrite", dest='overwrite', action="store_true", default=False,
+                        help="Overwrite (for upload/download)")
+    parser.add_argument("-c", "--contents", dest='contents', action="store_true", default=False,
+                        help="Copy contents of the source directory, instead of the source directory itself.")
+    parser.add_argument("-q", "--quick", dest='quick', action="store_true", default=False,
+                        help="Copy only if file size is different.")
+    parser.add_argument("--checksum", dest='checksum', action="store_true", default=False,
+                        help="Copy only if the SHA-256 hash of the file is different. Hashes of the files on the"
+                             " device are cached in %s. Requires the %s protocol." % (MANIFEST_PATH, PROTOCOL_RAW))
+    parser.add_argument("-z", "--compress", dest='compress', action="store_true", default=False,
+                        help="Upload files deflate compressed, they are decompressed on the device. Files that"
+                             " are compressed already (e.g. *.gz) are sent as they are. Requires the %s"
+                             " protocol." % PROTOCOL_RAW)
+    parser.add_argument("--rehash", dest='rehash', action="store_true", default=False,
+                        help="With --checksum: ignore the cached hashes, and hash all files on the device again.")
+    parser.add_argument("--output", dest='output', default=None,
+                        help="Output file. Messages received from MCU will be written here. For stdout, use '-'.")
+    parser.add_argument("--reload", dest='reload', choices=RELOAD_MODES, default=RESET_SOFT,
+                        help="What live_test_file does before it runs the changed script again. '%s' and '%s'"
+                             " reset the device (see --reset), '%s' only interrupts the running program, and"
+                             " reloads the changed library modules. Default is %s." % (
+                                 RESET_HARD, RESET_SOFT, RELOAD_MODULES, RESET_SOFT))
+    parser.add_argument("--debounce", dest='debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help="live_test_file waits until the watched files were not changed for this long"
+                             " (seconds), default is %s" % DEFAULT_DEBOUNCE)
+
+
+def add_session_arguments(parser):
+    """Options of a session with a device, except the port."""
+    parser.add_argument("-b", "--baudrate", dest='baudrate', type=int, default=DEFAULT_BAUD_RATE,
+                        help="Baud rate, default is %s" % DEFAULT_BAUD_RATE)
+    parser.add_argument("-t", "--timeout", dest='timeout', type=int, default=DEFAULT_TIMEOUT,
+                        help="Timeout, default is %s. Any non-positive value means infinite." % DEFAULT_TIMEOUT)
+    parser.add_argument("--protocol", dest='protocol', choices=PROTOCOLS, default=PROTOCOL_RAW,
+                        help="REPL protocol. 'raw' streams files through an agent in raw-paste mode,"
+                             " 'repl' uses the (slow) friendly REPL. Default is %s." % PROTOCOL_RAW)
+    parser.add_argument("--frame-size", dest='frame_size', type=int, default=DEFAULT_FRAME_SIZE,
+                        help="Initial frame size for file transfers in raw protocol mode, default is %s."
+                             " It is adapted to errors and to the free heap of the device." % DEFAULT_FRAME_SIZE)
+    parser.add_argument("--fast-baudrate", dest='fast_baudrate', default="auto",
+                        help="Switch the device and the port to a higher baud rate for the session, and switch"
+                             " back at the end. It falls back to the original baud rate when the link does not"
+                             " work. 'auto' tries %s for uploads and downloads, 'off' disables it. Or give a"
+                             " single baud rate. Requires the %s protocol." % (
+                                 ", ".join(str(rate) for rate in FAST_BAUD_RATES), PROTOCOL_RAW))
+    parser.add_argument("--window", dest='window', type=int, default=DEFAULT_WINDOW,
+                        help="Maximum number of frames in flight when uploading in raw protocol mode,"
+                             " default is %s" % DEFAULT_WINDOW)
+
+    parser.add_argument("--reset", dest='reset', choices=RESET_MODES, default=RESET_HARD,
+                        help="How the device is reset at the start of the session. '%s' uses the RTS and DTR"
+                             " lines, '%s' interrupts the running program and reboots MicroPython with Ctrl-D."
+                             " Default is %s." % (RESET_HARD, RESET_SOFT, RESET_HARD))
+
+
+class BatchArgumentParser(argparse.ArgumentParser):
+    """Parser for the lines of a batch. Errors are raised instead of exiting."""
+
+    def __init__(self, defaults):
+        super().__init__(prog=Commands.BATCH.value, add_help=False)
+        add_operation_arguments(self)
+        self.add_argument(dest='command', choices=BATCH_COMMANDS)
+        self.add_argument(dest='params', default=[], nargs='*')
+        # Options given on the command line apply to all operations.
+        self.set_defaults(**{action.dest: getattr(defaults, action.dest) for action in self._actions
+                             if action.dest not in ['command', 'params'] and hasattr(defaults, action.dest)})
+
+    def error(self, message):
+        raise ValueError(message)
 
 
 class Main:
     def __init__(self, args):
         self.args = args
+        # The EspSyncer of the current session
+        self.syncer = None
 
     def log(self, s):
         if self.args.verbose:
             sys.stdout.write(s)
             sys.stdout.flush()
 
+    def read_batch(self, path):
+        """Read the operations of a batch, from a file or from stdin ("-").
+
+        Every line is an operation, with the same syntax as the command line: options, a command (see
+        BATCH_COMMANDS) and its parameters. Quote the parameters as in a POSIX shell. Empty lines and lines
+        starting with # are ignored.
+
+        :return: A list of (line number, args) for the operations.
+        """
+        if path == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(path, "r", encoding="UTF-8") as fin:
+                lines = fin.read().splitlines()
+        parser = BatchArgumentParser(self.args)
+        operations = []
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                operations.append((lineno, parser.parse_args(shlex.split(line))))
+            except ValueError as e:
+                raise SystemExit("%s:%d: %s" % (path, lineno, e))
+        return operations
+
+    def get_operations(self, command, params):
+        """Operations of a command: the lines of a batch, or the command itself. See read_batch."""
+        if command == Commands.BATCH.value:
+            if len(params) != 1:
+                raise SystemExit("batch takes a single file name argument (or use '-' for stdin)")
+            return self.read_batch(params[0])
+        self.args.command, self.args.params = command, params
+        return [(None, self.args)]
+
     def run(self, command, params):
+        operations = self.get_operations(command, params)
+        self.run_session(operations, params[0] if command == Commands.BATCH.value else None)
+
+    def run_session(self, operations, batch_name=None):
+        """Run operations (see get_operations) in a single session with the device on self.args.port.
+
+        :param batch_name: Name of the batch file, for the log.
+        :return: The EspSyncer of the session.
+        """
         started = time.time()
         with serial.Serial(self.args.port, baudrate=self.args.baudrate, timeout=self.args.timeout) as ser:
-            syncer = EspSyncer(ser, self.args.timeout, self.log)
+            self.syncer = syncer = EspSyncer(ser, self.args.timeout, self.log, self.args.protocol,
+                                             self.args.frame_size, self.args.window, self.args.compress,
+                                             self.args.reset)
+            error = None
+            try:
+                self.run_operations(syncer, operations, batch_name)
+            except BaseException as e:
+                error = "%s: %s" % (e.__class__.__name__, e)
+                raise
+            finally:
+                if self.args.telemetry_report:
+                    self.write_report(syncer, started, error)
+        if self.args.verbose:
+            elapsed = time.time() - started
+            print("Total time elapsed: %.2fs" % elapsed)
+            if syncer.bytes_transferred:
+                print("Total transferred: %.2f KB, %.2f KB/s, %d retries" % (
+                    syncer.bytes_transferred / 1024.0, syncer.bytes_transferred / 1024.0 / elapsed, syncer.retries))
+            print("Serial line: %.2f KB sent, %.2f KB received, %d round trips, %.2fs waiting for the device" % (
+                syncer.bytes_sent / 1024.0, syncer.bytes_received / 1024.0, syncer.round_trips, syncer.wait_time))
+        return syncer
+
+    def connect(self, syncer, fast_baudrates):
+        """Reset the device, and switch the baud rate when needed."""
+        with syncer.measure(syncer.phase_stats, phase="reset"):
             syncer.reset()
-            if command == Commands.RESET.value:
-                # syncer.reset()
-                pass
-            elif command == Commands.LS.value:
-                print(syncer.ls(params[0]))
-            elif command == Commands.MKDIR.value:
-                self.log("MKDIR " + params[0] + "\n")
-                syncer.mkdir(params[0])
-            elif command == Commands.MAKEDIRS.value:
-                self.log("MAKEDIRS " + params[0] + "\n")
-                syncer.makedirs(params[0])
-            elif command == Commands.RMTREE.value:
-                syncer.rmtree(params[0])
-            elif command == Commands.UPLOAD.value:
-                syncer.upload(params[0], params[1], self.args.contents, self.args.overwrite, self.args.quick)
-            elif command == Commands.DOWNLOAD.value:
-                syncer.download(params[0], params[1], self.args.contents, self.args.overwrite, self.args.quick)
-            elif command in [Commands.EXECUTE_FILE.value, Commands.LIVE_TEST_FILE.value]:
-                if args.output:
-                    if args.output == "-":
-                        fout = sys.stdout
-                        stdout_encoding = "utf-8"
-                    else:
-                        fout = open(args.output, "ba")
-                        stdout_encoding = None
+        if fast_baudrates:
+            with syncer.measure(syncer.phase_stats, phase="negotiate_baudrate"):
+                syncer.negotiate_baudrate(fast_baudrates)
+
+    def run_operations(self, syncer, operations, batch_name):
+        """Reset the device, switch the baud rate when needed, and run the operations. Every step is a phase of
+        the telemetry (see EspSyncer.measure). When the session ends with a reset of the device (see
+        EspSyncer.execute), the device is left alone: it is at its boot baud rate already."""
+        fast_baudrates = self.get_fast_baudrates([op_args.command for _, op_args in operations])
+        self.connect(syncer, fast_baudrates)
+        try:
+            for lineno, op_args in operations:
+                if syncer.rebooted:
+                    # The code of an execute operation has reset the device, in the middle of the batch.
+                    self.connect(syncer, fast_baudrates)
+                if lineno is not None:
+                    self.log("BATCH %s:%d: %s\n" % (batch_name, lineno, op_args.command))
+                syncer.compress = op_args.compress
+                with syncer.measure(syncer.phase_stats, phase=op_args.command, params=op_args.params,
+                                    line=lineno):
+                    self.run_command(syncer, op_args.command, op_args.params, op_args)
+            # Forget the hashes of the files that were written or deleted by the operations.
+            syncer.save_manifest()
+        finally:
+            if fast_baudrates and not syncer.rebooted:
+                try:
+                    with syncer.measure(syncer.phase_stats, phase="restore_baudrate"):
+                        syncer.restore_baudrate()
+                except (TimeoutError, EspException) as e:
+                    # Do not hide the original error. The device is at its boot baud rate after a reset.
+                    sys.stderr.write("Could not restore the baud rate of the device: %s\n" % e)
+
+    def write_report(self, syncer, started, error):
+        """Write the telemetry of the session into the file given with --report, as JSON."""
+        duration = time.time() - started
+        totals = syncer.counters()
+        totals["duration"] = duration
+        totals["throughput"] = totals["bytes"] / duration if duration > 0 else 0.0
+        with open(self.args.telemetry_report, "w") as fout:
+            json.dump({
+                "port": self.args.port,
+                "protocol": self.args.protocol,
+                "baudrate": syncer.ser.baudrate,
+                "started": started,
+                "error": error,
+                "totals": totals,
+                "phases": syncer.phase_stats,
+                "files": syncer.file_stats,
+            }, fout, indent=2)
+
+    def get_fast_baudrates(self, commands):
+        """Baud rates to be tried for a session that runs the given commands, highest first."""
+        if self.args.fast_baudrate == "off":
+            return []
+        elif self.args.fast_baudrate == "auto":
+            # Only worth it when files are transferred.
+            if self.args.protocol == PROTOCOL_RAW and \
+                    set(commands) & {Commands.UPLOAD.value, Commands.DOWNLOAD.value, Commands.SNAPSHOT.value,
+                                     Commands.RESTORE.value}:
+                return FAST_BAUD_RATES
+            return []
+        else:
+            return [int(self.args.fast_baudrate)]
+
+    def run_command(self, syncer, command, params, args):
+        if command == Commands.RESET.value:
+            # syncer.reset()
+            pass
+        elif command == Commands.LS.value:
+            print(syncer.ls(params[0]))
+        elif command == Commands.MKDIR.value:
+            self.log("MKDIR " + params[0] + "\n")
+            syncer.mkdir(params[0])
+        elif command == Commands.MAKEDIRS.value:
+            self.log("MAKEDIRS " + params[0] + "\n")
+            syncer.makedirs(params[0])
+        elif command == Commands.RMTREE.value:
+            syncer.rmtree(params[0])
+        elif command == Commands.UPLOAD.value:
+            syncer.upload(params[0], params[1], args.contents, args.overwrite, args.quick,
+                          args.checksum, args.rehash)
+        elif command == Commands.DOWNLOAD.value:
+            syncer.download(params[0], params[1], args.contents, args.overwrite, args.quick,
+                            args.checksum, args.rehash)
+        elif command == Commands.SNAPSHOT.value:
+            if len(params) != 2:
+                raise SystemExit("snapshot takes a source path on the device and an archive file name")
+            syncer.snapshot(params[0], params[1])
+        elif command == Commands.RESTORE.value:
+            if len(params) not in [1, 2]:
+                raise SystemExit("restore takes an archive file name and an optional destination directory")
+            syncer.restore(params[0], params[1] if len(params) > 1 else "/")
+        elif command in [Commands.EXECUTE_FILE.value, Commands.LIVE_TEST_FILE.value]:
+            if args.output:
+                if args.output == "-":
+                    fout = sys.stdout
+                    stdout_encoding = "utf-8"
                 else:
-                    fout = None
+                    fout = open(args.output, "ba")
                     stdout_encoding = None
-                if not params:
-                    raise SystemExit("execute_file takes a filename argument (or use '--' for stdin)")
-                watch_file_path = None
-                if params[0] == "-":
-                    fin = sys.stdin
-                    stdin_encoding = "utf-8"
-                    is_regular_file = False
-                    if command == Commands.LIVE_TEST_FILE.value:
-                        raise SystemExit("cannot live test stdin, it would not be possible to watch for changes")
-                else:
-                    fin = open(params[0], "rb")
-                    stdin_encoding = None
-                    is_regular_file = True
-                    if command == Commands.LIVE_TEST_FILE.value:
-                        watch_file_path = params[0]
+            else:
+                fout = None
+                stdout_encoding = None
+            if not params:
+                raise SystemExit("execute_file takes a filename argument (or use '--' for stdin)")
+            watcher = None
+            if params[0] == "-":
+                fin = sys.stdin
+                stdin_encoding = "utf-8"
+                is_regular_file = False
+                if command == Commands.LIVE_TEST_FILE.value:
+                    raise SystemExit("cannot live test stdin, it would not be possible to watch for changes")
+            else:
+                fin = open(params[0], "rb")
+                stdin_encoding = None
+                is_regular_file = True
+                if command == Commands.LIVE_TEST_FILE.value:
+                    if len(params) not in [1, 3]:
+                        raise SystemExit("live_test_file takes a filename, and optionally a local library"
+                                         " directory and its path on the device")
+                    watcher = FileWatcher(params[:1] + params[1:2], args.debounce)
+                    self.log("WATCH %s (%s)\n" % (" ".join(params[:2]), watcher.method))
+            try:
                 while True:
-                    rerun = syncer.communicate(fin, fout, stdin_encoding, stdout_encoding,
-                                               watch_file_path=watch_file_path, no_select=is_regular_file,
-                                               timeout=args.timeout)
-                    if rerun:
-                        fin.close()
-                        fin = open(params[0], "rb")
-                        syncer.reset()
-                    else:
+                    changed = syncer.communicate(fin, fout, stdin_encoding, stdout_encoding,
+                                                 watcher=watcher, no_select=is_regular_file,
+                                                 timeout=args.timeout)
+                    if not changed:
                         break
-
-            elif command == Commands.EXECUTE.value:
-                self.log(params[0])
-                syncer(params[0], expect_echo=False)
-            elif command == Commands.COMMUNICATE.value:
-                syncer.communicate(stdin=sys.stdin, stdout=sys.stdout)
-            else:
-                parser.error("Invalid command: %s" % command)
-        if self.args.verbose:
-            print("Total time elapsed: %.2fs" % (time.time() - started))
+                    self.log("CHANGED %s\n" % " ".join(sorted(changed)))
+                    fin.close()
+                    fin = open(params[0], "rb")
+                    if args.reload == RELOAD_MODULES:
+                        syncer.interrupt()
+                    else:
+                        syncer.reset(mode=args.reload)
+                    if len(params) == 3:
+                        syncer.reload_modules(changed, params[1], params[2])
+            finally:
+                fin.close()
+                if watcher:
+                    watcher.close()
+
+        elif command == Commands.EXECUTE.value:
+            self.log(params[0] + "\n")
+            # The code may reset the device, then the manifest could not be saved at the end of the session.
+            syncer.save_manifest()
+            output = syncer.execute(params[0])
+            if output and not output.endswith("\n"):
+                # After a reset, the output ends with the prompt of the friendly REPL.
+                output += "\n"
+            sys.stdout.write(output)
+            sys.stdout.flush()
+        elif command == Commands.COMMUNICATE.value:
+            syncer.communicate(stdin=sys.stdin, stdout=sys.stdout)
+        else:
+            parser.error("Invalid command: %s" % command)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Copy directory structures to ESP8266')
     parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
                         help="Be verbose")
-    parser.add_argument("-o", "--overwrite", dest='overwrite', action="store_true", default=False,
-                        help="Overwrite (for upload/download)")
-    parser.add_argument("-c", "--contents", dest='contents', action="store_true", default=False,
-                        help="Copy contents of the source directory, instead of the source directory itself.")
-    parser.add_argument("-q", "--quick", dest='quick', action="store_true", default=False,
-                        help="Copy only if file size is different.")
+    add_operation_arguments(parser)
 
-    parser.add_argument("-b", "--baudrate", dest='baudrate', type=int, default=DEFAULT_BAUD_RATE,
-                        help="Baud rate, default is %s" % DEFAULT_BAUD_RATE)
-    parser.add_argument("-t", "--timeout", dest='timeout', type=int, default=DEFAULT_TIMEOUT,
-                        help="Timeout, default is %s. Any non-positive value means infinite." % DEFAULT_TIMEOUT)
     parser.add_argument("-p", "--port", dest='port', help="Port to be used", default=None)
-
-    parser.add_argument("--output", dest='output', default=None,
-                        help="Output file. Messages received from MCU will be written here. For stdout, use '-'.")
+    add_session_arguments(parser)
+    parser.add_argument("--report", dest='telemetry_report', default=None,
+                        help="Write the telemetry of the session into this file, as JSON: bytes sent and received,"
+                             " round trips, time spent waiting for the device and retries, in total, for every"
+                             " phase and for every file.")
 
     parser.add_argument(dest='command', default=None,
                         help="Command to be executed. Valid commands are:  " + "\n    ".join(VALID_COMMANDS) +
-                             " For reading data from stdin, use execute_file -")
+                             " For reading data from stdin, use execute_file -. The batch command runs the"
+                             " operations listed in a file (or stdin: batch -) in a single session, one per line,"
+                             " e.g. '--overwrite --contents upload libs /'.")
     parser.add_argument(dest='params', default=[], nargs='*')
 
     args = parser.parse_args()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Benchmark suite for espsyncer.py, on an emulated device.
+
+Every scenario runs against a fresh esp_emulator.EspEmulator (a MicroPython REPL on a pseudo terminal),
+with the line throttled to the given baud rate and a latency added to every turnaround. For each scenario,
+the wall time, the throughput, the number of round trips (the device started to wait for input), the bytes
+sent in both directions and the retries are reported, so protocol changes can be compared without a board.
+
+    espsyncer_bench.py --latency 0.005 --protocol raw --protocol repl --json bench.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import serial
+
+import espsyncer
+from esp_emulator import EspEmulator
+
+DEFAULT_BAUD_RATE = 115200
+DEFAULT_LATENCY = 0.002
+DEFAULT_FILES = 20
+DEFAULT_FILE_SIZE = 2048
+# Scenarios, in the order they are run. Each of them starts with a fresh session.
+SCENARIOS = [
+    "upload",  # Upload the source tree to an empty device
+    "sync_quick",  # Upload again with --quick, nothing has changed
+    "sync_checksum",  # Upload again with --checksum, one file has changed
+    "download",  # Download the whole tree
+    "snapshot",  # Snapshot of the whole tree
+]
+# Scenarios that can be used with the repl protocol
+REPL_SCENARIOS = ["upload", "sync_quick", "download"]
+
+
+def make_source_tree(path, files, file_size):
+    """Create a tree with python sources (compressible) and binary files (not compressible)."""
+    rnd = random.Random(files * 1000 + file_size)
+    for idx in range(files):
+        dpath = os.path.join(path, "lib" if idx % 2 else os.path.join("www", "static"))
+        os.makedirs(dpath, exist_ok=True)
+        if idx % 2:
+            line = "value_%d = %r\n" % (idx, "x" * rnd.randrange(10, 60))
+            data = (line * (file_size // len(line) + 1))[:file_size].encode("ascii")
+            fname = "module_%d.py" % idx
+        else:
+            data = bytes(rnd.randrange(256) for _ in range(file_size))
+            fname = "asset_%d.bin" % idx
+        with open(os.path.join(dpath, fname), "wb") as fout:
+            fout.write(data)
+
+
+def tree_size(path):
+    total = 0
+    for dpath, dnames, fnames in os.walk(path):
+        for fname in fnames:
+            total += os.path.getsize(os.path.join(dpath, fname))
+    return total
+
+
+class Main:
+    def __init__(self, args):
+        self.args = args
+
+    def log(self, s):
+        if self.args.verbose:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+    def scenario(self, name, protocol, device_root, src, workdir):
+        """Run a single scenario in a new session. Returns (transferred bytes, syncer, emulator, elapsed)."""
+        emulator = EspEmulator(device_root, self.args.baudrate, self.args.latency,
+                               error_rate=self.args.error_rate).start()
+        try:
+            with serial.Serial(emulator.port, self.args.baudrate, timeout=self.args.timeout) as ser:
+                syncer = espsyncer.EspSyncer(ser, self.args.timeout, self.log, protocol, compress=self.args.compress,
+                                             reset_mode=espsyncer.RESET_SOFT)
+                syncer.reset()
+                if self.args.fast_baudrate and protocol == espsyncer.PROTOCOL_RAW:
+                    syncer.negotiate_baudrate([self.args.fast_baudrate])
+                round_trips, bytes_in, bytes_out = emulator.round_trips, emulator.bytes_in, emulator.bytes_out
+                started = time.perf_counter()
+                if name == "upload":
+                    syncer.upload(src, "/", True, True, False)
+                elif name == "sync_quick":
+                    syncer.upload(src, "/", True, True, True)
+                elif name == "sync_checksum":
+                    fpath = os.path.join(src, "lib", "module_1.py")
+                    with open(fpath, "ab") as fout:
+                        fout.write(b"changed = True\n")
+                    syncer.upload(src, "/", True, True, False, checksum=True)
+                elif name == "download":
+                    dst = os.path.join(workdir, "download")
+                    shutil.rmtree(dst, ignore_errors=True)
+                    os.makedirs(dst)
+                    syncer.download("/", dst, True, True, False)
+                elif name == "snapshot":
+                    syncer.snapshot("/", os.path.join(workdir, "bench.snap"))
+                elapsed = time.perf_counter() - started
+                if self.args.fast_baudrate and protocol == espsyncer.PROTOCOL_RAW:
+                    syncer.restore_baudrate()
+            return {
+                "scenario": name,
+                "protocol": protocol,
+                "duration": elapsed,
+                "bytes": syncer.bytes_transferred,
+                "kb_per_sec": syncer.bytes_transferred / 1024.0 / elapsed if elapsed else 0.0,
+                "round_trips": emulator.round_trips - round_trips,
+                "bytes_to_device": emulator.bytes_in - bytes_in,
+                "bytes_from_device": emulator.bytes_out - bytes_out,
+                "retries": syncer.retries,
+            }
+        finally:
+            emulator.close()
+
+    def print_results(self, results):
+        print("%-14s %-8s %9s %10s %9s %8s %10s %10s %7s" % (
+            "Scenario", "Protocol", "Time", "Files KB", "KB/s", "Trips", "To dev KB", "From KB", "Retries"))
+        for result in results:
+            print("%-14s %-8s %8.2fs %10.2f %9.2f %8d %10.2f %10.2f %7d" % (
+                result["scenario"], result["protocol"], result["duration"], result["bytes"] / 1024.0,
+                result["kb_per_sec"], result["round_trips"], result["bytes_to_device"] / 1024.0,
+                result["bytes_from_device"] / 1024.0, result["retries"]))
+
+    def run(self):
+        results = []
+        with tempfile.TemporaryDirectory(prefix="espsyncer_bench_") as workdir:
+            for protocol in self.args.protocols:
+                src = os.path.join(workdir, "src")
+                device_root = os.path.join(workdir, "device")
+                for path in [src, device_root]:
+                    shutil.rmtree(path, ignore_errors=True)
+                    os.makedirs(path)
+                make_source_tree(src, self.args.files, self.args.file_size)
+                self.log("SOURCE %d files, %.2f KB\n" % (self.args.files, tree_size(src) / 1024.0))
+                for name in self.args.scenarios:
+                    if protocol == espsyncer.PROTOCOL_REPL and name not in REPL_SCENARIOS:
+                        continue
+                    self.log("SCENARIO %s %s\n" % (name, protocol))
+                    results.append(self.scenario(name, protocol, device_root, src, workdir))
+
+        self.print_results(results)
+        if self.args.json:
+            with open(self.args.json, "w") as fout:
+                json.dump({
+                    "baudrate": self.args.baudrate,
+                    "latency": self.args.latency,
+                    "files": self.args.files,
+                    "file_size": self.args.file_size,
+                    "compress": self.args.compress,
+                    "results": results,
+                }, fout, indent=2)
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark espsyncer on an emulated device')
+    parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
+                        help="Be verbose")
+    parser.add_argument("-b", "--baudrate", dest='baudrate', type=int, default=DEFAULT_BAUD_RATE,
+                        help="Baud rate of the emulated line, default is %s" % DEFAULT_BAUD_RATE)
+    parser.add_argument("-l", "--latency", dest='latency', type=float, default=DEFAULT_LATENCY,
+                        help="Latency of turnarounds in seconds, default is %s" % DEFAULT_LATENCY)
+    parser.add_argument("-e", "--error-rate", dest='error_rate', type=float, default=0.0,
+                        help="Probability of corrupting the data read by programs on the device, default is 0.")
+    parser.add_argument("--protocol", dest='protocols', action="append", choices=espsyncer.PROTOCOLS,
+                        default=None, help="Protocol to be measured, can be given multiple times. Default is %s."
+                                           % espsyncer.PROTOCOL_RAW)
+    parser.add_argument("-s", "--scenario", dest='scenarios', action="append", choices=SCENARIOS, default=None,
+                        help="Scenario to be run, can be given multiple times. Default is all of them: %s"
+                             % ", ".join(SCENARIOS))
+    parser.add_argument("-f", "--files", dest='files', type=int, default=DEFAULT_FILES,
+                        help="Number of files in the source tree, default is %s" % DEFAULT_FILES)
+    parser.add_argument("--file-size", dest='file_size', type=int, default=DEFAULT_FILE_SIZE,
+                        help="Size of the files in the source tree, default is %s" % DEFAULT_FILE_SIZE)
+    parser.add_argument("-z", "--compress", dest='compress', action="store_true", default=False,
+                        help="Compressed uploads")
+    parser.add_argument("--fast-baudrate", dest='fast_baudrate', type=int, default=None,
+                        help="Switch to this baud rate in each session (raw protocol only). Default is to stay at"
+                             " the initial baud rate.")
+    parser.add_argument("-t", "--timeout", dest='timeout', type=int, default=espsyncer.DEFAULT_TIMEOUT,
+                        help="Timeout, default is %s" % espsyncer.DEFAULT_TIMEOUT)
+    parser.add_argument("--json", dest='json', default=None,
+                        help="Write a machine readable report to this file.")
+
+    args = parser.parse_args()
+    if not args.protocols:
+        args.protocols = [espsyncer.PROTOCOL_RAW]
+    if not args.scenarios:
+        args.scenarios = SCENARIOS
+    Main(args).run()
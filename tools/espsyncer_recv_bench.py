@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for the serial receive buffer of espsyncer.
+
+A pseudo terminal pair stands in for the device: a thread writes large outputs (followed by the REPL prompt)
+into the master side, and EspSyncer.recv() reads them from the slave side through pyserial. The same is done
+with the old receiver, that read the port byte by byte, concatenated bytes objects, and searched the whole
+buffer for the terminator after every byte.
+"""
+import argparse
+import os
+import pty
+import sys
+import threading
+import time
+import tty
+
+import serial
+
+import espsyncer
+
+DEFAULT_SIZES = [16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024]
+DEFAULT_REPEAT = 3
+# The old receiver is quadratic, it is not measured above this size unless --legacy-max-size is changed.
+DEFAULT_LEGACY_MAX_SIZE = 64 * 1024
+
+
+class LegacyEspSyncer(espsyncer.EspSyncer):
+    """EspSyncer with the receive buffer implementation that was used before bytearray buffers."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = b''
+
+    def recv(self, terminator=espsyncer.DEFAULT_TERMINATOR, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        started = time.time()
+        with self._port_timeout(timeout):
+            while terminator not in self.buffer:
+                data = self.ser.read()
+                self.buffer += data
+                elapsed = time.time() - started
+                if timeout is not None and elapsed > timeout:
+                    raise TimeoutError
+
+        idx = self.buffer.find(terminator)
+        chunk = self.buffer[:idx]
+        self.buffer = self.buffer[idx + len(terminator):]
+        return chunk
+
+
+class Device(threading.Thread):
+    """Writes the payload and then the terminator into the master side of the pty."""
+
+    def __init__(self, fd, payload, terminator):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.data = payload + terminator
+
+    def run(self):
+        view = memoryview(self.data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+
+class Main:
+    def __init__(self, args):
+        self.args = args
+
+    def log(self, s):
+        if self.args.verbose:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+    def measure(self, cls, size):
+        """Receive a payload of the given size with cls, and return the elapsed time (best of repeat)."""
+        payload = bytes(range(32, 127)) * (size // 95 + 1)
+        payload = payload[:size]
+        best = None
+        for _ in range(self.args.repeat):
+            master, slave = pty.openpty()
+            tty.setraw(master)
+            try:
+                ser = serial.Serial(os.ttyname(slave), self.args.baudrate, timeout=5)
+                syncer = cls(ser, self.args.timeout, self.log)
+                device = Device(master, payload, espsyncer.DEFAULT_TERMINATOR)
+                started = time.perf_counter()
+                device.start()
+                result = syncer.recv()
+                elapsed = time.perf_counter() - started
+                device.join()
+                ser.close()
+            finally:
+                os.close(master)
+                os.close(slave)
+            if result != payload:
+                raise SystemExit("%s received %d bytes instead of %d" % (cls.__name__, len(result), size))
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def run(self):
+        print("Size        legacy             bytearray")
+        for size in self.args.sizes:
+            current = self.measure(espsyncer.EspSyncer, size)
+            if size <= self.args.legacy_max_size:
+                legacy = self.measure(LegacyEspSyncer, size)
+                legacy_text = "%7.3fs %6.2f MB/s" % (legacy, size / legacy / 1e6)
+            else:
+                legacy = None
+                legacy_text = "%18s" % "skipped"
+            line = "%-8s %s  %7.3fs %6.2f MB/s" % (
+                "%dK" % (size // 1024), legacy_text, current, size / current / 1e6)
+            if legacy:
+                line += "  x%.1f" % (legacy / current)
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the espsyncer receive buffer over a pty pair')
+    parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
+                        help="Be verbose")
+    parser.add_argument("-s", "--size", dest='sizes', type=int, action="append", default=None,
+                        help="Output size in bytes, can be given multiple times. Default is %s."
+                             % ", ".join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument("-r", "--repeat", dest='repeat', type=int, default=DEFAULT_REPEAT,
+                        help="Repeat each measurement this many times and keep the best, default is %s"
+                             % DEFAULT_REPEAT)
+    parser.add_argument("--legacy-max-size", dest='legacy_max_size', type=int, default=DEFAULT_LEGACY_MAX_SIZE,
+                        help="Do not measure the old receiver above this size, default is %s"
+                             % DEFAULT_LEGACY_MAX_SIZE)
+    parser.add_argument("-b", "--baudrate", dest='baudrate', type=int, default=115200,
+                        help="Baud rate of the pty. It does not limit the speed of a pty.")
+    parser.add_argument("-t", "--timeout", dest='timeout', type=float, default=60,
+                        help="Receive timeout, default is 60")
+
+    args = parser.parse_args()
+    if not args.sizes:
+        args.sizes = DEFAULT_SIZES
+    Main(args).run()
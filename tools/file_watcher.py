@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Watch local files and directories for changes.
+
+On Linux, changes are reported by inotify (through ctypes, there are no other dependencies), so they are
+noticed at once and nothing is polled. Everywhere else (or when inotify is not available), the watched
+files are checked with os.stat() periodically. Editors often save a file in several steps (write a backup,
+truncate, write, rename), so changes are only reported after the files were quiet for a short time.
+
+    watcher = FileWatcher(["test.py", "libs"])
+    while True:
+        for path in watcher.wait():
+            print("changed:", path)
+"""
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import sys
+import time
+
+# Changes are reported when there was no other change for this long (seconds).
+DEFAULT_DEBOUNCE = 0.3
+# Without inotify, the files are checked this often (seconds).
+DEFAULT_POLL_INTERVAL = 0.5
+# Temporary and backup files of editors, they are not reported.
+IGNORED_PATTERNS = [".*", "*~", "#*#", "*.swp", "*.swx", "*.tmp", "4913", "__pycache__"]
+
+# See inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def is_ignored(path):
+    return any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in IGNORED_PATTERNS)
+
+
+def _load_inotify():
+    """Return libc if it has inotify, or None."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class FileWatcher:
+    def __init__(self, paths, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        """Watch files and directories (recursively).
+
+        :param paths: Files and directories to be watched.
+        :param debounce: Changes are reported when the files were not changed for this long (seconds).
+        :param poll_interval: Check the files this often when inotify is not available (seconds).
+        :param use_inotify: Set this to False to always poll.
+        """
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.pending = set()
+        self.last_change = None
+        self.fd = None
+        self.libc = _load_inotify() if use_inotify else None
+        if self.libc:
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self.fd < 0:
+                self.fd = None
+        # inotify watch descriptor -> watched directory
+        self.watches = {}
+        if self.fd is not None:
+            for path in self.paths:
+                # Editors often replace files by renaming, so the directory of a file is watched.
+                self._add_watch(path if os.path.isdir(path) else os.path.dirname(path))
+        else:
+            self.snapshot = self.scan()
+            self.last_poll = time.time()
+
+    @property
+    def method(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def quiet_time(self):
+        """Changes are reported after this long without changes. When polling, there must be a poll in between,
+        that found nothing."""
+        return self.debounce if self.fd is not None else max(self.debounce, self.poll_interval)
+
+    def fileno(self):
+        """File descriptor that becomes readable on changes, or None when the files are polled."""
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _add_watch(self, dpath):
+        for subdir, dnames, fnames in os.walk(dpath):
+            dnames[:] = [dname for dname in dnames if not is_ignored(dname)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(subdir), WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = subdir
+            if subdir == dpath and not any(path == dpath for path in self.paths):
+                # The directory of a watched file, it is not recursive.
+                break
+
+    def is_watched(self, path):
+        """Tell if a path is one of the watched files, or it is in one of the watched directories."""
+        if is_ignored(path):
+            return False
+        for watched in self.paths:
+            if path == watched or path.startswith(watched.rstrip(os.sep) + os.sep):
+                return True
+        return False
+
+    def scan(self):
+        """Return (modification time, size) for all watched files."""
+        result = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                for dpath, dnames, fnames in os.walk(path):
+                    dnames[:] = [dname for dname in dnames if not is_ignored(dname)]
+                    for fname in fnames:
+                        fpath = os.path.join(dpath, fname)
+                        if not is_ignored(fpath):
+                            try:
+                                st = os.stat(fpath)
+                            except OSError:
+                                continue
+                            result[fpath] = (st.st_mtime_ns, st.st_size)
+            else:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                result[path] = (st.st_mtime_ns, st.st_size)
+        return result
+
+    def _read_events(self):
+        """Read the inotify events that are waiting, and return the changed paths."""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            idx = 0
+            while idx < len(data):
+                wd, mask, cookie, size = INOTIFY_EVENT.unpack_from(data, idx)
+                idx += INOTIFY_EVENT.size
+                name = os.fsdecode(data[idx:idx + size].rstrip(b"\0"))
+                idx += size
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, report everything.
+                    changed.update(self.scan())
+                    continue
+                dpath = self.watches.get(wd)
+                if dpath is None or not name:
+                    continue
+                path = os.path.join(dpath, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and self.is_watched(path):
+                        self._add_watch(path)
+                        changed.update(fpath for fpath in self.scan() if fpath.startswith(path + os.sep))
+                elif self.is_watched(path):
+                    changed.add(path)
+        return changed
+
+    def _poll_changes(self):
+        snapshot = self.scan()
+        changed = {path for path in set(snapshot) | set(self.snapshot)
+                   if snapshot.get(path) != self.snapshot.get(path)}
+        self.snapshot = snapshot
+        self.last_poll = time.time()
+        return changed
+
+    def poll(self):
+        """Check for changes without blocking.
+
+        :return: Set of the changed (created, modified or deleted) paths, after they were quiet for the debounce
+            time. Until then, the set is empty.
+        """
+        if self.fd is not None:
+            changed = self._read_events()
+        elif time.time() - self.last_poll >= self.poll_interval:
+            changed = self._poll_changes()
+        else:
+            changed = set()
+        now = time.time()
+        if changed:
+            self.pending |= changed
+            self.last_change = now
+        if self.pending and now - self.last_change >= self.quiet_time():
+            result, self.pending = self.pending, set()
+            return result
+        return set()
+
+    def timeout(self):
+        """How long to wait for the next call of poll(), in seconds. None means until fileno() is readable."""
+        deadlines = []
+        if self.pending:
+            deadlines.append(self.last_change + self.quiet_time())
+        if self.fd is None:
+            deadlines.append(self.last_poll + self.poll_interval)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def wait(self, timeout=None):
+        """Wait for changes, and return the changed paths (see poll). Returns an empty set on timeout."""
+        started = time.time()
+        while True:
+            changed = self.poll()
+            if changed:
+                return changed
+            wait = self.timeout()
+            if timeout is not None:
+                remaining = started + timeout - time.time()
+                if remaining <= 0:
+                    return set()
+                wait = remaining if wait is None else min(wait, remaining)
+            if self.fd is not None:
+                select.select([self.fd], [], [], wait)
+            else:
+                time.sleep(wait)
@@ -0,0 +1,2 @@
+def osdebug(level):
+    pass
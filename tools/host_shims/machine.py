@@ -0,0 +1,14 @@
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+
+    def __init__(self, pin, mode=IN, pull=None):
+        self.pin = pin
+
+    def value(self, value=None):
+        return 1
+
+
+def reset():
+    raise SystemExit("machine.reset()")
@@ -0,0 +1,62 @@
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = 2
+STAT_NO_AP_FOUND = 3
+STAT_CONNECT_FAIL = 4
+STAT_GOT_IP = 5
+
+# (ssid, bssid, channel, RSSI, authmode, hidden) - the same as WLAN.scan() returns on the device.
+SCAN_RESULTS = [
+    (b'office', b'\x00\x11\x22\x33\x44\x55', 1, -48, 3, False),
+    (b'guest', b'\x00\x11\x22\x33\x44\x56', 6, -67, 0, False),
+    (b'neighbour', b'\x66\x77\x88\x99\xaa\xbb', 11, -81, 4, False),
+]
+# Number of status() calls that return STAT_CONNECTING after connect() is called.
+CONNECT_POLLS = 4
+IFCONFIG = ('192.168.1.50', '255.255.255.0', '192.168.1.1', '192.168.1.1')
+
+_interfaces = {}
+
+
+class WLAN:
+    """Interfaces share their state, just like on the device: WLAN(STA_IF) always returns the same interface."""
+
+    def __init__(self, interface_id=STA_IF):
+        if interface_id not in _interfaces:
+            _interfaces[interface_id] = {"active": False, "config": {}, "ssid": None, "polls": 0}
+        self._state = _interfaces[interface_id]
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._state["active"]
+        self._state["active"] = is_active
+
+    def config(self, **kwargs):
+        self._state["config"].update(kwargs)
+
+    def scan(self):
+        return list(SCAN_RESULTS)
+
+    def connect(self, ssid, password):
+        self._state["ssid"] = ssid
+        self._state["polls"] = CONNECT_POLLS
+
+    def disconnect(self):
+        self._state["ssid"] = None
+
+    def status(self):
+        if self._state["ssid"] is None:
+            return STAT_IDLE
+        if self._state["polls"] > 0:
+            self._state["polls"] -= 1
+            return STAT_CONNECTING
+        return STAT_GOT_IP
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self):
+        return IFCONFIG
@@ -0,0 +1,20 @@
+import time as _time
+
+sleep = _time.sleep
+time = _time.time
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000.0)
+
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000)
+
+
+def ticks_us():
+    return int(_time.monotonic() * 1000000)
+
+
+def ticks_diff(end, start):
+    return end - start
@@ -1,11 +1,22 @@
+import argparse
 import os
 import sys
 
 sys.path.insert(0, os.environ["MP_HOME"])
 from mp_tools import *
 
-esptool("--chip esp32 erase_flash")
-esptool("--chip esp32 --baud 460800 write_flash -z 0x1000 %s" % LATEST_ESP32_FIRMWARE_PATH)
+parser = argparse.ArgumentParser(
+    description='Flash the latest MicroPython firmware to ESP32, unless it is there already'
+                ' (the file system is kept)')
+parser.add_argument("--erase", dest='erase', action="store_true", default=False,
+                    help="Erase the whole flash (including the file system) before writing the firmware")
+parser.add_argument("--force", dest='force', action="store_true", default=False,
+                    help="Write the firmware even if the device has it already")
+args = parser.parse_args()
+
+if not reflash(["--chip", "esp32", "--baud", "460800"], "0x1000", latest_firmware_path("esp32"),
+               erase=args.erase, force=args.force):
+    sys.exit(0)
 
 print("""
 
@@ -1,11 +1,22 @@
+import argparse
 import os
 import sys
 
 sys.path.insert(0, os.environ["MP_HOME"])
 from mp_tools import *
 
-esptool("erase_flash")
-esptool("--baud 115200 write_flash --flash_size=detect 0 %s" % LATEST_ESP8266_FIRMWARE_PATH)
+parser = argparse.ArgumentParser(
+    description='Flash the latest MicroPython firmware to ESP8266, unless it is there already'
+                ' (the file system is kept)')
+parser.add_argument("--erase", dest='erase', action="store_true", default=False,
+                    help="Erase the whole flash (including the file system) before writing the firmware")
+parser.add_argument("--force", dest='force', action="store_true", default=False,
+                    help="Write the firmware even if the device has it already")
+args = parser.parse_args()
+
+if not reflash(["--baud", "115200"], "0", latest_firmware_path("esp8266"), ["--flash_size=detect"],
+               erase=args.erase, force=args.force):
+    sys.exit(0)
 
 print("""
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Tests of esp_fsimage.py, on an emulated device (see esp_emulator.py).
+
+    python3 -m unittest test_esp_fsimage
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import espsyncer
+import esp_fsimage
+from esp_emulator import EspEmulator
+
+TIMEOUT = 5
+# The emulated device has no flash, this is enough for the probe of the layout.
+FLASHBDEV = b"""
+class _Bdev:
+    START_SEC = 0x100
+    SEC_SIZE = 4096
+    blocks = 256
+
+    def readblocks(self, block, buf):
+        for idx in range(len(buf)):
+            buf[idx] = 0
+
+bdev = _Bdev()
+"""
+
+
+class KeepTest(unittest.TestCase):
+    """probe --keep must not leave files in --keep-dir that are not on the device."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_esp_fsimage_")
+        self.device_root = os.path.join(self.workdir, "device")
+        self.keep_dir = os.path.join(self.workdir, "keep")
+        os.makedirs(self.device_root)
+        with open(os.path.join(self.device_root, "flashbdev.py"), "wb") as fout:
+            fout.write(FLASHBDEV)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def probe(self):
+        with EspEmulator(self.device_root) as emulator:
+            args = argparse.Namespace(port=emulator.port, baudrate=espsyncer.DEFAULT_BAUD_RATE, timeout=TIMEOUT,
+                                      reset=espsyncer.RESET_SOFT, verbose=False, output=None,
+                                      keep=["/wifi.json", "/wifi_ap.json"], keep_dir=self.keep_dir)
+            return esp_fsimage.Main(args).probe()
+
+    def test_deleted_on_device(self):
+        for fname in ["wifi.json", "wifi_ap.json"]:
+            with open(os.path.join(self.device_root, fname), "w") as fout:
+                fout.write('{"ssid": "%s"}' % fname)
+        layout = self.probe()
+        self.assertEqual(layout["size"], 256 * 4096)
+        self.assertEqual(sorted(os.listdir(self.keep_dir)), ["wifi.json", "wifi_ap.json"])
+        # The wifi settings were deleted with the reset pin, they must not be put back with the next image.
+        os.unlink(os.path.join(self.device_root, "wifi.json"))
+        self.probe()
+        self.assertEqual(os.listdir(self.keep_dir), ["wifi_ap.json"])
+        with open(os.path.join(self.keep_dir, "wifi_ap.json")) as fin:
+            self.assertEqual(fin.read(), '{"ssid": "wifi_ap.json"}')
+
+
+if __name__ == "__main__":
+    unittest.main()
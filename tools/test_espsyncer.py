@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Tests of espsyncer.py, on an emulated device (see esp_emulator.py).
+
+    python3 -m unittest test_espsyncer
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import serial
+
+import espsyncer
+from esp_emulator import EspEmulator
+
+# bytes(range(256)) never contains the soft reset sequence, that would end the hang of the emulated device.
+FILE_DATA = bytes(range(256)) * 64
+# The agent hangs after this many bytes of frames were received.
+STALL_AFTER = 8 * 1024
+TIMEOUT = 5
+
+
+class ResumeUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_espsyncer_")
+        self.src = os.path.join(self.workdir, "src")
+        self.device_root = os.path.join(self.workdir, "device")
+        os.makedirs(self.src)
+        os.makedirs(self.device_root)
+        with open(os.path.join(self.src, "big.bin"), "wb") as fout:
+            fout.write(FILE_DATA)
+        self.log = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def upload(self, baudrate=None, fast_baudrates=None, reset_mode=espsyncer.RESET_SOFT):
+        """Upload big.bin to a device that stops responding in the middle. Returns the syncer."""
+        with EspEmulator(self.device_root, baudrate, stall_after=STALL_AFTER) as emulator:
+            with serial.Serial(emulator.port, baudrate or espsyncer.DEFAULT_BAUD_RATE, timeout=TIMEOUT) as ser:
+                if reset_mode == espsyncer.RESET_HARD:
+                    # The pseudo terminal has no modem lines. RTS drives the EN pin of the emulated device.
+                    ser.setDTR = lambda value: None
+                    ser.setRTS = lambda value: value and emulator.hard_reset()
+                syncer = espsyncer.EspSyncer(ser, TIMEOUT, self.log.append, reset_mode=reset_mode)
+                syncer.reset()
+                boots = emulator.boots
+                if fast_baudrates:
+                    syncer.negotiate_baudrate(fast_baudrates)
+                syncer.upload(self.src, "/", True, True, False)
+                self.fast_baudrate = ser.baudrate
+                syncer.restore_baudrate()
+                self.assertTrue(syncer.probe())
+            self.assertEqual(emulator.boots, boots + 1)
+        return syncer
+
+    def assert_resumed(self):
+        log = "".join(self.log)
+        self.assertIn("TIMEOUT /big.bin", log)
+        self.assertIn("UPLOAD /big.bin (resumed at", log)
+        offset = float(log.split("resumed at ")[1].split("K")[0]) * 1024
+        self.assertGreater(offset, 0)
+        self.assertEqual(os.listdir(self.device_root), ["big.bin"])
+        with open(os.path.join(self.device_root, "big.bin"), "rb") as fin:
+            self.assertEqual(fin.read(), FILE_DATA)
+
+    def test_resume_after_timeout(self):
+        self.upload()
+        self.assert_resumed()
+
+    def test_resume_negotiates_baudrate(self):
+        # After a hard reset, the device is at its boot baud rate again.
+        syncer = self.upload(espsyncer.DEFAULT_BAUD_RATE, [460800], espsyncer.RESET_HARD)
+        self.assert_resumed()
+        self.assertEqual("".join(self.log).count("BAUDRATE 115200 -> 460800 OK"), 2)
+        self.assertEqual(self.fast_baudrate, 460800)
+        self.assertEqual(syncer.ser.baudrate, espsyncer.DEFAULT_BAUD_RATE)
+
+
+class ManifestTest(unittest.TestCase):
+    """Checksum sync must not skip a changed file, because of a stale hash in the manifest on the device."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_espsyncer_")
+        self.src = os.path.join(self.workdir, "src")
+        self.device_root = os.path.join(self.workdir, "device")
+        os.makedirs(self.src)
+        os.makedirs(self.device_root)
+        self.log = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def write_source(self, data):
+        with open(os.path.join(self.src, "wifi.json"), "wb") as fout:
+            fout.write(data)
+
+    def device_file(self):
+        return os.path.join(self.device_root, "wifi.json")
+
+    def sync(self, checksum=True):
+        """Upload the source directory in a new session. Returns True when wifi.json was uploaded."""
+        del self.log[:]
+        with EspEmulator(self.device_root) as emulator:
+            with serial.Serial(emulator.port, espsyncer.DEFAULT_BAUD_RATE, timeout=TIMEOUT) as ser:
+                syncer = espsyncer.EspSyncer(ser, TIMEOUT, self.log.append, reset_mode=espsyncer.RESET_SOFT)
+                syncer.reset()
+                syncer.upload(self.src, "/", True, True, False, checksum=checksum)
+        return "UPLOAD /wifi.json" in "".join(self.log)
+
+    def test_upload_without_checksum(self):
+        self.write_source(b'{"ssid": "aaaa"}')
+        self.assertTrue(self.sync())
+        mtime = os.stat(self.device_file()).st_mtime
+        # Same size, and the same mtime on the device (e.g. within the 2 seconds of FAT).
+        self.write_source(b'{"ssid": "bbbb"}')
+        self.assertTrue(self.sync(checksum=False))
+        os.utime(self.device_file(), (mtime, mtime))
+        self.write_source(b'{"ssid": "aaaa"}')
+        self.assertTrue(self.sync())
+        with open(self.device_file(), "rb") as fin:
+            self.assertEqual(fin.read(), b'{"ssid": "aaaa"}')
+        self.assertFalse(self.sync())
+
+    def test_clock_not_set(self):
+        # The clock of the device starts from the epoch after every boot.
+        mtime = 100
+        self.write_source(b'{"ssid": "aaaa"}')
+        self.assertTrue(self.sync())
+        os.utime(self.device_file(), (mtime, mtime))
+        self.assertFalse(self.sync())
+        # The application saves other settings, in another boot.
+        with open(self.device_file(), "wb") as fout:
+            fout.write(b'{"ssid": "bbbb"}')
+        os.utime(self.device_file(), (mtime, mtime))
+        self.assertTrue(self.sync())
+        with open(self.device_file(), "rb") as fin:
+            self.assertEqual(fin.read(), b'{"ssid": "aaaa"}')
+
+
+class BatchResetTest(unittest.TestCase):
+    """A batch can end with (or contain) an execute operation that resets the device."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_espsyncer_")
+        self.src = os.path.join(self.workdir, "src")
+        self.device_root = os.path.join(self.workdir, "device")
+        os.makedirs(self.src)
+        os.makedirs(self.device_root)
+        with open(os.path.join(self.src, "main.py"), "wb") as fout:
+            fout.write(b"print('hello')\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run_batch(self, lines, fast_baudrate):
+        """Run a batch in a session with soft reset. Returns the stdout of the session, and the emulator."""
+        batch = os.path.join(self.workdir, "batch.txt")
+        with open(batch, "w") as fout:
+            fout.write("\n".join(lines) + "\n")
+        parser = argparse.ArgumentParser()
+        espsyncer.add_operation_arguments(parser)
+        espsyncer.add_session_arguments(parser)
+        args = parser.parse_args(["--reset", espsyncer.RESET_SOFT, "--timeout", str(TIMEOUT),
+                                  "--fast-baudrate", fast_baudrate])
+        args.verbose, args.telemetry_report = True, None
+        with EspEmulator(self.device_root) as emulator:
+            args.port = emulator.port
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                espsyncer.Main(args).run(espsyncer.Commands.BATCH.value, [batch])
+        return stdout.getvalue(), emulator
+
+    def test_reset_at_the_end(self):
+        output, emulator = self.run_batch([
+            "--overwrite --contents upload %s /" % self.src,
+            'execute "print(42); import machine; machine.reset()"',
+        ], "460800")
+        self.assertIn("BAUDRATE 115200 -> 460800 OK", output)
+        self.assertIn("REBOOTED\n42", output)
+        # The device is at its boot baud rate after the reset, it is not switched back.
+        self.assertNotIn("BAUDRATE 460800 -> 115200", output)
+        self.assertEqual(emulator.baudrate, emulator.boot_baudrate)
+        # The initial boot, the reset of the session, and machine.reset()
+        self.assertEqual(emulator.boots, 3)
+        self.assertTrue(os.path.isfile(os.path.join(self.device_root, "main.py")))
+
+    def test_reset_in_the_middle(self):
+        output, emulator = self.run_batch([
+            'execute "import machine; machine.reset()"',
+            "--overwrite --contents upload %s /" % self.src,
+            'execute "print(len(open(\'main.py\').read()))"',
+        ], "off")
+        self.assertIn("REBOOTED", output)
+        self.assertIn("UPLOAD /main.py", output)
+        self.assertIn("\n15\r\n", output)
+        self.assertEqual(emulator.boots, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
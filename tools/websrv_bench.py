@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Load test and benchmark for libs/websrv.py on a Linux host.
+
+The web server (websrv + wifi_setup.handle) is started in a separate process (see websrv_bench_server.py),
+either with CPython or with the MicroPython unix port. MicroPython specific modules are replaced with the
+ones in the host_shims directory. Then concurrent HTTP clients replay the request mix of the real frontend:
+an asset burst (index.html, stylesheets and scripts), the initial API calls and then status polling.
+"""
+import argparse
+import binascii
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MP_TOOLS = os.path.split(os.path.abspath(__file__))[0]
+MP_HOME = os.path.split(MP_TOOLS)[0]
+MP_LIBS = os.path.join(MP_HOME, "libs")
+HOST_SHIMS = os.path.join(MP_TOOLS, "host_shims")
+BENCH_SERVER = os.path.join(MP_TOOLS, "websrv_bench_server.py")
+DEFAULT_WEBROOT = os.path.join(MP_HOME, "assets", "wifi_setup", "frontend", "wifi_setup")
+
+DEFAULT_CLIENTS = 4
+DEFAULT_SESSIONS = 5
+DEFAULT_POLLS = 8
+DEFAULT_TIMEOUT = 10
+
+# Used when there is no minified frontend build: (path, size) pairs, sizes are similar to the real build.
+SYNTHETIC_STYLES = [("static/css/main.css", 28 * 1024)]
+SYNTHETIC_SCRIPTS = [("static/js/main.js", 160 * 1024)]
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = max(0, min(len(values) - 1, int(round(percent / 100.0 * len(values) + 0.5)) - 1))
+    return values[idx]
+
+
+def api_path(params):
+    """Path of an API call, encoded the same way as the frontend does it."""
+    return "api/" + binascii.hexlify(json.dumps(params).encode("ascii")).decode("ascii")
+
+
+def http_get(port, path, timeout):
+    """Send a GET request and return (status, body). Status is zero when the connection failed."""
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=timeout) as sock:
+            sock.sendall(b"GET /" + path.encode("ascii") + b" HTTP/1.1\r\nHost: websrv_bench\r\n\r\n")
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+    except OSError:
+        return 0, b''
+    response = b''.join(chunks)
+    idx = response.find(b'\r\n\r\n')
+    if not response.startswith(b'HTTP/') or idx < 0:
+        return 0, response
+    header, body = response[:idx], response[idx + 4:]
+    status = int(header[9:12])
+    match = re.search(rb'Content-Length:\s*(\d+)', header, re.IGNORECASE)
+    if match and int(match.group(1)) != len(body):
+        # The server sent something else than it promised.
+        return 0, body
+    return status, body
+
+
+def find_assets(webroot):
+    """Return the stylesheets and scripts that are loaded by the (minified) index.html."""
+    with open(os.path.join(webroot, "index.html"), "r", encoding="UTF-8") as fin:
+        data = fin.read()
+    result = []
+    for name in ["all_styles", "all_js"]:
+        match = re.search(r'var %s = (\[.*?\]);' % name, data)
+        if match:
+            result.append([url.lstrip("/") for url in json.loads(match.group(1))])
+        else:
+            result.append([])
+    return result
+
+
+def make_synthetic_webroot(webroot):
+    """Create a webroot with incompressible assets, in the same layout that esp_minify_www.py produces."""
+    for path, size in SYNTHETIC_STYLES + SYNTHETIC_SCRIPTS:
+        fpath = os.path.join(webroot, path + ".gz")
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "wb") as fout:
+            fout.write(os.urandom(size))
+    with open(os.path.join(webroot, "index.html"), "w", encoding="UTF-8") as fout:
+        fout.write("<html><body><div id=\"root\"></div><script>\nvar all_styles = %s;\nvar all_js = %s;\n"
+                   "</script></body></html>\n" % (
+                       json.dumps(["/" + path for path, _ in SYNTHETIC_STYLES]),
+                       json.dumps(["/" + path for path, _ in SYNTHETIC_SCRIPTS])))
+
+
+class Client(threading.Thread):
+    """Replays frontend sessions and records (path_class, latency, status, size) for every request."""
+
+    def __init__(self, port, args, styles, scripts):
+        super().__init__(daemon=True)
+        self.port = port
+        self.args = args
+        self.assets = ["index.html"] + styles + scripts
+        self.results = []
+
+    def get(self, path_class, path):
+        started = time.perf_counter()
+        status, body = http_get(self.port, path, self.args.timeout)
+        self.results.append((path_class, time.perf_counter() - started, status, len(body)))
+
+    def api(self, params):
+        self.get("api", api_path(params))
+
+    def run(self):
+        for _ in range(self.args.sessions):
+            # Asset burst, as done by the loader in the minified index.html
+            for path in self.assets:
+                self.get("static", path)
+            # App.fullReload
+            self.api({"op": "scan_wifi"})
+            self.api({"op": "get_wifi_params"})
+            # App.testCurrentNetwork + App.monitorCurrentNetwork
+            self.api({"op": "set_wifi_param", "params": {"ssid": "office", "password": "secret"}})
+            self.api({"op": "connect_configured_wifi", "ssid": "office"})
+            for _ in range(self.args.polls):
+                if self.args.poll_interval:
+                    time.sleep(self.args.poll_interval)
+                self.api({"op": "ap_status"})
+            self.api({"op": "ifconfig"})
+
+
+class Main:
+    def __init__(self, args):
+        self.args = args
+
+    def log(self, s):
+        if self.args.verbose:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+    @staticmethod
+    def get_free_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def start_server(self, port, webroot, workdir):
+        cmd = [self.args.interpreter, BENCH_SERVER, str(port), webroot, MP_LIBS, HOST_SHIMS,
+               "1" if self.args.stats else "0"]
+        self.log("SERVER %s\n" % " ".join(cmd))
+        server = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL)
+        started = time.time()
+        while True:
+            if server.poll() is not None:
+                raise SystemExit("Server exited with code %s" % server.returncode)
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=1):
+                    pass
+                return server
+            except OSError:
+                if time.time() - started > self.args.timeout:
+                    server.kill()
+                    raise SystemExit("Server did not start within %ss" % self.args.timeout)
+                time.sleep(0.05)
+
+    def summarize(self, results, elapsed):
+        report = {
+            "interpreter": self.args.interpreter,
+            "clients": self.args.clients,
+            "duration": elapsed,
+            "requests": len(results),
+            "errors": sum(1 for item in results if not 200 <= item[2] < 300),
+            "bytes": sum(item[3] for item in results),
+            "requests_per_sec": len(results) / elapsed if elapsed else 0.0,
+            "latency_ms": {},
+        }
+        for path_class in ["static", "api", "all"]:
+            latencies = [item[1] * 1000.0 for item in results if path_class in ["all", item[0]]]
+            report["latency_ms"][path_class] = {
+                "count": len(latencies),
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies) if latencies else 0.0,
+            }
+        return report
+
+    def print_report(self, report):
+        print("Requests:      %d (%d errors)" % (report["requests"], report["errors"]))
+        print("Duration:      %.2fs" % report["duration"])
+        print("Throughput:    %.1f req/s, %.1f KB/s" % (
+            report["requests_per_sec"], report["bytes"] / 1024.0 / report["duration"]))
+        print("Latency (ms)       count      p50      p99      max")
+        for path_class, lat in report["latency_ms"].items():
+            print("    %-12s %8d %8.2f %8.2f %8.2f" % (path_class, lat["count"], lat["p50"], lat["p99"], lat["max"]))
+        server = report.get("server")
+        if server:
+            print("Server memory: %.1fK baseline, %.1fK peak" % (
+                server["baseline"] / 1024.0, server["peak"] / 1024.0))
+
+    def run(self):
+        with tempfile.TemporaryDirectory(prefix="websrv_bench_") as workdir:
+            webroot = self.args.webroot
+            if not os.path.isfile(os.path.join(webroot, "index.html")):
+                self.log("No index.html in %s, using synthetic assets\n" % webroot)
+                webroot = os.path.join(workdir, "www")
+                make_synthetic_webroot(webroot)
+            styles, scripts = find_assets(webroot)
+
+            port = self.get_free_port()
+            server = self.start_server(port, webroot, workdir)
+            try:
+                clients = [Client(port, self.args, styles, scripts) for _ in range(self.args.clients)]
+                started = time.perf_counter()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                elapsed = time.perf_counter() - started
+                results = []
+                for client in clients:
+                    results += client.results
+
+                report = self.summarize(results, elapsed)
+                status, body = http_get(port, api_path({"op": "bench_report"}), self.args.timeout)
+                if status == 200:
+                    report["server"] = json.loads(body)
+            finally:
+                server.kill()
+                server.wait()
+
+        self.print_report(report)
+        if self.args.json:
+            with open(self.args.json, "w") as fout:
+                json.dump(report, fout, indent=2)
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test and benchmark websrv on the host')
+    parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
+                        help="Be verbose")
+    parser.add_argument("-i", "--interpreter", dest='interpreter', default=sys.executable,
+                        help="Interpreter for the server, e.g. the path of the MicroPython unix port."
+                             " Default is the current python interpreter.")
+    parser.add_argument("-w", "--webroot", dest='webroot', default=DEFAULT_WEBROOT,
+                        help="Minified frontend directory, default is %s. When it does not exist, then"
+                             " synthetic assets are used." % DEFAULT_WEBROOT)
+    parser.add_argument("-c", "--clients", dest='clients', type=int, default=DEFAULT_CLIENTS,
+                        help="Number of concurrent clients, default is %s" % DEFAULT_CLIENTS)
+    parser.add_argument("-s", "--sessions", dest='sessions', type=int, default=DEFAULT_SESSIONS,
+                        help="Number of frontend sessions per client, default is %s" % DEFAULT_SESSIONS)
+    parser.add_argument("--polls", dest='polls', type=int, default=DEFAULT_POLLS,
+                        help="Number of status polls per session, default is %s" % DEFAULT_POLLS)
+    parser.add_argument("--poll-interval", dest='poll_interval', type=float, default=0.0,
+                        help="Seconds between status polls. The frontend uses 0.5, default is 0 (no wait).")
+    parser.add_argument("-t", "--timeout", dest='timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="Socket timeout, default is %s" % DEFAULT_TIMEOUT)
+    parser.add_argument("--stats", dest='stats', action="store_true", default=False,
+                        help="Enable websrv.STATS on the server, and include its statistics in the report.")
+    parser.add_argument("--json", dest='json', default=None,
+                        help="Write a machine readable report to this file.")
+
+    args = parser.parse_args()
+    Main(args).run()
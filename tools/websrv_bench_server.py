@@ -0,0 +1,90 @@
+# Web server process for websrv_bench.py.
+#
+# It runs websrv + wifi_setup.handle on a Linux host, under CPython or the MicroPython unix port.
+# Usage: websrv_bench_server.py <port> <webroot> <libs_dir> <shims_dir> <stats>
+import sys
+import gc
+import socket
+import select
+
+port = int(sys.argv[1])
+webroot = sys.argv[2]
+sys.path.insert(0, sys.argv[4])
+sys.path.insert(0, sys.argv[3])
+use_stats = sys.argv[5] == "1"
+
+# There is no gc.mem_free() in CPython. We emulate a heap of this size with tracemalloc.
+CPYTHON_HEAP_SIZE = 1024 * 1024
+
+if sys.implementation.name == "micropython":
+    tracemalloc = None
+else:
+    import tracemalloc
+    tracemalloc.start()
+    gc.mem_free = lambda: CPYTHON_HEAP_SIZE - tracemalloc.get_traced_memory()[0]
+
+import websrv
+import wifi_setup
+
+if tracemalloc:
+    import json
+    import types
+
+    # MicroPython serializes bytes (e.g. ssid and bssid in WLAN.scan() results) as strings.
+    websrv.json = types.SimpleNamespace(
+        loads=json.loads,
+        dumps=lambda obj: json.dumps(obj, default=lambda item: item.decode("latin-1")),
+    )
+
+websrv.STATS = use_stats
+
+
+def mem_used():
+    if tracemalloc:
+        return tracemalloc.get_traced_memory()[0]
+    elif hasattr(gc, "mem_alloc"):
+        return gc.mem_alloc()
+    else:
+        return 0
+
+
+gc.collect()
+baseline = mem_used()
+peak = baseline
+if tracemalloc:
+    tracemalloc.reset_peak()
+
+
+def handle(cl, addr, args):
+    if args and args.get("op") == "bench_report":
+        return {
+            "baseline": baseline,
+            "peak": peak,
+            "stats": websrv.stats() if websrv.STATS else None,
+        }
+    return wifi_setup.handle(cl, addr, args)
+
+
+addr = socket.getaddrinfo('127.0.0.1', port)[0][-1]
+srv = socket.socket()
+srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+srv.bind(addr)
+srv.listen(10)
+
+poll = select.poll()
+poll.register(srv, select.POLLIN)
+while True:
+    res = poll.poll(50)
+    if len(res):
+        try:
+            websrv.serve_get(srv, handle, webroot=webroot)
+        except OSError:
+            pass  # ECONNRESET?
+        if tracemalloc:
+            used = tracemalloc.get_traced_memory()[1]
+        else:
+            used = mem_used()
+        if used > peak:
+            peak = used
+    else:
+        gc.collect()
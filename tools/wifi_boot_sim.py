@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""Simulated boot-path benchmark for wifi_setup.main().
+
+wifi_setup.main() is executed on the host, many times, over randomized radio environments. The network,
+utime, machine and gc modules are replaced by a simulation that has a virtual clock, so a run takes
+microseconds instead of seconds. The simulated WLAN has scan latency, per-AP connect latency, failure
+probabilities and RSSI. Some access points reject the association: the chip keeps retrying, and the attempt
+only ends when wifi_setup gives up (CONNECT_TIMEOUT). Some are hidden: they are not in the scan results,
+but connecting without a BSSID finds them. For every connection strategy and attempt timeout, the
+distribution of the time to get an IP address, and the rates of fallbacks into setup mode and of boots
+that hang are reported.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import types
+
+MP_TOOLS = os.path.split(os.path.abspath(__file__))[0]
+MP_HOME = os.path.split(MP_TOOLS)[0]
+MP_LIBS = os.path.join(MP_HOME, "libs")
+HOST_SHIMS = os.path.join(MP_TOOLS, "host_shims")
+
+STRATEGIES = ["scan", "bssid", "direct"]
+DEFAULT_RUNS = 1000
+DEFAULT_TIMEOUTS = [0.0, 10.0]
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = 2
+STAT_NO_AP_FOUND = 3
+STAT_CONNECT_FAIL = 4
+STAT_GOT_IP = 5
+
+# Simulation parameters, in seconds
+SCAN_TIME = (1.5, 2.5)
+CONNECT_TIME = (1.0, 3.0)
+# An AP with this RSSI is slowest to connect, and it has the highest probability to fail.
+WEAK_RSSI = -90
+STRONG_RSSI = -40
+FAIL_PROBABILITY = (0.02, 0.4)
+# Probability that a failing connection hangs in STAT_CONNECTING for STUCK_TIME seconds, before it fails.
+STUCK_PROBABILITY = 0.3
+STUCK_TIME = 30.0
+# Probability that an AP rejects the association (e.g. MAC filter, too many clients). The chip keeps retrying,
+# so the status stays STAT_CONNECTING until the attempt is abandoned.
+REJECT_PROBABILITY = 0.1
+# Probability that an AP of a configured network does not broadcast its SSID.
+HIDDEN_PROBABILITY = 0.1
+# A boot that did not finish in this many seconds is counted as hung (without CONNECT_TIMEOUT, a rejected
+# association never ends).
+BOOT_LIMIT = 300.0
+
+
+class SetupMode(Exception):
+    """Raised instead of starting the setup web server (that would never return)."""
+
+
+class BootHung(Exception):
+    """Raised by the clock when the boot takes longer than BOOT_LIMIT."""
+
+
+class AccessPoint:
+    def __init__(self, ssid, bssid, rssi, connect_time, fails, stuck, rejects=False, hidden=False):
+        self.ssid = ssid
+        self.bssid = bssid
+        self.rssi = rssi
+        self.connect_time = connect_time
+        self.fails = fails
+        self.stuck = stuck
+        self.rejects = rejects
+        self.hidden = hidden
+
+    def scan_result(self):
+        return (b"" if self.hidden else self.ssid.encode("ascii"), self.bssid, 1, self.rssi, 3, self.hidden)
+
+
+class Environment:
+    """A randomized radio environment, and the wifi.json that is saved on the device."""
+
+    def __init__(self, rnd: random.Random):
+        self.scan_time = rnd.uniform(*SCAN_TIME)
+        self.configured = ["net%d" % idx for idx in range(rnd.randint(1, 3))]
+        self.aps = []
+        ssids = ["neighbour%d" % idx for idx in range(rnd.randint(0, 6))]
+        for ssid in self.configured:
+            if rnd.random() < 0.8:
+                ssids += [ssid] * rnd.randint(1, 2)
+        for ssid in ssids:
+            rssi = rnd.randint(WEAK_RSSI, STRONG_RSSI)
+            weakness = float(STRONG_RSSI - rssi) / (STRONG_RSSI - WEAK_RSSI)
+            connect_time = CONNECT_TIME[0] + (CONNECT_TIME[1] - CONNECT_TIME[0]) * weakness * rnd.uniform(0.5, 1.5)
+            fail_probability = FAIL_PROBABILITY[0] + (FAIL_PROBABILITY[1] - FAIL_PROBABILITY[0]) * weakness
+            fails = rnd.random() < fail_probability
+            stuck = fails and rnd.random() < STUCK_PROBABILITY
+            rejects = rnd.random() < REJECT_PROBABILITY
+            hidden = ssid in self.configured and rnd.random() < HIDDEN_PROBABILITY
+            bssid = bytes(rnd.randint(0, 255) for _ in range(6))
+            self.aps.append(AccessPoint(ssid, bssid, rssi, connect_time, fails, stuck, rejects, hidden))
+        rnd.shuffle(self.aps)
+        # The networks were set up in a random order, wifi_setup.mark_last_ok saved it into "last_ok". The
+        # order of the dict is not used: it is arbitrary on the device, unlike here.
+        self.last_ok = dict(zip(self.configured, rnd.sample(range(1, len(self.configured) + 1),
+                                                            len(self.configured))))
+
+    def wifi_params(self):
+        return {ssid: {"ssid": ssid, "password": "secret", "last_ok": self.last_ok[ssid]}
+                for ssid in self.configured}
+
+    def reachable(self):
+        """Tells if there is a configured network that can be connected."""
+        return any(ap.ssid in self.configured and not ap.fails and not ap.rejects for ap in self.aps)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if self.now > BOOT_LIMIT:
+            raise BootHung()
+
+
+def make_modules(env: Environment, clock: Clock):
+    """Create the simulated network, utime, machine and gc modules for a single boot."""
+    utime = types.ModuleType("utime")
+    utime.sleep = clock.sleep
+    utime.sleep_ms = lambda ms: clock.sleep(ms / 1000.0)
+    utime.time = lambda: clock.now
+    utime.ticks_ms = lambda: int(clock.now * 1000)
+    utime.ticks_diff = lambda end, start: end - start
+
+    machine = types.ModuleType("machine")
+
+    class Pin:
+        IN = 0
+        OUT = 1
+        PULL_UP = 2
+
+        def __init__(self, pin, mode=IN, pull=None):
+            pass
+
+        def value(self, value=None):
+            return 1
+
+    def reset():
+        raise SystemExit("machine.reset()")
+
+    machine.Pin = Pin
+    machine.reset = reset
+
+    network = types.ModuleType("network")
+    network.STA_IF = 0
+    network.AP_IF = 1
+    for name, value in globals().items():
+        if name.startswith("STAT_"):
+            setattr(network, name, value)
+
+    class WLAN:
+        def __init__(self, interface_id=network.STA_IF):
+            self._active = False
+            self.ap = None
+            self.result = STAT_IDLE
+            self.done_at = 0.0
+            self.attempts = 0
+
+        def active(self, is_active=None):
+            if is_active is None:
+                return self._active
+            self._active = is_active
+
+        def config(self, **kwargs):
+            pass
+
+        def scan(self):
+            clock.sleep(env.scan_time)
+            return [ap.scan_result() for ap in env.aps]
+
+        def connect(self, ssid, password, bssid=None):
+            self.attempts += 1
+            candidates = [ap for ap in env.aps if ap.ssid == ssid and (bssid is None or ap.bssid == bssid)]
+            started = clock.now
+            if bssid is None:
+                # The chip has to scan for the AP itself.
+                started += env.scan_time
+            if not candidates:
+                self.ap, self.result, self.done_at = None, STAT_NO_AP_FOUND, started
+                return
+            self.ap = max(candidates, key=lambda ap: ap.rssi)
+            if self.ap.rejects:
+                self.result, self.done_at = STAT_CONNECTING, float("inf")
+            elif self.ap.fails:
+                self.result = STAT_CONNECT_FAIL
+                self.done_at = started + (STUCK_TIME if self.ap.stuck else self.ap.connect_time)
+            else:
+                self.result = STAT_GOT_IP
+                self.done_at = started + self.ap.connect_time
+
+        def disconnect(self):
+            self.ap, self.result, self.done_at = None, STAT_IDLE, 0.0
+
+        def status(self):
+            if clock.now < self.done_at:
+                return STAT_CONNECTING
+            return self.result
+
+        def isconnected(self):
+            return self.status() == STAT_GOT_IP
+
+        def ifconfig(self):
+            return ('192.168.1.50', '255.255.255.0', '192.168.1.1', '192.168.1.1')
+
+    wlans = {}
+
+    def get_wlan(interface_id=network.STA_IF):
+        if interface_id not in wlans:
+            wlans[interface_id] = WLAN(interface_id)
+        return wlans[interface_id]
+
+    network.WLAN = get_wlan
+
+    # A real gc.collect() would take more time than the rest of the simulation.
+    gc = types.ModuleType("gc")
+    gc.collect = lambda: None
+    gc.mem_free = lambda: 0
+    return {"utime": utime, "machine": machine, "network": network, "gc": gc}
+
+
+_wifi_setup_code = None
+
+
+def load_wifi_setup():
+    """Execute wifi_setup in a fresh module. It is compiled only once."""
+    global _wifi_setup_code
+    path = os.path.join(MP_LIBS, "wifi_setup.py")
+    if _wifi_setup_code is None:
+        with open(path, "r") as fin:
+            _wifi_setup_code = compile(fin.read(), path, "exec")
+    module = types.ModuleType("wifi_setup")
+    module.__file__ = path
+    exec(_wifi_setup_code, module.__dict__)
+    return module
+
+
+def boot(env: Environment, strategy, timeout):
+    """Simulate a single boot. Returns (result, elapsed, attempts), result is "ip", "setup" or "hung"."""
+    clock = Clock()
+    with open("wifi.json", "w") as fout:
+        json.dump(env.wifi_params(), fout)
+    saved_modules = {name: sys.modules.get(name) for name in ["utime", "machine", "network", "gc"]}
+    sys.modules.update(make_modules(env, clock))
+    try:
+        wifi_setup = load_wifi_setup()
+    finally:
+        for name, module in saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def run_setup(webroot):
+        raise SetupMode()
+
+    wifi_setup.run_setup = run_setup
+    wifi_setup.CONNECT_STRATEGY = strategy
+    wifi_setup.CONNECT_TIMEOUT = timeout or None
+    try:
+        result = "ip" if wifi_setup.main() else "setup"
+    except SetupMode:
+        result = "setup"
+    except BootHung:
+        result = "hung"
+    return result, clock.now, wifi_setup.wlan.attempts
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = max(0, min(len(values) - 1, int(round(percent / 100.0 * len(values) + 0.5)) - 1))
+    return values[idx]
+
+
+class Main:
+    def __init__(self, args):
+        self.args = args
+
+    def log(self, s):
+        if self.args.verbose:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+    def simulate(self, environments, strategy, timeout):
+        to_ip, to_setup, attempts = [], [], 0
+        missed, hung = 0, 0
+        for env in environments:
+            result, elapsed, cnt = boot(env, strategy, timeout)
+            attempts += cnt
+            if result == "ip":
+                to_ip.append(elapsed)
+                continue
+            if result == "hung":
+                hung += 1
+            else:
+                to_setup.append(elapsed)
+            if env.reachable():
+                missed += 1
+        runs = len(environments)
+        return {
+            "strategy": strategy,
+            "timeout": timeout or None,
+            "runs": runs,
+            "connected": len(to_ip),
+            "fallback_rate": float(len(to_setup)) / runs,
+            "hung_rate": float(hung) / runs,
+            "missed_rate": float(missed) / runs,
+            "attempts_per_boot": float(attempts) / runs,
+            "time_to_ip": {
+                "mean": sum(to_ip) / len(to_ip) if to_ip else 0.0,
+                "p50": percentile(to_ip, 50),
+                "p90": percentile(to_ip, 90),
+                "p99": percentile(to_ip, 99),
+                "max": max(to_ip) if to_ip else 0.0,
+            },
+            "time_to_setup": {
+                "p50": percentile(to_setup, 50),
+                "p99": percentile(to_setup, 99),
+            },
+        }
+
+    def print_report(self, results):
+        print("strategy timeout   fallback    hung  missed  attempts |  ip p50   ip p90   ip p99   ip max | setup p50")
+        for res in results:
+            tti = res["time_to_ip"]
+            print("%-8s %7s %9.1f%% %6.1f%% %6.1f%% %9.2f | %6.2fs %7.2fs %7.2fs %7.2fs | %8.2fs" % (
+                res["strategy"], "%.1fs" % res["timeout"] if res["timeout"] else "-",
+                100.0 * res["fallback_rate"], 100.0 * res["hung_rate"], 100.0 * res["missed_rate"],
+                res["attempts_per_boot"],
+                tti["p50"], tti["p90"], tti["p99"], tti["max"], res["time_to_setup"]["p50"]))
+
+    def run(self):
+        rnd = random.Random(self.args.seed)
+        environments = [Environment(rnd) for _ in range(self.args.runs)]
+        reachable = sum(1 for env in environments if env.reachable())
+        self.log("%d environments, %d with a reachable configured network\n" % (len(environments), reachable))
+
+        sys.path.insert(0, HOST_SHIMS)
+        sys.path.insert(0, MP_LIBS)
+        results = []
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory(prefix="wifi_boot_sim_") as workdir:
+            os.chdir(workdir)
+            try:
+                for strategy in self.args.strategies:
+                    for timeout in self.args.timeouts:
+                        self.log("SIMULATE %s, timeout=%s\n" % (strategy, timeout or None))
+                        results.append(self.simulate(environments, strategy, timeout))
+            finally:
+                os.chdir(cwd)
+
+        self.print_report(results)
+        if self.args.json:
+            with open(self.args.json, "w") as fout:
+                json.dump(results, fout, indent=2)
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate wifi_setup.main() over randomized environments')
+    parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
+                        help="Be verbose")
+    parser.add_argument("-n", "--runs", dest='runs', type=int, default=DEFAULT_RUNS,
+                        help="Number of randomized environments, default is %s" % DEFAULT_RUNS)
+    parser.add_argument("--seed", dest='seed', type=int, default=0,
+                        help="Random seed, default is 0")
+    parser.add_argument("-s", "--strategy", dest='strategies', action="append", choices=STRATEGIES,
+                        default=None,
+                        help="Connection strategy (wifi_setup.CONNECT_STRATEGY). Can be specified multiple"
+                             " times. Default is all of them: %s" % ", ".join(STRATEGIES))
+    parser.add_argument("-t", "--timeout", dest='timeouts', action="append", type=float, default=None,
+                        help="Attempt timeout in seconds (wifi_setup.CONNECT_TIMEOUT), zero means no timeout."
+                             " Can be specified multiple times. Default is %s" % DEFAULT_TIMEOUTS)
+    parser.add_argument("--json", dest='json', default=None,
+                        help="Write a machine readable report to this file.")
+
+    args = parser.parse_args()
+    if not args.strategies:
+        args.strategies = STRATEGIES
+    if not args.timeouts:
+        args.timeouts = DEFAULT_TIMEOUTS
+    Main(args).run()